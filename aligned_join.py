@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+
+'''Time-aligned outer join of data sets at a chosen time and place grain.
+
+yearly_numeric_data.csv is a wide table each source added columns to by
+hand. JoinEngine builds such tables from declared sources instead. A
+source is a loader returning rows plus the names of its time column and,
+optionally, its borough and community district columns:
+
+    engine = JoinEngine(cache_dir='datasets/aligned_cache')
+
+    @engine.register('tonnage', time='MONTH', time_grain='month', borough='BOROUGH',
+                     district='COMMUNITYDISTRICT', values=TONNAGE_COLUMNS, how='sum',
+                     version=lambda: source_version(tonnage_file))
+    def load_tonnage_rows():
+        return pd.read_csv(tonnage_file, dtype=str)
+
+    engine.frame(time='year', geo='borough')
+
+frame() resamples every source that has data at the requested grain
+(time: month, year; place: city, borough, district) and outer-joins the
+results on (time[, borough[, district]]), the same index TonnageRollup
+uses. how says how rows and finer grains combine: 'sum', 'mean' or
+'count' (rows per key, stored under the single name in values). Means
+are kept as sums and row counts until the end, so a yearly or city mean
+is the mean over all rows, not a mean of monthly or borough means. With
+pivot, the values of a column (e.g. an indicator name) become columns.
+
+A source is first reduced to its own finest grain and every coarser
+grain is derived from that, never from the raw rows again. Each result
+is cached in memory and, for sources with a version, as a pickle in
+cache_dir. Adding a source to a table therefore costs one resample of
+that source; the others come from the cache.
+
+Running the module regenerates the columns of the yearly CSVs that the
+declared sources provide; the dashboard's column list is read from their
+header, so it follows:
+
+    python aligned_join.py datasets --update-yearly'''
+
+import argparse
+import os
+import pickle
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import source_version
+from energy_cleaning import load_benchmarking
+from tonnage_rollup import TONNAGE_COLUMNS, parse_months
+
+TIME_GRAINS = ['month', 'year']          # finest first
+GEO_GRAINS = ['city', 'borough', 'district']
+GEO_KEYS = {'city': [], 'borough': ['borough'], 'district': ['borough', 'district']}
+HOW = ['sum', 'mean', 'count']
+CACHE_FORMAT = 2
+
+BOROUGHS = ['Manhattan', 'Bronx', 'Brooklyn', 'Queens', 'Staten Island']
+# Names and codes ('1'..'5', in boro_cd order) as written across the sources
+BOROUGH_LOOKUP = dict({name.lower(): name for name in BOROUGHS}, **{str(i + 1): name for i, name in enumerate(BOROUGHS)})
+BOROUGH_LOOKUP['the bronx'] = 'Bronx'
+
+
+def borough_names(series):
+    '''Borough names as in monthly_tonnage.csv from any spelling or code.'''
+    text = series.astype(str).str.strip().str.lower().str.replace(r'\.0+$', '', regex=True)
+    return text.map(BOROUGH_LOOKUP)
+
+
+def district_keys(districts, boroughs=None):
+    '''(borough, district) from community district numbers.
+
+    Three digit boro_cd codes (101 = Manhattan 01, as in the spatial join
+    output) carry their borough; plain district numbers take it from
+    boroughs.'''
+    number = pd.to_numeric(districts, errors='coerce')
+    from_code = (number // 100).map(lambda code: BOROUGH_LOOKUP.get(str(int(code))) if code > 0 else None)
+    borough = from_code if boroughs is None else from_code.where(number >= 100, borough_names(boroughs))
+    district = (number % 100).map(lambda d: None if pd.isnull(d) else '{:02d}'.format(int(d)))
+    return borough, district
+
+
+def parse_time(series, grain, time_format=None):
+    '''Monthly Periods or int years from a time column.
+
+    Month keys are parsed with time_format if given, else as "1993 / 11".
+    Years are the first four digit group of the text, so "2005", "2005-07"
+    and "Annual Average 2009-2010" all count towards their first year.'''
+    if grain == 'month':
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return series.dt.to_period('M')
+        if time_format:
+            return pd.to_datetime(series, format=time_format, errors='coerce').dt.to_period('M')
+        return parse_months(series)
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.dt.year.astype('Int64')
+    return pd.to_numeric(series.astype(str).str.extract(r'(\d{4})', expand=False), errors='coerce').astype('Int64')
+
+
+def column_name(text):
+    '''Lower-case underscore name for a pivoted value, like the yearly columns.'''
+    return re.sub(r'[^0-9a-z%]+', '_', str(text).lower()).strip('_')
+
+
+class TimeSource:
+    '''A data set with a time key, an optional geography and the values to combine.'''
+
+    def __init__(self, name, loader, time, time_grain='year', time_format=None, borough=None, district=None,
+                 values=None, how='sum', pivot=None, version=None):
+        if time_grain not in TIME_GRAINS:
+            raise ValueError('time_grain must be one of {}'.format(TIME_GRAINS))
+        if how not in HOW:
+            raise ValueError('how must be one of {}'.format(HOW))
+        if how == 'count' and (not values or len(values) != 1):
+            raise ValueError('how="count" needs values=[<name of the count column>]')
+        self.name = name
+        self.loader = loader
+        self.time = time
+        self.time_grain = time_grain
+        self.time_format = time_format
+        self.borough = borough
+        self.district = district
+        self.values = list(values or [])
+        self.how = how
+        self.pivot = [pivot] if isinstance(pivot, str) else pivot
+        self.version_func = version
+
+    @property
+    def geo_grain(self):
+        return 'district' if self.district else 'borough' if self.borough else 'city'
+
+    def supports(self, time, geo):
+        return (TIME_GRAINS.index(time) >= TIME_GRAINS.index(self.time_grain)
+                and GEO_GRAINS.index(geo) <= GEO_GRAINS.index(self.geo_grain))
+
+    def version(self):
+        return None if self.version_func is None else str(self.version_func())
+
+    def reduce(self, df):
+        '''The rows of df combined at this source's finest grain.'''
+        keys = pd.DataFrame({self.time_grain: parse_time(df[self.time], self.time_grain, self.time_format)},
+                            index=df.index)
+        if self.district:
+            keys['borough'], keys['district'] = district_keys(df[self.district],
+                                                              df[self.borough] if self.borough else None)
+        elif self.borough:
+            keys['borough'] = borough_names(df[self.borough])
+        key_names = list(keys.columns)
+
+        if self.how == 'count':
+            values = pd.DataFrame({self.values[0]: np.ones(len(df), dtype=np.int64)}, index=df.index)
+        else:
+            values = df[self.values].apply(pd.to_numeric, errors='coerce')
+        frame = pd.concat([keys, values], axis=1)
+        if self.pivot:
+            frame['pivot'] = df[self.pivot].astype(str).agg(' '.join, axis=1).map(column_name)
+            key_names.append('pivot')
+        frame = frame.dropna(subset=key_names)
+        if self.time_grain == 'year':
+            frame['year'] = frame['year'].astype(np.int64)
+
+        grouped = frame.groupby(key_names, observed=True)[list(values.columns)]
+        reduced = self._columns(grouped.sum(), values.columns)
+        if self.how == 'mean':
+            # Sums and row counts, so every coarser grain is a mean over rows
+            # rather than a mean of the finer grain's means
+            reduced = pd.concat({'sum': reduced, 'count': self._columns(grouped.count(), values.columns)},
+                                axis=1)
+        return reduced.sort_index()
+
+    def _columns(self, grouped, values):
+        if not self.pivot:
+            return grouped
+        grouped = grouped.unstack('pivot')
+        if len(values) == 1:
+            grouped.columns = list(grouped.columns.get_level_values('pivot'))
+        else:
+            grouped.columns = ['{}_{}'.format(p, column_name(v)) for v, p in grouped.columns]
+        return grouped
+
+    def resample(self, reduced, time, geo):
+        '''A coarser grain of the output of reduce(), in the same form.'''
+        if (time, geo) == (self.time_grain, self.geo_grain):
+            return reduced
+        index = reduced.index.to_frame(index=False)
+        if time == 'year' and self.time_grain == 'month':
+            index['year'] = index.pop('month').dt.year
+        keys = [index[key].values for key in [time] + GEO_KEYS[geo]]
+        return reduced.groupby(keys).sum().rename_axis([time] + GEO_KEYS[geo]).sort_index()
+
+    def finish(self, reduced):
+        '''The values of a reduce() or resample() result: means divide sums by counts.'''
+        if self.how != 'mean':
+            return reduced
+        counts = reduced['count']
+        return reduced['sum'] / counts.where(counts > 0)
+
+
+class JoinEngine:
+    '''Declared time sources, resampled on demand and joined on a shared index.'''
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.sources = {}
+        self._cache = {}    # (name, time, geo) -> (version, frame)
+        self._lock = threading.Lock()
+
+    def register(self, name, loader=None, **options):
+        '''Declare a source (see TimeSource). Without loader, works as a decorator.'''
+        if loader is None:
+            def decorator(func):
+                self.register(name, func, **options)
+                return func
+            return decorator
+        if name in self.sources:
+            raise ValueError('source "{}" is already registered'.format(name))
+        self.sources[name] = TimeSource(name, loader, **options)
+        return self.sources[name]
+
+    def register_dataset(self, registry, name, **options):
+        '''Declare a data set of a DatasetRegistry, versioned like its handle.'''
+        handle = registry.handle(name)
+        options.setdefault('version', handle.version_func)
+        return self.register(name, handle.get, **options)
+
+    def invalidate(self, name):
+        '''Forget the cached frames of a source, e.g. after its data changed.'''
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == name]:
+                del self._cache[key]
+
+    # -- cache ----------------------------------------------------------
+
+    def _cache_path(self, name, time, geo):
+        return os.path.join(self.cache_dir, '{}.{}.{}.pickle'.format(name, time, geo))
+
+    def _cached(self, name, time, geo, version):
+        found = self._cache.get((name, time, geo))
+        if found is not None and found[0] == version:
+            return found[1]
+        if self.cache_dir is None or version is None:
+            return None
+        try:
+            with open(self._cache_path(name, time, geo), 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        if (entry.get('format'), entry.get('version')) != (CACHE_FORMAT, version):
+            return None
+        self._cache[(name, time, geo)] = (version, entry['frame'])
+        return entry['frame']
+
+    def _store(self, name, time, geo, version, frame):
+        self._cache[(name, time, geo)] = (version, frame)
+        if self.cache_dir is None or version is None:
+            return
+        path = self._cache_path(name, time, geo)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'format': CACHE_FORMAT, 'version': version, 'frame': frame}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # -- queries --------------------------------------------------------
+
+    def series(self, name, time='year', geo='city'):
+        '''One source resampled to (time, geo), from the cache when it is current.'''
+        source = self.sources[name]
+        if not source.supports(time, geo):
+            raise ValueError('source "{}" has no data at the {} x {} grain (finest is {} x {})'.format(
+                name, time, geo, source.time_grain, source.geo_grain))
+        version = source.version()
+        with self._lock:
+            frame = self._cached(name, time, geo, version)
+            if frame is not None:
+                return source.finish(frame)
+            finest = (source.time_grain, source.geo_grain)
+            reduced = self._cached(name, finest[0], finest[1], version)
+            if reduced is None:
+                reduced = source.reduce(source.loader())
+                self._store(name, finest[0], finest[1], version, reduced)
+            frame = source.resample(reduced, time, geo)
+            if (time, geo) != finest:
+                self._store(name, time, geo, version, frame)
+            return source.finish(frame)
+
+    def compatible(self, time='year', geo='city'):
+        return [name for name, source in self.sources.items() if source.supports(time, geo)]
+
+    def frame(self, time='year', geo='city', names=None):
+        '''Outer join of the named sources (by default all that have data at the grain).
+
+        A column name used by more than one source is prefixed with the
+        source's name.'''
+        if time not in TIME_GRAINS or geo not in GEO_GRAINS:
+            raise ValueError('time must be one of {} and geo one of {}'.format(TIME_GRAINS, GEO_GRAINS))
+        names = self.compatible(time, geo) if names is None else list(names)
+        frames = [self.series(name, time, geo) for name in names]
+        if not frames:
+            return pd.DataFrame(index=pd.Index([], name=time))
+        seen = pd.Index([col for frame in frames for col in frame.columns])
+        shared = set(seen[seen.duplicated()])
+        frames = [frame.rename(columns={col: '{}_{}'.format(name, col) for col in frame.columns if col in shared})
+                  for name, frame in zip(names, frames)]
+        return pd.concat(frames, axis=1, join='outer', sort=True)
+
+
+def default_engine(data_dir, cache_dir=None):
+    '''Engine over the time-keyed data sets of the datasets directory.
+
+    Sources whose files are missing are left out.'''
+    engine = JoinEngine(cache_dir)
+    tonnage_file = os.path.join(data_dir, 'monthly_tonnage.csv')
+    complaints_file = os.path.join(data_dir, 'pri_env_complaints_by_borough.csv')
+    air_file = os.path.join(data_dir, 'air_quality.csv')
+    energy_files = [os.path.join(data_dir, 'pri_municipalenergy_consumption_10to13.csv'),
+                    os.path.join(data_dir, 'pri_municipalenergy_consumption_10to14.csv')]
+
+    if os.path.exists(tonnage_file):
+        engine.register('tonnage', lambda: pd.read_csv(tonnage_file, dtype=str), time='MONTH',
+                        time_grain='month', borough='BOROUGH', district='COMMUNITYDISTRICT',
+                        values=TONNAGE_COLUMNS, how='sum', version=lambda: source_version(tonnage_file))
+    if os.path.exists(complaints_file):
+        # e.g. 11/25/2011 10:53:37 AM
+        engine.register('complaints', lambda: pd.read_csv(complaints_file, dtype=str), time='Date_Received',
+                        time_grain='month', time_format='%m/%d/%Y %I:%M:%S %p',
+                        borough='Incident_Address_Borough', values=['number_of_indoor_complaints'],
+                        how='count', version=lambda: source_version(complaints_file))
+    if os.path.exists(air_file):
+        def load_air_quality():
+            df = pd.read_csv(air_file, dtype=str)
+            return df[df['geo_type_name'] == 'Borough']
+        engine.register('air_quality', load_air_quality, time='year_description', borough='geo_entity_name',
+                        values=['data_valuemessage'], how='mean', pivot=['name', 'Measure'],
+                        version=lambda: source_version(air_file))
+    if all(os.path.exists(path) for path in energy_files):
+        engine.register('energy', lambda: load_benchmarking(energy_files), time='year', borough='borough',
+                        values=['value'], how='mean', pivot='metric',
+                        version=lambda: ','.join(source_version(path) for path in energy_files))
+    return engine
+
+
+def update_yearly_files(frame, num_file, stan_file, add=False):
+    '''Rewrite the columns of the yearly numeric and standardized CSVs found in frame.
+
+    frame is a year x column table (JoinEngine.frame('year', 'city')).
+    Only years already in the yearly files are filled. With add, columns
+    the files do not have yet are appended. Returns the columns written.'''
+    # round_trip parsing so the columns we do not touch are written back unchanged
+    num_df = pd.read_csv(num_file, index_col=0, float_precision='round_trip')
+    stan_df = pd.read_csv(stan_file, index_col=0, float_precision='round_trip')
+    aligned = frame.reindex(num_df['year'].astype(int).values)
+    columns = [col for col in frame.columns if add or col in num_df.columns]
+    for col in columns:
+        # Round away float summation noise so reruns write identical files
+        values = np.round(aligned[col].to_numpy(dtype=np.float64, na_value=np.nan), 6)
+        num_df[col] = values
+        if np.isfinite(values).any():
+            low, high = np.nanmin(values), np.nanmax(values)
+            stan_df[col] = (values - low) / (high - low) if high > low else 0.0
+        else:
+            stan_df[col] = values
+    num_df.to_csv(num_file)
+    stan_df.to_csv(stan_file)
+    return columns
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Join the time-keyed data sets at a year/month and place grain.')
+    parser.add_argument('data_dir', help='datasets directory')
+    parser.add_argument('--time', default='year', choices=TIME_GRAINS)
+    parser.add_argument('--geo', default='city', choices=GEO_GRAINS)
+    parser.add_argument('--sources', help='comma separated sources, default all with data at the grain')
+    parser.add_argument('--cache-dir', help='resampled frame cache, default <data_dir>/aligned_cache')
+    parser.add_argument('--out', help='write the joined frame to this CSV')
+    parser.add_argument('--update-yearly', action='store_true',
+                        help='regenerate the yearly CSV columns the sources provide')
+    parser.add_argument('--add-columns', action='store_true',
+                        help='with --update-yearly, also append columns the yearly CSVs do not have')
+    args = parser.parse_args()
+
+    engine = default_engine(args.data_dir, args.cache_dir or os.path.join(args.data_dir, 'aligned_cache'))
+    names = args.sources.split(',') if args.sources else None
+    frame = engine.frame(args.time, args.geo, names)
+    print('{} x {}: {} rows x {} columns from {}'.format(args.time, args.geo, len(frame), len(frame.columns),
+                                                       ', '.join(names or engine.compatible(args.time, args.geo))))
+    if args.out:
+        frame.to_csv(args.out)
+    if args.update_yearly:
+        yearly = frame if (args.time, args.geo) == ('year', 'city') else engine.frame('year', 'city', names)
+        written = update_yearly_files(yearly, os.path.join(args.data_dir, 'yearly_numeric_data.csv'),
+                                      os.path.join(args.data_dir, 'yearly_stan_data.csv'), args.add_columns)
+        print('yearly CSVs: wrote {}'.format(', '.join(written) or 'no columns'))
+
+
+if __name__ == '__main__':
+    main()
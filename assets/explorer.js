@@ -0,0 +1,36 @@
+// Year filtering for Figures 2, 3 and 4, run in the browser.
+//
+// The server sends the selected columns once (the explorer-data store, see
+// explorer_data in final_discovery_app.py); moving the year slider only
+// re-filters those points here. filter_explorer is the Python twin used
+// when DISCOVERY_CLIENTSIDE_FILTERING=0, keep the two in step.
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    explorer: {
+        filter_years: function(data, yearRange) {
+            if (!data || !yearRange) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            var lo = yearRange[0];
+            var hi = yearRange[yearRange.length - 1];
+            // Same half-open [lo, hi) range the server side always used
+            var keep = data.year.map(function(year) { return year >= lo && year < hi; });
+            var pick = function(values) {
+                return values.filter(function(value, i) { return keep[i]; });
+            };
+
+            var figures = data.figures.map(function(fig) {
+                return {
+                    data: fig.data.map(function(trace) {
+                        return Object.assign({}, trace, {x: pick(trace.x), y: pick(trace.y), text: pick(trace.text)});
+                    }),
+                    layout: fig.layout
+                };
+            });
+            var captions = data.captions.map(function(caption) {
+                return caption.replace('{start}', lo).replace('{end}', hi);
+            });
+            return figures.concat(captions);
+        }
+    }
+});
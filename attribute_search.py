@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+'''Search the columns of every data set by name, synonym and value.
+
+The README's consumer wants "race and gender attributes" wherever they
+occur. Finding them used to mean opening every file and cleaning its
+column names (see the regex loop in HW4.ipynb). AttributeIndex is an
+inverted index instead: every column contributes the terms of
+
+    its name       'Incident_Address_Zip' -> incident, address, zip
+    synonyms       zip -> zipcode, postcode, postal; sex -> gender
+    sample values  the most common values of text columns, so 'white'
+                   finds a race column and 'mold' a complaint type
+
+and a query is answered from the terms alone:
+
+- exact terms score highest, then terms the query word is a prefix of
+  (found by bisecting the sorted term list), then fuzzy matches within
+  one or two edits (candidates come from a trigram index and are checked
+  with a bounded edit distance);
+- a term found in a column's name outweighs a synonym, which outweighs
+  a sample value; a column matching several query words adds them up.
+
+Nothing is scanned per query, so lookups stay in the low milliseconds
+with tens of thousands of columns. Data sets are added and replaced one
+at a time and cached_attribute_index only re-reads CSVs that changed.
+
+    index = cached_attribute_index('datasets')
+    index.search('race gender')'''
+
+import argparse
+import bisect
+import glob
+import heapq
+import json
+import os
+import re
+from collections import Counter, defaultdict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import _write_atomic
+from link_discovery import _read_csv_chunks
+
+INDEX_FORMAT = 3
+
+# Field weights: where in a column a term was found
+NAME, SYNONYM, VALUE = 3.0, 2.0, 1.0
+# Match weights: how the query word matched the term
+EXACT, PREFIX, FUZZY = 1.0, 0.6, 0.4
+
+# Groups of words that mean the same thing in the portal exports
+SYNONYMS = [
+    ['race', 'ethnicity', 'ethnic'],
+    ['gender', 'sex'],
+    ['age', 'agegroup'],
+    ['zip', 'zipcode', 'postcode', 'postal'],
+    ['borough', 'boro', 'county'],
+    ['address', 'addr', 'street'],
+    ['bin', 'building'],
+    ['year', 'yr', 'fiscal', 'calendar'],
+    ['date', 'day', 'time', 'received'],
+    ['latitude', 'lat'],
+    ['longitude', 'lon', 'lng', 'long'],
+    ['population', 'pop', 'residents'],
+    ['count', 'number', 'num', 'total'],
+    ['consumption', 'usage', 'use'],
+    ['emissions', 'ghg', 'co2', 'co2e'],
+    ['complaint', '311', 'incident'],
+    ['district', 'cd', 'community'],
+    ['tons', 'tonnage', 'collected'],
+]
+SYNONYM_OF = {word: group for group in SYNONYMS for word in group}
+
+SAMPLE_ROWS = 2000
+SAMPLE_VALUES = 20
+
+Column = namedtuple('Column', ['dataset', 'column', 'name'])
+SearchHit = namedtuple('SearchHit', ['dataset', 'column', 'score', 'matched'])
+
+
+def tokens(text):
+    '''Lower-case words of a column name or value; camelCase is split too.'''
+    text = re.sub(r'([a-z])([A-Z])', r'\1 \2', str(text))
+    return [t for t in re.split(r'[^a-z0-9]+', text.lower()) if t]
+
+
+def normalize_name(name):
+    return '_'.join(tokens(name))
+
+
+def trigrams(term):
+    padded = '  {} '.format(term)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_edits(word):
+    '''Edits a fuzzy match of word may need: none for short words.'''
+    return 0 if len(word) < 4 else 1 if len(word) < 8 else 2
+
+
+def edit_distance(a, b, limit):
+    '''Levenshtein distance of a and b, or limit + 1 if it is larger.'''
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def column_terms(column, values=()):
+    '''{term: field weight} for a column name and its sample values.'''
+    terms = {}
+    for word in tokens(column):
+        terms[word] = NAME
+        for synonym in SYNONYM_OF.get(word, ()):
+            terms.setdefault(synonym, SYNONYM)
+    for value in values:
+        for word in tokens(value):
+            # Numbers and codes in values are noise, names are not
+            if not word.isdigit() and len(word) > 1:
+                terms.setdefault(word, VALUE)
+    return terms
+
+
+def sample_values(series, limit=SAMPLE_VALUES):
+    '''The most common values of a text column; nothing for numeric ones.'''
+    values = series.dropna().astype(str).str.strip()
+    values = values[values.str.contains(r'[A-Za-z]', regex=True)]
+    return list(values.value_counts().index[:limit])
+
+
+class AttributeIndex:
+    def __init__(self, max_expansions=64):
+        self.max_expansions = max_expansions
+        self.columns = {}                 # id -> Column
+        self.column_terms = {}            # id -> {term: field weight}
+        self.datasets = defaultdict(list) # dataset -> column ids
+        self.sources = {}                 # dataset -> (path, size, mtime_ns)
+        self.postings = {}                # term -> {column id: field weight}
+        self.grams = defaultdict(set)     # trigram -> terms
+        self._next_id = 0                 # one past the highest column id in use
+        self._free = []                   # heap of unused ids below _next_id
+        self._sorted_terms = None
+        self._arrays = {}                 # term -> (column ids, field weights), built on first use
+
+    # -- building -------------------------------------------------------
+
+    def add_dataset(self, dataset, columns, source=None):
+        '''Index a data set's columns, replacing what was indexed for it.
+
+        columns maps column names to a few of their values.'''
+        self.remove_dataset(dataset)
+        for column, values in columns.items():
+            self._add_column(dataset, self._new_id(), column, column_terms(column, values))
+        self.sources[dataset] = source
+
+    def _add_column(self, dataset, col_id, column, terms):
+        self.columns[col_id] = Column(dataset, column, normalize_name(column))
+        self.column_terms[col_id] = terms
+        self.datasets[dataset].append(col_id)
+        for term, weight in terms.items():
+            if term not in self.postings:
+                for gram in trigrams(term):
+                    self.grams[gram].add(term)
+                self._sorted_terms = None
+            self.postings.setdefault(term, {})[col_id] = weight
+            self._arrays.pop(term, None)
+
+    def _new_id(self):
+        # Freed ids are reused, lowest first, so the score vectors of a
+        # search stay as long as the columns in use however often data
+        # sets are replaced
+        if self._free:
+            return heapq.heappop(self._free)
+        self._next_id += 1
+        return self._next_id - 1
+
+    def _free_ids(self, ids):
+        free = set(self._free) | set(ids)
+        while self._next_id - 1 in free:
+            self._next_id -= 1
+            free.discard(self._next_id)
+        self._free = sorted(free)   # a sorted list is a valid heap
+
+    def remove_dataset(self, dataset):
+        removed = self.datasets.pop(dataset, [])
+        for col_id in removed:
+            del self.columns[col_id]
+            for term in self.column_terms.pop(col_id):
+                postings = self.postings[term]
+                del postings[col_id]
+                self._arrays.pop(term, None)
+                if not postings:
+                    del self.postings[term]
+                    for gram in trigrams(term):
+                        self.grams[gram].discard(term)
+                    self._sorted_terms = None
+        if removed:
+            self._free_ids(removed)
+        self.sources.pop(dataset, None)
+
+    def add_frame(self, dataset, df, source=None):
+        self.add_dataset(dataset, {column: sample_values(df[column]) for column in df.columns}, source)
+
+    def add_csv(self, path, dataset=None, sample_rows=SAMPLE_ROWS):
+        '''Index a CSV's header and the first sample_rows rows.'''
+        dataset = dataset or os.path.splitext(os.path.basename(path))[0]
+        sample = next(_read_csv_chunks(path, sample_rows))
+        stat = os.stat(path)
+        self.add_frame(dataset, sample, (path, stat.st_size, stat.st_mtime_ns))
+        return dataset
+
+    def add_directory(self, directory, pattern='*.csv'):
+        '''Index the new or changed CSVs of directory and drop the deleted ones.'''
+        changed, present = [], set()
+        for path in sorted(glob.glob(os.path.join(directory, pattern))):
+            dataset = os.path.splitext(os.path.relpath(path, directory))[0]
+            present.add(dataset)
+            stat = os.stat(path)
+            if self.sources.get(dataset) == (path, stat.st_size, stat.st_mtime_ns):
+                continue
+            try:
+                self.add_csv(path, dataset)
+            except (ValueError, StopIteration, pd.errors.ParserError):
+                continue  # empty or not a table
+            changed.append(dataset)
+        for dataset, source in list(self.sources.items()):
+            if (source and os.path.abspath(os.path.dirname(source[0])) == os.path.abspath(directory)
+                    and dataset not in present):
+                self.remove_dataset(dataset)
+                changed.append(dataset)
+        return changed
+
+    # -- searching ------------------------------------------------------
+
+    def _terms(self):
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        return self._sorted_terms
+
+    def expand(self, word):
+        '''{term: match weight} for the terms a query word matches.'''
+        matches = {}
+        if word in self.postings:
+            matches[word] = EXACT
+        if len(word) >= 2:
+            # Shortest completions first: 'pop' -> 'pop', 'population', ...
+            terms = self._terms()
+            start = bisect.bisect_left(terms, word)
+            end = bisect.bisect_left(terms, word + '\uffff', start)
+            for term in sorted(terms[start:end], key=len)[:self.max_expansions]:
+                matches.setdefault(term, PREFIX)
+        limit = max_edits(word)
+        if limit:
+            grams = trigrams(word)
+            shared = Counter(term for gram in grams for term in self.grams.get(gram, ()))
+            # Every edit removes at most three of the word's trigrams
+            needed = len(grams) - 3 * limit
+            for term, count in shared.most_common(4 * self.max_expansions):
+                if count < needed:
+                    break
+                if term not in matches:
+                    distance = edit_distance(word, term, limit)
+                    if distance <= limit:
+                        matches[term] = FUZZY * (1 - distance / float(len(word)))
+        return matches
+
+    def _posting_arrays(self, term):
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            postings = self.postings[term]
+            arrays = (np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                      np.fromiter(postings.values(), dtype=np.float64, count=len(postings)))
+            self._arrays[term] = arrays
+        return arrays
+
+    def search(self, query, top=20, datasets=None):
+        '''Columns best matching the words of query, as SearchHits.
+
+        datasets restricts the hits to those data sets.'''
+        # Dense score vectors over column ids: a handful of numpy operations
+        # per matched term instead of a Python loop over its postings
+        scores = np.zeros(self._next_id)
+        expansions = []
+        for word in dict.fromkeys(tokens(query)):
+            matches = self.expand(word)
+            expansions.append(matches)
+            best = np.zeros(self._next_id)
+            for term, match in matches.items():
+                ids, fields = self._posting_arrays(term)
+                best[ids] = np.maximum(best[ids], match * fields)
+            scores += best
+        if datasets is not None:
+            keep = np.zeros(self._next_id, dtype=bool)
+            for dataset in datasets:
+                keep[self.datasets.get(dataset, [])] = True
+            scores[~keep] = 0
+        found = np.flatnonzero(scores)
+        if top and len(found) > top:
+            found = found[np.argpartition(-scores[found], top - 1)[:top]]
+        ranked = sorted(found, key=lambda col_id: (-scores[col_id], self.columns[col_id]))
+        hits = []
+        for col_id in ranked:
+            terms = self.column_terms[col_id]
+            matched = sorted({term for matches in expansions for term in matches if term in terms})
+            column = self.columns[col_id]
+            hits.append(SearchHit(column.dataset, column.column, float(scores[col_id]), matched))
+        return hits
+
+    # -- persistence ----------------------------------------------------
+
+    def save(self, path):
+        '''Write the indexed columns and their terms as JSON.
+
+        The postings and trigrams are rebuilt from them on load, and
+        nothing is pickled, so loading a file cannot run code.'''
+        state = {'format': INDEX_FORMAT, 'max_expansions': self.max_expansions,
+                 'next_id': self._next_id, 'free': self._free, 'sources': self.sources,
+                 'datasets': {dataset: [[col_id, self.columns[col_id].column, self.column_terms[col_id]]
+                                        for col_id in ids]
+                              for dataset, ids in self.datasets.items()}}
+
+        def write(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+        _write_atomic(path, write)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            state = json.load(f)
+        if state.get('format') != INDEX_FORMAT:
+            raise ValueError('index format {} is not {}'.format(state.get('format'), INDEX_FORMAT))
+        index = cls(state['max_expansions'])
+        for dataset, columns in state['datasets'].items():
+            for col_id, column, terms in columns:
+                index._add_column(dataset, col_id, column, terms)
+        index.sources = {dataset: tuple(source) if source else source
+                         for dataset, source in state['sources'].items()}
+        index._next_id = state['next_id']
+        index._free = state['free']
+        return index
+
+
+def cached_attribute_index(directory, path=None):
+    '''The AttributeIndex of directory, kept in path between runs.'''
+    path = path or os.path.join(directory, 'attribute_index.json')
+    index = None
+    if os.path.exists(path):
+        try:
+            index = AttributeIndex.load(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            index = None  # unreadable or an older format: rebuild it
+    index = index or AttributeIndex()
+    if index.add_directory(directory) or not os.path.exists(path):
+        try:
+            index.save(path)
+        except OSError:
+            pass  # read-only data directory: keep it in memory
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the columns of every CSV in a directory.')
+    parser.add_argument('directory', help='directory of CSV files')
+    parser.add_argument('query', nargs='+', help='words to look for, e.g. race gender')
+    parser.add_argument('--index', help='index file, default <directory>/attribute_index.json')
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    index = cached_attribute_index(args.directory, args.index)
+    for hit in index.search(' '.join(args.query), args.top):
+        print('{:6.2f}  {}:{}  ({})'.format(hit.score, hit.dataset, hit.column, ', '.join(hit.matched)))
+
+
+if __name__ == '__main__':
+    main()
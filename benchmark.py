@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+'''Benchmarks for the app's callbacks and figure builders, without a browser.
+
+Each case calls a callback (the uncached function under the figure
+cache) or a figure builder directly and records, over --repeat calls:
+latency percentiles, the peak memory allocated during a call (from
+tracemalloc, which sees numpy and pandas buffers) and the size of the
+serialized output as Dash would send it. Load times of the data sets the
+cases use are recorded once per run.
+
+Runs go against the real datasets directory and against synthetic copies
+scaled 10x, 100x and 1000x: yearly data with sqrt(scale) times as many
+years and as many columns (so scale times as many values) and scale
+times as many complaint rows. Every scale runs in its own process, so
+the app's import-time state and memory peaks do not leak between them.
+
+    python benchmark.py --data-dir datasets --out bench.json
+    python benchmark.py --data-dir datasets --out new.json --compare bench.json
+
+Results are JSON; --compare prints the change in p50 latency and payload
+size per case and exits non-zero if any case got slower than
+--threshold.'''
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_SCALES = ['real', '10', '100', '1000']
+COMPLAINT_ROWS = 5000
+COPIED_FILES = ['monthly_tonnage.csv', 'pri_municipalenergy_consumption_10to13.csv',
+                'pri_municipalenergy_consumption_10to14.csv']
+
+
+# -- synthetic data -----------------------------------------------------
+
+def scale_yearly(num_df, scale, rng):
+    '''Yearly data with sqrt(scale) times the years and columns of num_df.
+
+    The real columns keep their names (the layout's defaults refer to
+    them); copies get a _<k> suffix. Values follow a random walk per
+    column with the real column's gaps repeated.'''
+    factor = math.sqrt(scale)
+    n_rows = int(round(len(num_df) * factor))
+    data_cols = [col for col in num_df.columns if col != 'year']
+    n_cols = int(round(len(data_cols) * factor))
+    last_year = int(num_df['year'].max())
+    years = np.arange(last_year - n_rows + 1, last_year + 1)
+
+    columns = {'year': years}
+    for i in range(n_cols):
+        source = data_cols[i % len(data_cols)]
+        name = source if i < len(data_cols) else '{}_{}'.format(source, i // len(data_cols))
+        real = num_df[source].values.astype(np.float64)
+        level, spread = np.nanmean(real), np.nanstd(real) or 1.0
+        values = level + np.cumsum(rng.normal(0, spread / 4, n_rows))
+        gaps = np.isnan(np.resize(real[::-1], n_rows)[::-1])
+        values[gaps] = np.nan
+        columns[name] = values
+    return pd.DataFrame(columns)
+
+
+def synthetic_complaints(n_rows, first_year, last_year, rng):
+    from complaints import borolist, complaint_types
+    seconds = rng.randint(0, 365 * 24 * 3600, n_rows)
+    dates = (pd.to_datetime(rng.randint(first_year, last_year + 1, n_rows).astype(str), format='%Y')
+             + pd.to_timedelta(seconds, unit='s'))
+    return pd.DataFrame({
+        'Complaint_Number': np.arange(n_rows),
+        'Incident_Address_Borough': np.asarray(borolist)[rng.randint(0, len(borolist), n_rows)],
+        'Complaint_Type_311': np.asarray(complaint_types)[rng.randint(0, len(complaint_types), n_rows)],
+        'Date_Received': dates.strftime('%m/%d/%Y %I:%M:%S %p'),
+    })
+
+
+def make_synthetic(data_dir, out_dir, scale, seed=0):
+    '''Write a scaled copy of data_dir to out_dir, unless it is already there.'''
+    marker = os.path.join(out_dir, 'synthetic.json')
+    if os.path.exists(marker):
+        return out_dir
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+
+    num_df = pd.read_csv(os.path.join(data_dir, 'yearly_numeric_data.csv'), index_col=0)
+    big = scale_yearly(num_df, scale, rng)
+    big.to_csv(os.path.join(out_dir, 'yearly_numeric_data.csv'))
+    data = big.drop(columns='year')
+    stan = (data - data.min()) / (data.max() - data.min())
+    stan.insert(0, 'year', big['year'])
+    stan.to_csv(os.path.join(out_dir, 'yearly_stan_data.csv'))
+
+    synthetic_complaints(COMPLAINT_ROWS * scale, 2010, 2019, rng).to_csv(
+        os.path.join(out_dir, 'pri_env_complaints_by_borough.csv'), index=False)
+    for name in COPIED_FILES:
+        if os.path.exists(os.path.join(data_dir, name)):
+            shutil.copy(os.path.join(data_dir, name), out_dir)
+    with open(marker, 'w') as f:
+        json.dump({'scale': scale, 'seed': seed, 'rows': len(big), 'columns': len(data.columns),
+                   'complaints': COMPLAINT_ROWS * scale}, f)
+    return out_dir
+
+
+# -- measuring ----------------------------------------------------------
+
+def payload_size(value):
+    from figure_cache import dumps
+    return len(dumps(value).encode('utf-8'))
+
+
+def measure(func, args, repeat):
+    '''Latency percentiles (ms), peak traced memory and payload size of func(*args).'''
+    func(*args)  # warm up imports and lazily built state
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append((time.perf_counter() - start) * 1000)
+    times = np.array(times)
+    # Traced separately: tracemalloc slows allocation heavy code down a lot
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'n': repeat, 'mean_ms': float(times.mean()), 'p50_ms': float(np.percentile(times, 50)),
+            'p90_ms': float(np.percentile(times, 90)), 'p99_ms': float(np.percentile(times, 99)),
+            'max_ms': float(times.max()), 'peak_bytes': int(peak), 'payload_bytes': payload_size(result)}
+
+
+def cases(app):
+    '''(name, function, args) for every benchmarked callback and builder.'''
+    num_df = app.datasets['num']
+    columns = [col for col in num_df.columns if col != 'year']
+    counts = num_df[columns].notnull().sum()
+    # The two best-covered columns, so the explorer has the most points to draw
+    x, y = list(counts.sort_values(ascending=False, kind='stable').index[:2])
+    years = num_df['year']
+    year_range = [int(years.min()), int(years.max()) + 1]
+    correlations = app.datasets['correlations']
+
+    selected = [
+        ('update_options', app.update_options, (columns[:5],)),
+        ('update_year_bounds', app.update_year_bounds.uncached, (x, y)),
+        ('update_correlation[pair]', app.update_correlation.uncached, (x, y, 'pair')),
+        ('update_correlation[full]', app.update_correlation.uncached, (x, y, 'full')),
+        ('update_correlation[cached]', app.update_correlation, (x, y, 'full')),
+        ('update_explorer_data', app.update_explorer_data.uncached, (x, y)),
+        ('update_explorer_figures', app.update_explorer_figures.uncached, (x, y, year_range)),
+        ('make_heatmap[full]', app.make_heatmap,
+         ('heatmap-1', correlations.frame().values, correlations.columns, correlations.columns,
+          'Heatmap Correlation')),
+    ]
+    if 'complaint_cube' not in app.datasets.loaded():
+        return selected  # the complaints file is not in every checkout
+    cube = app.datasets['complaint_cube']
+    year = cube.years[-1] if cube.years else 2019
+    selected += [
+        ('functionName', app.functionName, (year,)),
+        ('make_stacked_bars', app.make_stacked_bars, (year, app.complaint_types, cube.year_counts(year))),
+    ]
+    return selected
+
+
+def run_one(repeat):
+    '''Benchmark the app found through DISCOVERY_DATA_PATH; returns the results dict.'''
+    import final_discovery_app as app
+
+    loads = {}
+    for name in ['yearly', 'num', 'stan', 'correlations', 'complaint_cube']:
+        start = time.perf_counter()
+        try:
+            app.datasets.warm([name])
+        except Exception as exc:  # e.g. the complaints file is not in every checkout
+            loads[name] = '{}: {}'.format(type(exc).__name__, exc)
+            continue
+        loads[name] = (time.perf_counter() - start) * 1000
+
+    results = {}
+    for name, func, args in cases(app):
+        try:
+            results[name] = measure(func, args, repeat)
+        except Exception as exc:  # a missing data file should not sink the whole run
+            results[name] = {'error': '{}: {}'.format(type(exc).__name__, exc)}
+    num_df = app.datasets['num']
+    result = {'load_ms': loads, 'cases': results,
+              'data': {'years': len(num_df), 'columns': len(num_df.columns) - 1},
+              'memory': app.datasets.memory_report()}
+    if sys.platform != 'win32':
+        import resource
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['max_rss_bytes'] = rss if sys.platform == 'darwin' else rss * 1024
+    return result
+
+
+def run_scale(scale, data_dir, work_dir, repeat):
+    if scale == 'real':
+        path = data_dir
+    else:
+        path = make_synthetic(data_dir, os.path.join(work_dir, 'x{}'.format(scale)), int(scale))
+    env = dict(os.environ, DISCOVERY_DATA_PATH=os.path.join(os.path.abspath(path), ''))
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', '--repeat', str(repeat)],
+                          env=env, cwd=here, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    if proc.returncode != 0:
+        return {'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'failed'}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def compare(new, old, threshold, min_delta_ms=0.5):
+    '''Print p50 and payload changes per case; returns the cases slower than threshold.
+
+    Slowdowns of less than min_delta_ms are timer noise, not regressions.'''
+    slower = []
+    for scale, run in sorted(new['scales'].items()):
+        base = old.get('scales', {}).get(scale, {}).get('cases', {})
+        for name, stats in sorted(run.get('cases', {}).items()):
+            before = base.get(name)
+            if 'p50_ms' not in stats or not before or 'p50_ms' not in before:
+                continue
+            ratio = stats['p50_ms'] / before['p50_ms'] if before['p50_ms'] else float('inf')
+            print('{:>5} {:<28} p50 {:9.2f} ms ({:+6.0%})  payload {:>10} B ({:+6.0%})'.format(
+                scale, name, stats['p50_ms'], ratio - 1, stats['payload_bytes'],
+                stats['payload_bytes'] / float(before['payload_bytes'] or 1) - 1))
+            if ratio > 1 + threshold and stats['p50_ms'] - before['p50_ms'] > min_delta_ms:
+                slower.append((scale, name, ratio))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Data Discovery App callbacks.')
+    parser.add_argument('--data-dir', default='datasets', help='the real datasets directory')
+    parser.add_argument('--work-dir', default='benchmark_data', help='where synthetic data sets are written')
+    parser.add_argument('--scales', default=','.join(DEFAULT_SCALES),
+                        help="comma separated: 'real' and/or scale factors")
+    parser.add_argument('--repeat', type=int, default=30, help='timed calls per case')
+    parser.add_argument('--out', help='write results to this JSON file')
+    parser.add_argument('--compare', help='earlier results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='p50 slowdown (0.25 = 25%%) that counts as a regression')
+    parser.add_argument('--min-delta-ms', type=float, default=0.5,
+                        help='ignore p50 slowdowns smaller than this many milliseconds')
+    parser.add_argument('--run-one', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(args.repeat)))
+        return
+
+    results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+               'pandas': pd.__version__, 'numpy': np.__version__, 'repeat': args.repeat, 'scales': {}}
+    for scale in args.scales.split(','):
+        print('running scale {}'.format(scale), file=sys.stderr)
+        results['scales'][scale] = run_scale(scale, args.data_dir, args.work_dir, args.repeat)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f), args.threshold, args.min_delta_ms)
+        for scale, name, ratio in slower:
+            print('REGRESSION {} {}: p50 x{:.2f}'.format(scale, name, ratio))
+        if slower:
+            sys.exit(1)
+    elif not args.out:
+        print(json.dumps(results, indent=1, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
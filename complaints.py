@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+'''Complaint counts for the environmental complaints figure (Figure 6).
+
+Figure 6 only needs the number of complaints per year, borough and
+complaint type. Instead of rescanning every complaint row whenever the
+year selector changes, the counts are computed once into a dense
+year x borough x complaint type cube and each request just slices it.
+
+For exports too large to load, stream_complaint_cube builds the same cube
+from the raw DOHMH complaints CSV in fixed-size chunks.'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+borolist = ['Brooklyn', 'Manhattan', 'Queens', 'Bronx', 'Staten Island']
+complaint_types = ['Asbestos', 'Indoor Air Quality', 'Mold', 'Asbestos/Garbage Nuisance',
+                   'Indoor Sewage', 'Cooling Tower', 'Lead']
+
+
+class ComplaintCube:
+    '''Dense count cube indexed by [year - first_year, borough, complaint type].
+
+    Boroughs and complaint types follow the order of borolist and
+    complaint_types, which is also the order Figure 6 draws them in.'''
+
+    def __init__(self, first_year, counts, boroughs=borolist, types=complaint_types):
+        self.first_year = int(first_year)
+        self.counts = counts
+        self.boroughs = list(boroughs)
+        self.types = list(types)
+
+    @property
+    def years(self):
+        return list(range(self.first_year, self.first_year + self.counts.shape[0]))
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes
+
+    @classmethod
+    def empty(cls, first_year, last_year, boroughs=borolist, types=complaint_types):
+        counts = np.zeros((last_year - first_year + 1, len(boroughs), len(types)), dtype=np.int64)
+        return cls(first_year, counts, boroughs, types)
+
+    @classmethod
+    def from_codes(cls, year, boro_codes, type_codes, boroughs=borolist, types=complaint_types):
+        '''Count rows given as parallel arrays of years and category codes.
+
+        Rows with a missing year (NaN) or an unknown borough or type
+        (code -1) are not counted.'''
+        year = np.asarray(year, dtype=np.float64)
+        valid = ~np.isnan(year) & (boro_codes >= 0) & (type_codes >= 0)
+        if not valid.any():
+            return cls.empty(0, -1, boroughs, types)
+
+        year = year[valid].astype(np.int64)
+        first_year = int(year.min())
+        n_years = int(year.max()) - first_year + 1
+        n_boros, n_types = len(boroughs), len(types)
+        flat = ((year - first_year) * n_boros + boro_codes[valid]) * n_types + type_codes[valid]
+        counts = np.bincount(flat, minlength=n_years * n_boros * n_types)
+        return cls(first_year, counts.reshape(n_years, n_boros, n_types), boroughs, types)
+
+    @classmethod
+    def from_frame(cls, df, date_col='Date_Received', boro_col='Incident_Address_Borough',
+                   type_col='Complaint_Type_311', boroughs=borolist, types=complaint_types,
+                   ignore_case=False):
+        '''Count every row of df into a new cube in a single vectorized pass.
+
+        With ignore_case, 'MOLD' counts as 'Mold' and 'BROOKLYN' as
+        'Brooklyn', as needed for the raw DOHMH export.'''
+        year = df[date_col].dt.year.values
+        boro_codes = _codes(df[boro_col], boroughs, ignore_case)
+        type_codes = _codes(df[type_col], types, ignore_case)
+        return cls.from_codes(year, boro_codes, type_codes, boroughs, types)
+
+    def merge(self, other):
+        '''New cube holding the counts of both cubes.'''
+        if (self.boroughs, self.types) != (other.boroughs, other.types):
+            raise ValueError('cannot merge complaint cubes with different boroughs or types')
+        if other.counts.shape[0] == 0:
+            return self
+        if self.counts.shape[0] == 0:
+            return other
+        first_year = min(self.first_year, other.first_year)
+        last_year = max(self.years[-1], other.years[-1])
+        merged = ComplaintCube.empty(first_year, last_year, self.boroughs, self.types)
+        for cube in (self, other):
+            start = cube.first_year - first_year
+            merged.counts[start:start + cube.counts.shape[0]] += cube.counts
+        return merged
+
+    def save(self, path, **meta):
+        np.savez(path, first_year=self.first_year, counts=self.counts,
+                 boroughs=np.array(self.boroughs), types=np.array(self.types),
+                 meta=np.array(repr(sorted(meta.items()))))
+
+    @classmethod
+    def load(cls, path, **meta):
+        '''Load a saved cube, or return None if it was saved with other meta.'''
+        try:
+            with np.load(path) as data:
+                if str(data['meta']) != repr(sorted(meta.items())):
+                    return None
+                return cls(int(data['first_year']), data['counts'],
+                           data['boroughs'].tolist(), data['types'].tolist())
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def year_counts(self, year):
+        '''Counts for one year as a [type][borough] nested list of ints.
+
+        Years outside the loaded range have no complaints, so they come
+        back as all zeros.'''
+        idx = int(year) - self.first_year
+        if 0 <= idx < self.counts.shape[0]:
+            return self.counts[idx].T.tolist()
+        return [[0] * len(self.boroughs) for _ in self.types]
+
+
+def _codes(values, categories, ignore_case=False):
+    if ignore_case:
+        values = values.astype(str).str.strip().str.lower()
+        categories = [c.lower() for c in categories]
+    return pd.Categorical(values, categories=categories).codes
+
+
+def stream_complaint_cube(path, chunksize=500000, date_col='Date_Received',
+                          boro_col='Incident_Address_Borough', type_col='Complaint_Type_311'):
+    '''Count a raw complaints CSV chunk by chunk.
+
+    Only the three columns the cube needs are read, and each chunk is
+    folded into the running counts and then dropped, so memory stays
+    bounded by chunksize no matter how large the file is. The year is
+    taken straight from the date text (the first four digit group, which
+    covers both "12/01/2016 10:00:00 AM" and "2016-12-01") instead of
+    parsing full datetimes.'''
+    cube = None
+    reader = pd.read_csv(path, usecols=[date_col, boro_col, type_col], dtype=str,
+                         chunksize=chunksize)
+    for chunk in reader:
+        year = pd.to_numeric(chunk[date_col].str.extract(r'(\d{4})', expand=False), errors='coerce')
+        part = ComplaintCube.from_codes(year.values,
+                                        _codes(chunk[boro_col], borolist, ignore_case=True),
+                                        _codes(chunk[type_col], complaint_types, ignore_case=True))
+        cube = part if cube is None else cube.merge(part)
+    if cube is None:
+        cube = ComplaintCube.empty(0, -1)
+    return cube
+
+
+def cached_complaint_cube(path, chunksize=500000):
+    '''stream_complaint_cube with the result cached next to the CSV.
+
+    The cache (<csv>.cube.npz) is reused while the CSV keeps the same
+    size and mtime, so a worker start does not rescan a multi-gigabyte
+    export.'''
+    stat = os.stat(path)
+    cache_path = path + '.cube.npz'
+    cube = ComplaintCube.load(cache_path, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    if cube is None:
+        cube = stream_complaint_cube(path, chunksize)
+        tmp_path = '{}.{}.tmp.npz'.format(path, os.getpid())
+        try:
+            cube.save(tmp_path, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    return cube
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+'''All-pairs Pearson correlation computed once, looked up per request.
+
+CorrelationMatrix.from_frame computes the correlation of every pair of
+numeric columns with pairwise-complete observations, the same thing
+DataFrame.corr() does, but in a handful of NumPy matrix products instead
+of a loop over column pairs. For each pair it also keeps n, the number
+of rows where both columns have a value, so callers can tell a
+correlation over 40 years from one over 3.'''
+
+import numpy as np
+import pandas as pd
+
+
+class CorrelationMatrix:
+    def __init__(self, columns, corr, counts):
+        self.columns = list(columns)
+        self.corr = corr
+        self.counts = counts
+        self._pos = {col: i for i, col in enumerate(self.columns)}
+
+    @property
+    def nbytes(self):
+        return self.corr.nbytes + self.counts.nbytes
+
+    @classmethod
+    def from_frame(cls, df, columns=None, exclude=()):
+        '''Correlate the numeric columns of df (or the given columns).'''
+        if columns is None:
+            columns = [col for col in df.select_dtypes(include='number').columns if col not in exclude]
+        values = df[columns].to_numpy(dtype=np.float64, na_value=np.nan)
+        corr, counts = pairwise_complete_corr(values)
+        return cls(columns, corr, counts)
+
+    def __contains__(self, col):
+        return col in self._pos
+
+    def count(self, x, y):
+        '''Number of rows where both x and y have a value.'''
+        return int(self.counts[self._pos[x], self._pos[y]])
+
+    def value(self, x, y):
+        return float(self.corr[self._pos[x], self._pos[y]])
+
+    def frame(self, columns=None):
+        '''Correlation matrix for the given columns (all of them by default).'''
+        if columns is None:
+            return pd.DataFrame(self.corr, index=self.columns, columns=self.columns)
+        idx = [self._pos[col] for col in columns]
+        return pd.DataFrame(self.corr[np.ix_(idx, idx)], index=columns, columns=columns)
+
+
+def pairwise_complete_corr(values):
+    '''Pearson correlation and overlap count for every pair of columns.
+
+    values is a 2-D float array with NaN for missing entries. For columns
+    i and j only the rows where both are present are used, matching
+    DataFrame.corr(). Pairs with fewer than two shared rows or no variance
+    over their shared rows come back as NaN.'''
+    mask = ~np.isnan(values)
+    valid = mask.astype(np.float64)
+
+    # Standardize each column over all of its values first. Correlation is
+    # unaffected, but the sums below then stay small and well conditioned.
+    col_counts = np.maximum(valid.sum(axis=0), 1)
+    mean = np.where(mask, values, 0.0).sum(axis=0) / col_counts
+    std = np.sqrt(np.where(mask, (values - mean) ** 2, 0.0).sum(axis=0) / col_counts)
+    std[std == 0] = 1.0
+    z = np.where(mask, (values - mean) / std, 0.0)
+
+    counts = valid.T @ valid             # n_ij: rows with both i and j
+    sums = z.T @ valid                   # sum of z_i over those rows
+    squares = (z * z).T @ valid          # sum of z_i^2 over those rows
+    products = z.T @ z                   # sum of z_i * z_j over those rows
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = products - sums * sums.T / counts
+        var_i = squares - sums * sums / counts
+        var_j = var_i.T
+        corr = cov / np.sqrt(var_i * var_j)
+
+    # Variances that are only rounding noise mean a constant column.
+    tiny = 1e-12 * np.maximum(counts, 1)
+    corr[(counts < 2) | (var_i <= tiny) | (var_j <= tiny)] = np.nan
+    np.clip(corr, -1.0, 1.0, out=corr)
+    diag = np.diag_indices_from(corr)
+    corr[diag] = np.where(np.isnan(corr[diag]), np.nan, 1.0)
+    return corr, counts.astype(np.int64)
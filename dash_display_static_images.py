@@ -1,23 +1,32 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+from dash.exceptions import PreventUpdate
 
 import flask
-import glob
-import os
+
+from image_catalog import ImageCatalog
+from image_store import ImageStore
 
 image_directory = 'C:\\IS698\\othre\\'
-list_of_images = [os.path.basename(x) for x in glob.glob('{}*.png'.format(image_directory))]
+# Re-scanned in the background, so new charts show up without a restart
+image_catalog = ImageCatalog(image_directory)
+# The page only asks whether that changed when it loads and every few
+# minutes after, not every few seconds per open tab
+image_poll_interval = 5 * 60 * 1000
 static_image_route = '/static/'
+images = ImageStore(image_directory, catalog=image_catalog)
 
 app = dash.Dash()
 
 app.layout = html.Div([
     dcc.Dropdown(
         id='image-dropdown',
-        options=[{'label': i, 'value': i} for i in list_of_images],
-        value=list_of_images[0]
+        options=image_catalog.options(),
+        value=(image_catalog.names() or [None])[0]
     ),
+    dcc.Interval(id='image-catalog-poll', interval=image_poll_interval),
+    dcc.Store(id='image-catalog-version', data=image_catalog.version),
     html.Img(id='image')
 ])
 
@@ -25,17 +34,32 @@ app.layout = html.Div([
     dash.dependencies.Output('image', 'src'),
     [dash.dependencies.Input('image-dropdown', 'value')])
 def update_image_src(value):
+    if value is None:
+        raise PreventUpdate  # no images in the directory yet
     return static_image_route + value
 
+@app.callback(
+    [dash.dependencies.Output('image-dropdown', 'options'),
+     dash.dependencies.Output('image-catalog-version', 'data')],
+    [dash.dependencies.Input('image-catalog-poll', 'n_intervals')],
+    [dash.dependencies.State('image-catalog-version', 'data')])
+def refresh_image_options(n_intervals, known_version):
+    # Also runs on page load, so a reload always lists the current images.
+    # Only send the options when the directory actually changed
+    if known_version == image_catalog.version:
+        raise PreventUpdate
+    return image_catalog.options(), image_catalog.version
+
 # Add a static image route that serves images from desktop
 # Be *very* careful here - you don't want to serve arbitrary files
 # from your computer or server
 @app.server.route('{}<image_path>.png'.format(static_image_route))
 def serve_image(image_path):
     image_name = '{}.png'.format(image_path)
-    if image_name not in list_of_images:
+    if image_name not in image_catalog:
         raise Exception('"{}" is excluded from the allowed static files'.format(image_path))
-    return flask.send_from_directory(image_directory, image_name)
+    # Resized WebP/PNG variant with ETag and cache headers, see image_store.py
+    return images.send(image_name, flask.request)
 
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
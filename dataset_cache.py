@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+'''Columnar on-disk cache for the CSV data sets.
+
+Parsing the CSV files (and especially their date columns) on every start
+is slow once the files get large. read_csv_cached parses a CSV once and
+stores the typed DataFrame as an uncompressed Arrow IPC (Feather v2) file
+next to the CSV, e.g. yearly_numeric_data.csv.feather. Later loads memory
+map that file instead of parsing the CSV again.
+
+A small JSON sidecar (<csv>.feather.json) records the source file's size,
+mtime and SHA-1 along with the read options. The cache entry is reused
+while the size and mtime are unchanged. If only the mtime changed, the
+content hash decides, so touching or re-copying a file does not force a
+rebuild. Any change to the content or to the read options rebuilds the
+entry.
+
+pyarrow is optional: without it every call simply parses the CSV.'''
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # pragma: no cover - depends on the environment
+    pa = None
+    feather = None
+
+CACHE_SUFFIX = '.feather'
+META_SUFFIX = '.feather.json'
+CACHE_FORMAT = 1
+
+
+def file_hash(path, block_size=1 << 20):
+    '''SHA-1 of a file's contents, read in blocks.'''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cache_paths(csv_path):
+    return csv_path + CACHE_SUFFIX, csv_path + META_SUFFIX
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _dump_json(obj, path):
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+
+
+def _write_atomic(path, write):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _options_key(version, parse_dates, date_format, read_csv_kwargs):
+    return json.dumps({'format': CACHE_FORMAT, 'version': str(version),
+                       'parse_dates': list(parse_dates or []), 'date_format': date_format,
+                       'read_csv': {k: repr(v) for k, v in sorted(read_csv_kwargs.items())}},
+                      sort_keys=True)
+
+
+def _parse_csv(csv_path, parse_dates, date_format, transform, read_csv_kwargs):
+    df = pd.read_csv(csv_path, **read_csv_kwargs)
+    for col in parse_dates or []:
+        df[col] = pd.to_datetime(df[col], format=date_format)
+    if transform is not None:
+        df = transform(df)
+    return df
+
+
+def source_version(csv_path):
+    '''Content hash of the CSV as recorded by the cache, or hashed now.
+
+    Use it to key anything derived from the data set (figures, sketches)
+    so that it goes stale together with the cache entry.'''
+    meta = _read_meta(cache_paths(csv_path)[1])
+    stat = os.stat(csv_path)
+    if meta and meta.get('size') == stat.st_size and meta.get('mtime_ns') == stat.st_mtime_ns:
+        return meta['sha1']
+    return file_hash(csv_path)
+
+
+def read_csv_cached(csv_path, parse_dates=None, transform=None, version=1, date_format=None,
+                    **read_csv_kwargs):
+    '''pd.read_csv with a persistent columnar cache next to csv_path.
+
+    parse_dates lists columns to run through pd.to_datetime, with
+    date_format if given (much faster than letting pandas guess, which
+    falls back to parsing row by row when it cannot), and transform
+    is an optional function applied to the parsed frame before caching.
+    Bump version whenever transform changes what it produces; the other
+    options are part of the cache key automatically.'''
+    if feather is None:
+        return _parse_csv(csv_path, parse_dates, date_format, transform, read_csv_kwargs)
+
+    cache_path, meta_path = cache_paths(csv_path)
+    options = _options_key(version, parse_dates, date_format, read_csv_kwargs)
+    stat = os.stat(csv_path)
+    meta = _read_meta(meta_path)
+
+    if meta is not None and meta.get('options') == options and os.path.exists(cache_path):
+        fresh = meta.get('size') == stat.st_size and meta.get('mtime_ns') == stat.st_mtime_ns
+        if not fresh and meta.get('size') == stat.st_size and meta.get('sha1') == file_hash(csv_path):
+            # Same bytes with a new mtime: keep the entry, just remember the new mtime.
+            meta['mtime_ns'] = stat.st_mtime_ns
+            try:
+                _write_atomic(meta_path, lambda p: _dump_json(meta, p))
+            except OSError:
+                pass
+            fresh = True
+        if fresh:
+            try:
+                return feather.read_table(cache_path, memory_map=True).to_pandas()
+            except (OSError, pa.ArrowException):
+                pass  # unreadable entry, rebuild it below
+
+    sha1 = file_hash(csv_path)
+    df = _parse_csv(csv_path, parse_dates, date_format, transform, read_csv_kwargs)
+    meta = {'source': os.path.basename(csv_path), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns, 'sha1': sha1, 'options': options}
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        _write_atomic(cache_path, lambda p: feather.write_feather(table, p, compression='uncompressed'))
+        _write_atomic(meta_path, lambda p: _dump_json(meta, p))
+    except (OSError, pa.ArrowException):
+        # Read-only data directory or a column Arrow cannot type:
+        # serve the parsed frame and try again next start.
+        pass
+    return df
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+'''Lazy registry of the data sets used by the app.
+
+Each data set is registered under a name together with a loader function
+and the type the loader is expected to return. Nothing is read until the
+first time a data set is requested, so a worker only pays (in start up
+time and memory) for the data sets its pages actually use. warm() loads
+a set of handles in advance, e.g. before forking server workers, and
+memory_report() shows what each loaded data set costs.
+
+    datasets = DatasetRegistry()
+
+    @datasets.register('num', kind=pd.DataFrame)
+    def load_num():
+        return pd.read_csv(num_file)
+
+    num_df = datasets['num']'''
+
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+def memory_footprint(value):
+    '''Approximate number of bytes held by a loaded data set.'''
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum()) if isinstance(value, pd.DataFrame) else int(usage)
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if hasattr(value, 'memory_usage'):
+        return int(value.memory_usage())
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(memory_footprint(k) + memory_footprint(v)
+                                          for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(memory_footprint(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class DatasetHandle:
+    '''A named data set that is loaded on first access.'''
+
+    def __init__(self, name, loader, kind=None, description='', version=None):
+        self.name = name
+        self.loader = loader
+        self.kind = kind
+        self.description = description
+        self.version_func = version
+        self._value = None
+        self._version = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    value = self.loader()
+                    if self.kind is not None and not isinstance(value, self.kind):
+                        raise TypeError('data set "{}" should be a {}, its loader returned a {}'.format(
+                            self.name, self.kind.__name__, type(value).__name__))
+                    self._version = self.version_func() if self.version_func else None
+                    self._value = value
+                    self._loaded = True
+        return self._value
+
+    @property
+    def version(self):
+        '''Version of the loaded data (e.g. its source file hash), loading it if needed.
+
+        Computed once per load, so it is cheap enough to use in cache keys.'''
+        self.get()
+        return self._version
+
+    def unload(self):
+        '''Drop the loaded value; the next get() loads it again.'''
+        with self._lock:
+            self._value = None
+            self._version = None
+            self._loaded = False
+
+    def memory_usage(self):
+        '''Bytes held by the loaded value, 0 if it has not been loaded.'''
+        if not self._loaded:
+            return 0
+        return memory_footprint(self._value)
+
+    def __repr__(self):
+        return '<DatasetHandle {!r} ({})>'.format(self.name, 'loaded' if self._loaded else 'not loaded')
+
+
+class DatasetRegistry:
+    '''Collection of DatasetHandles, looked up by name.'''
+
+    def __init__(self):
+        self._handles = {}
+
+    def register(self, name, loader=None, kind=None, description='', version=None):
+        '''Register loader under name. Without loader, works as a decorator.
+
+        version is an optional function returning a version string for the
+        data, evaluated whenever the data set is loaded.'''
+        if loader is None:
+            def decorator(func):
+                self.register(name, func, kind=kind, description=description, version=version)
+                return func
+            return decorator
+        if name in self._handles:
+            raise ValueError('data set "{}" is already registered'.format(name))
+        handle = DatasetHandle(name, loader, kind=kind, description=description, version=version)
+        self._handles[name] = handle
+        return handle
+
+    def handle(self, name):
+        try:
+            return self._handles[name]
+        except KeyError:
+            raise KeyError('no data set registered as "{}"'.format(name))
+
+    def get(self, name):
+        return self.handle(name).get()
+
+    __getitem__ = get
+
+    def __contains__(self, name):
+        return name in self._handles
+
+    def names(self):
+        return list(self._handles)
+
+    def warm(self, names=None):
+        '''Load the named data sets (all of them by default) right now.'''
+        for name in (self.names() if names is None else names):
+            self.get(name)
+
+    def reload(self, names=None):
+        '''Unload and load again the named data sets (by default, the loaded ones).'''
+        if names is None:
+            names = self.loaded()
+        for name in names:
+            self.handle(name).unload()
+        self.warm(names)
+        return names
+
+    def loaded(self):
+        '''Names of the data sets that are currently loaded.'''
+        return [name for name, handle in self._handles.items() if handle.loaded]
+
+    def memory_report(self):
+        '''{name: bytes} for every registered data set; 0 means not loaded.'''
+        return {name: handle.memory_usage() for name, handle in self._handles.items()}
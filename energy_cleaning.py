@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+'''Cleaning stage for the municipal building energy benchmarking files.
+
+The benchmarking exports (pri_municipalenergy_consumption_10to13.csv and
+_10to14.csv) have one row per building and one column per year and
+metric, e.g. "2010 Rating *" or "2014 Source EUI (kBtu/ft²)*". Boroughs
+are sometimes codes ('1'..'5' or '1.0'..'5.0') and the numbers are often
+text like ' 57 ' or 'Not Available'.
+
+clean_benchmarking fixes all of that with whole-column operations and
+to_long reshapes the result into one row per building, year and metric,
+which is easy to slice by agency, borough and year:
+
+    long_df = load_benchmarking([file_10to13, file_10to14])
+    long_df[(long_df['agency'] == 'DOE') & (long_df['metric'] == 'source_eui')]'''
+
+import re
+
+import numpy as np
+import pandas as pd
+
+BOROUGH_CODES = {'1': 'Manhattan', '2': 'Bronx', '3': 'Brooklyn', '4': 'Queens', '5': 'Staten Island'}
+
+# Spellings of the same metric across the yearly exports
+METRICS = [
+    (re.compile(r'^(rating|score)\b', re.I), 'rating'),
+    (re.compile(r'^source\s*eui\b', re.I), 'source_eui'),
+    (re.compile(r'^ghg\s*emissions\s*intensity\b', re.I), 'ghg_intensity'),
+]
+YEAR_COLUMN = re.compile(r'^\s*(\d{4})\s*(.*?)\s*$')
+MISSING = ['', 'Not Available', 'N/A', 'NA', 'n/a']
+
+ID_COLUMNS = ['borough', 'block', 'lot', 'bin', 'building', 'agency']
+
+
+def map_boroughs(series):
+    '''Borough codes ('1'..'5', '1.0'..'5.0') to names; names are kept.'''
+    names = series.astype(str).str.strip()
+    codes = names.str.replace(r'\.0+$', '', regex=True)
+    return codes.map(BOROUGH_CODES).fillna(names).where(series.notnull())
+
+
+def to_number(series):
+    '''Whitespace padded numbers and "Not Available" style markers to float.'''
+    if pd.api.types.is_numeric_dtype(series):
+        return series.astype(np.float64)
+    text = series.astype(str).str.strip().str.replace(',', '', regex=False)
+    text = text.mask(text.isin(MISSING))
+    return pd.to_numeric(text, errors='coerce').astype(np.float64)
+
+
+def parse_year_column(column):
+    '''(year, metric) for a year-prefixed metric column, None otherwise.'''
+    match = YEAR_COLUMN.match(column)
+    if match is None:
+        return None
+    year, label = match.groups()
+    for pattern, metric in METRICS:
+        if pattern.match(label):
+            return int(year), metric
+    return None
+
+
+def clean_benchmarking(df):
+    '''Typed copy of a benchmarking export, still one row per building.
+
+    Identifier columns are renamed to ID_COLUMNS and every year-prefixed
+    metric column becomes a float column named like "2010 rating".'''
+    df = df.rename(columns=lambda col: col.strip())
+    out = pd.DataFrame(index=df.index)
+    out['borough'] = map_boroughs(df['Borough'])
+    for col in ['Block', 'Lot', 'BIN']:
+        out[col.lower()] = to_number(df[col])
+    out['building'] = df['Building'].astype(str).str.strip()
+    out['agency'] = df['Agency'].astype(str).str.strip()
+
+    for col in df.columns:
+        parsed = parse_year_column(col)
+        if parsed is not None:
+            out['{} {}'.format(*parsed)] = to_number(df[col])
+    return out
+
+
+def to_long(clean_df):
+    '''Reshape clean_benchmarking output to building x year x metric rows.'''
+    value_cols = [col for col in clean_df.columns if col not in ID_COLUMNS]
+    long_df = clean_df.melt(id_vars=ID_COLUMNS, value_vars=value_cols,
+                            var_name='year_metric', value_name='value')
+    long_df = long_df[long_df['value'].notnull()]
+    parts = long_df['year_metric'].str.split(' ', n=1, expand=True)
+    long_df = long_df.assign(year=parts[0].astype(np.int16), metric=parts[1]).drop(columns='year_metric')
+    for col in ['borough', 'agency', 'metric']:
+        long_df[col] = long_df[col].astype('category')
+    return long_df[ID_COLUMNS + ['year', 'metric', 'value']].reset_index(drop=True)
+
+
+def load_benchmarking(paths):
+    '''Long table of every benchmarking file in paths.
+
+    When the same building (borough, block, lot and BIN), year and metric
+    appear in more than one file (2010 is in both exports) the first file
+    wins.'''
+    frames = [to_long(clean_benchmarking(pd.read_csv(path, dtype=str))) for path in paths]
+    long_df = pd.concat(frames, ignore_index=True)
+    long_df = long_df.drop_duplicates(subset=['borough', 'block', 'lot', 'bin', 'year', 'metric'], keep='first')
+    for col in ['borough', 'agency', 'metric']:
+        long_df[col] = long_df[col].astype('category')
+    return long_df.sort_values(['agency', 'borough', 'year'], kind='stable').reset_index(drop=True)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+'''Bounded LRU cache for serialized callback outputs.
+
+Most explorer requests are repeats (scrubbing the year slider back and
+forth over the same column pair), so the finished outputs are kept and
+handed back without touching pandas or plotly again. A hit returns the
+stored object itself, so callers must not modify what a cached function
+returns.
+
+Without a path, the cache is a plain in-process OrderedDict of the
+outputs as the function returned them; nothing is serialized. With one,
+entries live as JSON in a small SQLite file so every worker process on
+the host shares one cache, and each process keeps the last few decoded
+entries in memory so a repeat does not parse the JSON again. An output
+whose JSON takes longer to decode than it took to compute (the full
+correlation heatmap of a large catalog) is only kept in that local
+memory: other workers are better off computing it. Both evict the least
+recently used entry once maxsize entries are stored.
+
+    figure_cache = FigureCache(maxsize=256)
+
+    @app.callback(...)
+    @figure_cache.memoize(version=lambda: datasets.handle('num').version)
+    def update_graph(x, y, year_range):
+        ...'''
+
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from plotly.utils import PlotlyJSONEncoder
+
+MISSING = object()
+DECODED_ENTRIES = 32
+
+
+def dumps(value):
+    '''Serialize callback outputs (figures, components, numpy data) to JSON.'''
+    return json.dumps(value, cls=PlotlyJSONEncoder)
+
+
+class MemoryBackend:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key, MISSING)
+            if value is not MISSING:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, cost=None):
+        '''Store value; returns it, as get() will.'''
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    '''LRU entries in a SQLite file, shared by every process that opens it.'''
+
+    def __init__(self, path, maxsize, decoded_entries=DECODED_ENTRIES):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local()
+        # Entries never change under a key (the data version is part of it),
+        # so decoded copies can be kept without checking the file again
+        self._decoded = MemoryBackend(decoded_entries)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'key TEXT PRIMARY KEY, value TEXT NOT NULL, used REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+
+    def _connect(self):
+        # One connection per thread and per process: connections must not
+        # be carried across a fork.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        value = self._decoded.get(key)
+        if value is not MISSING:
+            conn.execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+            return value
+        row = conn.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return MISSING
+        conn.execute('UPDATE entries SET used = ? WHERE key = ?', (time.time(), key))
+        value = json.loads(row[0])
+        self._decoded.set(key, value)
+        return value
+
+    def set(self, key, value, cost=None):
+        '''Store value; returns it decoded from JSON, as get() will.
+
+        cost is how long computing value took, in seconds. The shared row
+        is only written if decoding it is quicker than that.'''
+        payload = dumps(value)
+        start = time.perf_counter()
+        value = json.loads(payload)
+        decode = time.perf_counter() - start
+        self._decoded.set(key, value)
+        if cost is not None and decode >= cost:
+            return value
+        conn = self._connect()
+        conn.execute('INSERT OR REPLACE INTO entries (key, value, used) VALUES (?, ?, ?)',
+                     (key, payload, time.time()))
+        excess = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0] - self.maxsize
+        if excess > 0:
+            conn.execute('DELETE FROM entries WHERE key IN '
+                         '(SELECT key FROM entries ORDER BY used LIMIT ?)', (excess,))
+        return value
+
+    def clear(self):
+        self._connect().execute('DELETE FROM entries')
+        self._decoded.clear()
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+
+class FigureCache:
+    def __init__(self, maxsize=256, path=None):
+        if path:
+            self.backend = SQLiteBackend(path, maxsize)
+        else:
+            self.backend = MemoryBackend(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.counts = Counter()   # (function name, 'hit' or 'miss') -> count
+        self._lock = threading.Lock()
+
+    def _count(self, name, result):
+        # Callbacks run in threads; += on shared counters is not atomic
+        with self._lock:
+            if result == 'hit':
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.counts[(name, result)] += 1
+
+    def memoize(self, version=None):
+        '''Cache a callback's outputs keyed on its arguments.
+
+        version is called on every request and its result becomes part of
+        the key, so entries built from an older copy of the data are never
+        served (they age out of the LRU instead).'''
+        def decorator(func):
+            name = '{}.{}'.format(func.__module__, func.__qualname__)
+
+            @functools.wraps(func)
+            def wrapper(*args):
+                key = json.dumps([name, args, version() if version else None],
+                                 cls=PlotlyJSONEncoder)
+                value = self.backend.get(key)
+                if value is not MISSING:
+                    self._count(name, 'hit')
+                    return value
+                self._count(name, 'miss')
+                start = time.perf_counter()
+                value = func(*args)
+                return self.backend.set(key, value, time.perf_counter() - start)
+            wrapper.uncached = func
+            return wrapper
+        return decorator
+
+    def clear(self):
+        self.backend.clear()
+
+    def __len__(self):
+        return len(self.backend)
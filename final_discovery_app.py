@@ -10,33 +10,145 @@ To solve this, we are creating an interactive journal article
 which will help readers find their own relationships within
 NYC data. '''
 
+import glob
+import json
+import os
+
 import pandas as pd
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash import Patch
+from dash.dependencies import ClientsideFunction, Input, Output, State
+import flask
+
+from attribute_search import AttributeIndex, cached_attribute_index
+from column_sketches import SketchCatalog
+from complaints import ComplaintCube, borolist, cached_complaint_cube, complaint_types
+from correlation import CorrelationMatrix
+from dataset_cache import read_csv_cached, source_version
+from dataset_registry import DatasetRegistry
+from energy_cleaning import load_benchmarking
+from figure_cache import FigureCache
+from instrumentation import instrument_app, record_traces, section, timed
+from link_graph import LinkGraph, cached_link_graph
+from tonnage_rollup import TonnageRollup
+from yearly_matrix import YearlyMatrix, cached_yearly_matrix
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
-data_path = 'C:\\Users\\watson\\Documents\\GitHub\\data_discovery_project\\datasets\\'
+# DISCOVERY_DATA_PATH points the app at another copy of datasets/ (ending in a separator)
+data_path = os.environ.get('DISCOVERY_DATA_PATH',
+                           'C:\\Users\\watson\\Documents\\GitHub\\data_discovery_project\\datasets\\')
 num_file = data_path + 'yearly_numeric_data.csv'
 stan_file = data_path + 'yearly_stan_data.csv'
 pri_env_comp = data_path + 'pri_env_complaints_by_borough.csv'
-num_df = pd.read_csv(num_file, index_col=0)
-num_df['year'] = num_df['year'].astype(int)
-stan_df = pd.read_csv(stan_file, index_col=0)
-
-# df_columns apply for both num_df and stan_df
-df_columns = list(stan_df.columns)
+tonnage_file = data_path + 'monthly_tonnage.csv'
+energy_files = [data_path + 'pri_municipalenergy_consumption_10to13.csv',
+                data_path + 'pri_municipalenergy_consumption_10to14.csv']
+# e.g. 11/25/2011 10:53:37 AM
+complaint_date_format = '%m/%d/%Y %I:%M:%S %p'
+# Set to the raw DOHMH indoor complaints export to build Figure 6 by streaming it
+raw_env_comp = os.environ.get('DISCOVERY_COMPLAINTS_RAW')
+
+# Data sets are loaded the first time a callback asks for them, see dataset_registry.py
+datasets = DatasetRegistry()
+
+@datasets.register('yearly', kind=YearlyMatrix, description='yearly numeric data, memory-mapped',
+                   version=lambda: source_version(num_file))
+def load_yearly():
+    # One mapped copy shared by every worker, see yearly_matrix.py
+    return cached_yearly_matrix(num_file)
+
+@datasets.register('num', kind=pd.DataFrame, description='yearly numeric data',
+                   version=lambda: source_version(num_file))
+def load_num_df():
+    return datasets['yearly'].frame()
+
+@datasets.register('stan', kind=pd.DataFrame, description='yearly data standardized to [0,1]')
+def load_stan_df():
+    return datasets['yearly'].standardized()
+
+@datasets.register('full', kind=pd.DataFrame, description='yearly columns without missing values')
+def load_full_df():
+    yearly = datasets['yearly']
+    return yearly.frame(yearly.complete_columns())
+
+@datasets.register('years', kind=list, description='years covered by every full column')
+def load_years():
+    return sorted(datasets['full']['year'].values)
+
+@datasets.register('correlations', kind=CorrelationMatrix,
+                   description='pairwise correlation of every yearly column')
+def load_correlations():
+    return CorrelationMatrix.from_frame(datasets['num'], exclude=['year'])
+
+@datasets.register('complaints', kind=pd.DataFrame, description='environmental complaints')
+def load_complaints():
+    return read_csv_cached(pri_env_comp, parse_dates=['Date_Received'],
+                           date_format=complaint_date_format)
+
+@datasets.register('complaint_cube', kind=ComplaintCube,
+                   description='complaint counts by year, borough and type')
+def load_complaint_cube():
+    if raw_env_comp:
+        return cached_complaint_cube(raw_env_comp)
+    # Read the rows directly rather than through 'complaints' so they are
+    # freed once counted instead of staying resident in the registry.
+    return ComplaintCube.from_frame(read_csv_cached(pri_env_comp, parse_dates=['Date_Received'],
+                                                    date_format=complaint_date_format))
+
+@datasets.register('energy', kind=pd.DataFrame,
+                   description='municipal building energy benchmarks, building x year x metric')
+def load_energy():
+    return load_benchmarking(energy_files)
+
+@datasets.register('tonnage', kind=TonnageRollup,
+                   description='DSNY tonnage by month/quarter/year and city/borough/district')
+def load_tonnage():
+    return TonnageRollup.from_csv(tonnage_file)
+
+@datasets.register('link_graph', kind=LinkGraph,
+                   description='data sets and the join keys linking them')
+def load_link_graph():
+    # Kept next to the CSVs; only new or changed files are read, see link_graph.py
+    return cached_link_graph(data_path)
+
+@datasets.register('attribute_index', kind=AttributeIndex,
+                   description='column names, synonyms and sample values of every CSV')
+def load_attribute_index():
+    return cached_attribute_index(data_path)
+
+@datasets.register('column_sketches', kind=SketchCatalog,
+                   description='HyperLogLog sketches of every column of every CSV')
+def load_column_sketches():
+    # Read from the .hll.npz files next to the CSVs, see column_sketches.py
+    return SketchCatalog(data_path)
+
+# The data sets the callbacks read; serve.py loads these before forking
+callback_datasets = ['yearly', 'num', 'correlations', 'complaint_cube', 'attribute_index', 'link_graph',
+                     'column_sketches']
+
+# Finished explorer outputs, keyed on their inputs and the data version. Set
+# DISCOVERY_FIGURE_CACHE to a file path to share the cache between workers.
+figure_cache = FigureCache(maxsize=512, path=os.environ.get('DISCOVERY_FIGURE_CACHE'))
+
+# Filter the explorer figures (2, 3 and 4) by year in the browser, see
+# assets/explorer.js. Set DISCOVERY_CLIENTSIDE_FILTERING=0 to filter on the server.
+clientside_filtering = os.environ.get('DISCOVERY_CLIENTSIDE_FILTERING', '1') != '0'
+
+# df_columns apply for both num_df and stan_df. Only the header is read here,
+# the layout needs the column names but not the data.
+df_columns = list(pd.read_csv(stan_file, index_col=0, nrows=0).columns)
 df_columns.remove('year')
 drop_options = [{'value':col, 'label':' '.join(col.lower().split('_'))} for col in df_columns]
+# The link graph's nodes are the CSVs of the data directory
+def link_source_options():
+    return [{'value':name, 'label':' '.join(name.split('_'))}
+            for name in sorted(os.path.splitext(os.path.basename(path))[0]
+                               for path in glob.glob(data_path + '*.csv'))]
 
-full_df = num_df[num_df.columns[num_df.notnull().all()]]
-years = sorted(full_df['year'].values)
-
-final_environComplaint = pd.read_csv(pri_env_comp)
-final_environComplaint['Date_Received'] = pd.to_datetime(final_environComplaint['Date_Received'])
-
+@timed('figure')
 def make_graph(graph_id, opts, df, title):
     return dcc.Graph(
         id=graph_id,
@@ -51,46 +163,56 @@ def make_graph(graph_id, opts, df, title):
         animate=False
     )
 
+def axis_title(col):
+    parts = col.split('_')
+    if len(parts) > 1:
+        return ' '.join(parts[:4])
+    return parts[0]
+
+@timed('figure')
+def scatter_figure(x_axis, y_axis, df, title, mode='markers'):
+    # Plain lists, so the figure can also be filtered in the browser
+    return {
+        'data': [
+            {'x': df[x_axis].tolist(), 'y': df[y_axis].tolist(), 'mode':mode,
+             'text':df['year'].tolist()}
+        ],
+        'layout': {'title': title, 'legend':{'orientation':'h'},
+                   'xaxis':{'title':axis_title(x_axis)},'yaxis':{'title':axis_title(y_axis)}}
+    }
+
+def empty_scatter(mode='markers'):
+    # Starting figure for the explorer graphs, which callbacks only patch
+    return {'data': [{'x': [], 'y': [], 'text': [], 'mode': mode}],
+            'layout': {'legend':{'orientation':'h'}, 'xaxis':{}, 'yaxis':{}}}
+
 def make_scatter(graph_id, x_axis, y_axis, df, title, mode='markers'):
-    xp = x_axis.split('_')
-    yp = y_axis.split('_')
-    if len(xp) > 1:
-        x_title = ' '.join(xp[:4])
-    else:
-        x_title = xp[0]
-    if len(yp) > 1:
-        y_title = ' '.join(yp[:4])
-    else:
-        y_title = yp[0]
-    
     return dcc.Graph(
         id=graph_id,
-        figure={
-            'data': [
-                {'x': df[x_axis], 'y': df[y_axis], 'mode':mode,
-                 'text':df['year']}
-            ],
-            'layout': {'title': title, 'legend':{'orientation':'h'},
-                       'xaxis':{'title':x_title},'yaxis':{'title':y_title}}
-        },
+        figure=scatter_figure(x_axis, y_axis, df, title, mode),
         animate=False
     )
 
 import plotly.graph_objects as go
 
-def make_heatmap(graph_id, z_data, x_data, y_data, title):
-    fig = go.Figure(data=go.Heatmap(
+@timed('figure')
+def heatmap_figure(z_data, x_data, y_data):
+    return go.Figure(data=go.Heatmap(
         z=z_data,
         x=x_data,
         y=y_data,
         colorscale='RdBu', zmid=0)
     )
+
+@timed('figure')
+def make_heatmap(graph_id, z_data, x_data, y_data, title):
     graph = dcc.Graph(
         id=graph_id,
-        figure=fig
+        figure=heatmap_figure(z_data, x_data, y_data)
     )
     return graph
 
+@timed('figure')
 def make_bar(nm, xdata, ydata):
     my_bar = go.Bar(
         name=nm,
@@ -99,10 +221,8 @@ def make_bar(nm, xdata, ydata):
     )
     return my_bar
 
-borolist = ['Brooklyn', 'Manhattan', 'Queens', 'Bronx', 'Staten Island']
-
-
-def make_stacked_bars(df, year, comp_types, num_comps):
+@timed('figure')
+def make_stacked_bars(year, comp_types, num_comps):
     fig = go.Figure(
         data=[
             make_bar(comp_types[i], borolist, num_comps[i]) for i in range(len(comp_types))
@@ -120,6 +240,48 @@ def make_stacked_bars(df, year, comp_types, num_comps):
     )
     return graph
 
+@timed('figure')
+def link_network_figure(graph, source, reach):
+    # Positions come from the graph's stored layout, nothing is laid out here
+    nodes, edges = graph.network()
+    where = {name: (x, y) for name, x, y, _, _ in nodes}
+    hops = {r.dataset: r.hops for r in reach}
+    hops[source] = 0
+    on_path = {frozenset((e.source, e.target)) for r in reach for e in r.path}
+
+    def segments(selected):
+        xs, ys = [], []
+        for e in edges:
+            if (frozenset((e.source, e.target)) in on_path) == selected:
+                xs += [where[e.source][0], where[e.target][0], None]
+                ys += [where[e.source][1], where[e.target][1], None]
+        return xs, ys
+
+    faint_x, faint_y = segments(False)
+    path_x, path_y = segments(True)
+    fig = go.Figure(data=[
+        go.Scatter(x=faint_x, y=faint_y, mode='lines', line={'color':'#ddd', 'width':1},
+                   hoverinfo='none', showlegend=False),
+        go.Scatter(x=path_x, y=path_y, mode='lines', line={'color':'#888', 'width':2},
+                   hoverinfo='none', showlegend=False),
+        go.Scatter(
+            x=[x for _, x, _, _, _ in nodes], y=[y for _, _, y, _, _ in nodes],
+            mode='markers+text', text=[name for name, _, _, _, _ in nodes], textposition='top center',
+            hovertext=['{}<br>{:,} rows<br>keys: {}'.format(name, rows, ', '.join(kinds))
+                       for name, _, _, rows, kinds in nodes],
+            hoverinfo='text', showlegend=False,
+            marker={'size':[8 + 3 * len(str(rows)) for _, _, _, rows, _ in nodes],
+                    'color':[hops.get(name, -1) for name, _, _, _, _ in nodes],
+                    'colorscale':[[0, '#eee'], [0.25, '#eee'], [0.25, '#d62728'], [1, '#fdd0a2']],
+                    'cmin':-1, 'cmax':3, 'line':{'width':1, 'color':'#666'}})
+    ])
+    fig.update_layout(
+        title="Data sets reachable from " + str(source),
+        xaxis={'visible':False}, yaxis={'visible':False}, height=550,
+        margin={'l':20, 'r':20, 't':50, 'b':20}
+    )
+    return fig
+
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 app.layout = html.Div(children=[  #outer div
     html.Div(children=[
@@ -205,13 +367,16 @@ app.layout = html.Div(children=[  #outer div
         each other. 
         ''', style={'text-align':'left'}),
         
-        html.Div(id='graph-2'), #selectx vs selecty
+        html.Div(id='graph-2', children=[
+            dcc.Graph(id='year-by-year-data', figure=empty_scatter(), animate=False)
+        ]), #selectx vs selecty
         html.Br(),
         
         html.Div(id='graph-2-caption', style={'text-align':'left'}),
 
         html.Div(id='min-year', style={'display':'none'}),
         html.Div(id='max-year', style={'display':'none'}),
+        dcc.Store(id='explorer-data'), #selected columns, filtered by year in the browser
     
         html.Div(
             html.Div(
@@ -228,6 +393,17 @@ app.layout = html.Div(children=[  #outer div
         
         html.Br(),
         
+        html.Div(
+            dcc.Input(
+                id='attribute-search',
+                type='search',
+                debounce=True,
+                placeholder='Search the columns of every data set, e.g. population, emissions, borough',
+                style={'width': '100%'}
+            ), #narrows the dropdowns below and the data set dropdown of Figure 7
+        ),
+        html.Div(id='attribute-search-results', style={'text-align': 'left'}),
+
         html.Div(id='dropdowns', children=[
             html.Div(
                 dcc.Dropdown(
@@ -251,11 +427,25 @@ app.layout = html.Div(children=[  #outer div
         
         html.Br(),
         
-        html.Div(id='graph-3-4', className='row'), #selectx and selecty
+        html.Div(id='graph-3-4', className='row', children=[
+            html.Div(dcc.Graph(id='year-by-x-data', figure=empty_scatter('line'), animate=False),
+                     className='six columns'),
+            html.Div(dcc.Graph(id='year-by-y-data', figure=empty_scatter('line'), animate=False),
+                     className='six columns')
+        ]), #selectx and selecty
         html.Div(id='graph-34-caption', style={'text-align': 'left'}),
         html.Br(),
         
-        html.Div(id='graph-5'), #Heatmap Corr between selectx/selecty
+        dcc.RadioItems(
+            id='corr-view',
+            options=[{'label':'Selected pair', 'value':'pair'},
+                     {'label':'All columns', 'value':'full'}],
+            value='pair',
+            labelStyle={'display':'inline-block'}
+        ), #choose what graph-5 shows
+        html.Div(id='graph-5', children=[
+            make_heatmap('heatmap-1', [], [], [], 'Heatmap Correlation')
+        ]), #Heatmap Corr between selectx/selecty
         html.Div(id='graph-5-caption', style={'text-align': 'left'}),
         html.Br(),
         html.Br(),
@@ -312,6 +502,38 @@ app.layout = html.Div(children=[  #outer div
         html.Div('''----''', style={'text-align':'center'}),
         html.Br(),
         html.Br(),
+
+        html.Div('''
+        Each data set above shares keys with others: years, boroughs, building numbers,
+        zip codes, community districts and addresses. Pick a data set to see which others
+        it joins with, directly or through one or two more, and how many rows each join
+        would give.
+        ''', style={'text-align': 'left'}),
+        html.Br(),
+        html.Div(className='row', children=[
+            html.Div(
+                dcc.Dropdown(
+                    id='link-source',
+                    options=link_source_options(),
+                    value='yearly_numeric_data',
+                    multi=False
+                ), #end dropdown 'link-source'
+                className='eight columns'
+            ),
+            html.Div(
+                dcc.RadioItems(
+                    id='link-hops',
+                    options=[{'label':'{} hop{}'.format(k, 's' if k > 1 else ''), 'value':k} for k in (1, 2, 3)],
+                    value=2,
+                    labelStyle={'display':'inline-block'}
+                ), #how far to follow the links
+                className='four columns'
+            )
+        ]),
+        dcc.Graph(id='link-graph', animate=False), #Figure 7, the data set link graph
+        html.Div(id='link-caption', style={'text-align': 'left'}),
+        html.Br(),
+        html.Br(),
         
         html.Div('''
         As shown, both time and space are contributing factors pointing to how the climate is
@@ -333,6 +555,9 @@ app.layout = html.Div(children=[  #outer div
 )
 def update_options(options_selected):
     #options_selected is the list of dropdown options
+    # Standardize just the selected columns instead of keeping a scaled copy
+    with section('pandas'):
+        stan_df = datasets['yearly'].standardized(options_selected)
     my_graph = make_graph('yearly-data', options_selected, stan_df, 'Yearly Data')
     return my_graph
 """
@@ -342,53 +567,150 @@ def update_options(options_selected):
 def update_years_output(value):
     return 'You have selected "{}"'.format(value)
 """
-@app.callback(
-    [Output('min-year', 'children'),
-     Output('max-year', 'children'),
-     Output('graph-2', 'children'),
-     Output('graph-3-4', 'children'),
-     Output('graph-5', 'children'),
-     Output('graph-2-caption', 'children'),
-     Output('graph-34-caption', 'children'),
-     Output('graph-5-caption', 'children')],
-    [Input('select-x', 'value'),
-     Input('select-y', 'value'),
-     Input('year-slider', 'value')]
-    )
-def update_graph_2_3_4(x, y, year_range):
-    temp_df = num_df[(num_df[x].notnull()) & (num_df[y].notnull())][['year',x,y]]
-    temp_df2 = temp_df.loc[(temp_df['year'].isin(range(int(year_range[0]), int(year_range[1]))))]
-    years = sorted(temp_df['year'].values)
-    year0, year1 = str(years[0]), str(years[-1])
-    titl = '{} vs {}'.format(x, y)
-    my_graph2 = make_scatter('year-by-year-data', x, y, temp_df2, titl)
-    #my_graph = 'you have selected: {}'.format(year_range)
-    my_graph3 = make_scatter('year-by-x-data', 'year', x, temp_df2, x, mode='line')
-    my_graph4 = make_scatter('year-by-y-data', 'year', y, temp_df2, y, mode='line')
-    graphs_lst = [
-                    html.Div(children=[my_graph3],
-                        className='six columns'
-                    ),
-                    html.Div(children=[my_graph4],
-                        className='six columns'
-                    )
-    ]
-
-    corr_df = temp_df[[x, y]].corr()
-    corr_plot = make_heatmap('heatmap-1', corr_df, [x,y], [x,y], 'Heatmap Correlation')
-
+@timed('pandas')
+def pair_rows(x, y):
+    # Rows of the yearly data where both selected columns have a value;
+    # x == y must not give a frame with a duplicate column
+    yearly = datasets['yearly']
+    columns = list(dict.fromkeys([x, y]))
+    return yearly.frame(columns)[yearly.valid_rows(columns)]
+
+def explorer_captions(x, y, start, end):
     g2_caption = '''
     Figure 2 : Plot of '{}' vs '{}', showing the actual data points as they relate to each
     other over time from {} to {}.
-    '''.format(x, y, year_range[0], year_range[-1])
+    '''.format(x, y, start, end)
 
     g34_caption = '''
     Figure 3 (left) : '{}', Figure 4 (Right) : '{}', showing the actual data points over time from {} to {}.
-    '''.format(x, y, year_range[0], year_range[-1])
+    '''.format(x, y, start, end)
+    return g2_caption, g34_caption
 
-    g5_caption = '''Figure 5 : Heatmap showing Pearson correlation between {} and {}'''.format(x, y)
-    
-    return year0, year1, my_graph2, graphs_lst, corr_plot, g2_caption, g34_caption, g5_caption
+def explorer_data(x, y):
+    '''Unfiltered figures 2-4 and their captions, ready for filter_explorer.
+
+    This is what the browser receives in the explorer-data store; the
+    captions keep {start} and {end} for the selected years.'''
+    temp_df = pair_rows(x, y)
+    titl = '{} vs {}'.format(x, y)
+    return {
+        'year': temp_df['year'].tolist(),
+        'figures': [scatter_figure(x, y, temp_df, titl),
+                    scatter_figure('year', x, temp_df, x, mode='line'),
+                    scatter_figure('year', y, temp_df, y, mode='line')],
+        'captions': list(explorer_captions(x, y, '{start}', '{end}')),
+    }
+
+@timed('pandas')
+def filter_explorer(data, year_range):
+    '''Python twin of filter_years in assets/explorer.js.'''
+    lo, hi = int(year_range[0]), int(year_range[1])
+    keep = [lo <= year < hi for year in data['year']]
+    figures = []
+    for fig in data['figures']:
+        traces = [dict(trace, **{key: [v for v, k in zip(trace[key], keep) if k]
+                                 for key in ('x', 'y', 'text')})
+                  for trace in fig['data']]
+        figures.append({'data': traces, 'layout': fig['layout']})
+    captions = [c.replace('{start}', str(year_range[0])).replace('{end}', str(year_range[-1]))
+                for c in data['captions']]
+    return figures + captions
+
+@timed('figure')
+def figure_patch(fig):
+    # Only the trace arrays and titles differ between two explorer figures
+    patched = Patch()
+    for key in ('x', 'y', 'text'):
+        patched['data'][0][key] = fig['data'][0][key]
+    patched['layout']['title'] = fig['layout']['title']
+    patched['layout']['xaxis']['title'] = fig['layout']['xaxis']['title']
+    patched['layout']['yaxis']['title'] = fig['layout']['yaxis']['title']
+    return patched
+
+# Each callback below only depends on the inputs that change its outputs:
+# the slider never recomputes Figure 5, and the correlation view never
+# refilters Figures 2-4.
+
+@app.callback(
+    [Output('min-year', 'children'),
+     Output('max-year', 'children')],
+    [Input('select-x', 'value'),
+     Input('select-y', 'value')]
+)
+@figure_cache.memoize(version=lambda: datasets.handle('num').version)
+def update_year_bounds(x, y):
+    years = pair_rows(x, y)['year'].values
+    return str(years.min()), str(years.max())
+
+@app.callback(
+    [Output('heatmap-1', 'figure'),
+     Output('graph-5-caption', 'children')],
+    [Input('select-x', 'value'),
+     Input('select-y', 'value'),
+     Input('corr-view', 'value')]
+)
+@figure_cache.memoize(version=lambda: datasets.handle('num').version)
+def update_correlation(x, y, corr_view='pair'):
+    correlations = datasets['correlations']
+    if corr_view == 'full':
+        corr_cols = correlations.columns
+    else:
+        corr_cols = [x, y]
+    with section('pandas'):
+        corr_df = correlations.frame(corr_cols)
+
+    # The heatmap's colorscale and template stay in the browser
+    with section('figure'):
+        heatmap = Patch()
+        heatmap['data'][0]['z'] = corr_df.values.tolist()
+        heatmap['data'][0]['x'] = list(corr_cols)
+        heatmap['data'][0]['y'] = list(corr_cols)
+
+    if corr_view == 'full':
+        g5_caption = '''Figure 5 : Heatmap showing Pearson correlation between every pair of columns,
+        each computed over the years where both columns have data.'''
+    else:
+        g5_caption = '''Figure 5 : Heatmap showing Pearson correlation between {} and {}
+        over the {} years where both have data'''.format(x, y, correlations.count(x, y))
+    return heatmap, g5_caption
+
+@figure_cache.memoize(version=lambda: datasets.handle('num').version)
+def update_explorer_data(x, y):
+    return explorer_data(x, y)
+
+@figure_cache.memoize(version=lambda: datasets.handle('num').version)
+def update_explorer_figures(x, y, year_range):
+    fig2, fig3, fig4, g2_caption, g34_caption = filter_explorer(update_explorer_data(x, y), year_range)
+    return figure_patch(fig2), figure_patch(fig3), figure_patch(fig4), g2_caption, g34_caption
+
+if clientside_filtering:
+    app.callback(
+        Output('explorer-data', 'data'),
+        [Input('select-x', 'value'),
+         Input('select-y', 'value')]
+    )(update_explorer_data)
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='explorer', function_name='filter_years'),
+        [Output('year-by-year-data', 'figure'),
+         Output('year-by-x-data', 'figure'),
+         Output('year-by-y-data', 'figure'),
+         Output('graph-2-caption', 'children'),
+         Output('graph-34-caption', 'children')],
+        [Input('explorer-data', 'data'),
+         Input('year-slider', 'value')]
+    )
+else:
+    app.callback(
+        [Output('year-by-year-data', 'figure'),
+         Output('year-by-x-data', 'figure'),
+         Output('year-by-y-data', 'figure'),
+         Output('graph-2-caption', 'children'),
+         Output('graph-34-caption', 'children')],
+        [Input('select-x', 'value'),
+         Input('select-y', 'value'),
+         Input('year-slider', 'value')]
+    )(update_explorer_figures)
 
 @app.callback(
     [Output('graph-6', 'children'),
@@ -396,28 +718,104 @@ def update_graph_2_3_4(x, y, year_range):
     [Input('pri-year-selector', 'value')]
 )
 def functionName(year):
-    environYr = final_environComplaint[final_environComplaint['Date_Received'].dt.year == year]
-
-    complaintType = ['Asbestos', 'Indoor Air Quality', 'Mold','Asbestos/Garbage Nuisance', 'Indoor Sewage','Cooling Tower', 'Lead']
-    numComplaints = [[],[],[],[],[],[],[]]
-    
-    for boro in borolist:
-        boroYr = environYr[environYr['Incident_Address_Borough']==boro]
-        complaintDF = boroYr.groupby('Complaint_Type_311').size()
-        complaintIndex = 0
-        for t in complaintType:
-            try: 
-                typeNum = complaintDF.loc[t]
-                (numComplaints[complaintIndex]).append(typeNum)
-            except: 
-                (numComplaints[complaintIndex]).append(0)
-            complaintIndex += 1
+    numComplaints = datasets['complaint_cube'].year_counts(year)
 
     g6_caption = '''Figure 6 : Different types of environmental complaints during {}.'''.format(year)
 
-    stacked_bars = make_stacked_bars(environYr, year, complaintType, numComplaints)
+    stacked_bars = make_stacked_bars(year, complaint_types, numComplaints)
     return stacked_bars, g6_caption
 
+@app.callback(
+    [Output('select-x', 'options'),
+     Output('select-y', 'options'),
+     Output('link-source', 'options'),
+     Output('attribute-search-results', 'children')],
+    [Input('attribute-search', 'value')],
+    [State('select-x', 'value'),
+     State('select-y', 'value'),
+     State('link-source', 'value')],
+    prevent_initial_call=True
+)
+def update_search(query, x, y, source):
+    if not query or not query.strip():
+        return drop_options, drop_options, link_source_options(), ''
+    index = datasets['attribute_index']
+    yearly_name = os.path.splitext(os.path.basename(num_file))[0]
+
+    # Matching yearly columns for the explorer, best first; the current
+    # selections stay so the figures keep their inputs
+    labels = {opt['value']: opt for opt in drop_options}
+    matches = [hit.column for hit in index.search(query, top=None, datasets=[yearly_name])
+               if hit.column in labels]
+    def narrowed(options, current):
+        values = matches + [current] if current in labels and current not in matches else matches
+        return [labels[value] for value in values]
+
+    hits = index.search(query, top=200)
+    ranked = list(dict.fromkeys(hit.dataset for hit in hits))
+    link_labels = {opt['value']: opt for opt in link_source_options()}
+    if source in link_labels and source not in ranked:
+        ranked.append(source)
+
+    results = [html.Div('{} : {} ({})'.format(hit.dataset, hit.column, ', '.join(hit.matched)))
+               for hit in hits[:10]]
+    if not results:
+        results = [html.Div('No column matches "{}".'.format(query))]
+    return (narrowed(drop_options, x), narrowed(drop_options, y),
+            [link_labels[name] for name in ranked if name in link_labels], results)
+
+def link_graph_version():
+    # New, changed or removed CSVs reach Figure 7 without a restart: the data
+    # directory is checked at most every 5 seconds and the graph loaded again
+    # when it changed (only those files are read, see cached_link_graph)
+    if datasets['link_graph'].stale(min_interval=5):
+        datasets.reload(['link_graph'])
+    return datasets['link_graph'].version
+
+@app.callback(
+    [Output('link-graph', 'figure'),
+     Output('link-caption', 'children')],
+    [Input('link-source', 'value'),
+     Input('link-hops', 'value')]
+)
+@figure_cache.memoize(version=link_graph_version)
+def update_link_view(source, hops):
+    graph = datasets['link_graph']
+    reach = graph.reachable(source, hops, top=10) if source in graph.rows else []
+    fig = link_network_figure(graph, source, reach)
+
+    lines = ['''Figure 7 : Data sets linked to '{}' within {} hop{}, by the estimated number of rows
+    of the join.'''.format(source, hops, 's' if hops > 1 else '')]
+    for r in reach:
+        route = ' then '.join('{} on {} ({} = {})'.format(e.target, e.kind.replace('_', ' '),
+                                                         e.source_column, e.target_column) for e in r.path)
+        lines.append('{}: about {:,.0f} rows, joining {}'.format(r.dataset, r.join_rows, route))
+    if len(lines) == 1:
+        lines.append('No other data set shares a join key with it.')
+    return fig, [html.Div(line) for line in lines]
+
+
+# Overlap and join size of any two columns from their sketches, e.g.
+# /join-estimate?left=monthly_tonnage:BOROUGH&right=pri_municipalenergy_consumption_10to14:Borough
+@app.server.route('/join-estimate')
+def join_estimate():
+    try:
+        left, right = [tuple(flask.request.args[side].split(':', 1)) for side in ('left', 'right')]
+        estimate = datasets['column_sketches'].estimate(left, right)
+    except (KeyError, IndexError, ValueError):
+        body = json.dumps({'error': 'left and right must be known dataset:column pairs'})
+        return app.server.response_class(body, status=400, mimetype='application/json')
+    return app.server.response_class(json.dumps(estimate._asdict()), mimetype='application/json')
+
+# Timing and payload metrics for every callback above, served at /metrics.
+# DISCOVERY_METRICS=0 turns them off.
+if os.environ.get('DISCOVERY_METRICS', '1') != '0':
+    instrument_app(app, figure_cache, datasets)
+
+# Record the callback requests of real sessions for loadtest.py
+if os.environ.get('DISCOVERY_TRACE_FILE'):
+    record_traces(app.server, os.environ['DISCOVERY_TRACE_FILE'])
+
 
 def main():
     #for opt in drop_options:
@@ -426,4 +824,5 @@ def main():
     
 if __name__ == '__main__':
     main()
+    # Development server; use serve.py to run with prefork workers
     app.run_server(debug=True)
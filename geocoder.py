@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+'''Batch geocoding of complaint addresses with a persistent cache.
+
+The complaints cleaning used to call the Google Maps API once per row with
+a missing Latitude/Longitude. Geocoder.fill instead:
+
+1. normalizes every address ("East 173 st" -> "EAST 173 STREET") and
+   de-duplicates them by address, borough and zip, so each distinct
+   address is resolved once;
+2. answers from the on-disk cache of earlier resolutions (a SQLite file).
+   Addresses the backend found no match for are cached too, and only
+   retried once that answer is older than retry_after (30 days by
+   default); backend errors are never cached;
+3. looks the rest up in a local address table (a PAD/PLUTO-style CSV
+   with address, borough, zip and coordinates);
+4. sends only what is still unresolved to the remote backend, if one is
+   configured. Backends are plain objects with a geocode(text) method
+   returning (lat, lon) or None, so a stub can stand in for the real
+   service in tests.
+
+Re-running the cleaning therefore only ever touches new addresses.
+
+    geocoder = Geocoder(AddressTable.from_csv('pad_addresses.csv'),
+                        cache_path='geocode_cache.sqlite')
+    complaints = geocoder.fill(complaints)'''
+
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+RETRY_AFTER = 30 * 24 * 3600   # seconds before a failed lookup is tried again
+
+# Whole-word abbreviations found in the complaint addresses
+ABBREVIATIONS = {
+    'ST': 'STREET', 'STR': 'STREET', 'AVE': 'AVENUE', 'AV': 'AVENUE', 'PL': 'PLACE',
+    'BLVD': 'BOULEVARD', 'RD': 'ROAD', 'DR': 'DRIVE', 'PKWY': 'PARKWAY', 'LN': 'LANE',
+    'CT': 'COURT', 'TER': 'TERRACE', 'HWY': 'HIGHWAY', 'SQ': 'SQUARE', 'EXPY': 'EXPRESSWAY',
+    'E': 'EAST', 'W': 'WEST', 'N': 'NORTH', 'S': 'SOUTH',
+}
+ABBREVIATION_PATTERN = r'\b({})\b'.format('|'.join(sorted(ABBREVIATIONS, key=len, reverse=True)))
+
+
+def normalize_address(series):
+    '''Canonical upper-case form of street addresses, one whole-column pass.'''
+    text = series.fillna('').astype(str).str.upper()
+    text = text.str.replace('&APOS;', "'", regex=False).str.replace("'", '', regex=False)
+    text = text.str.replace(r'[^A-Z0-9\- ]', ' ', regex=True)
+    text = text.str.replace(r'\b(\d+)(ST|ND|RD|TH)\b', r'\1', regex=True)
+    text = text.str.replace(ABBREVIATION_PATTERN, lambda m: ABBREVIATIONS[m.group(1)], regex=True)
+    return text.str.replace(r'\s+', ' ', regex=True).str.strip()
+
+
+def normalize_borough(series):
+    return series.fillna('').astype(str).str.strip().str.upper()
+
+
+def normalize_zip(series):
+    '''Zip codes as 5 digit text; 11221.0 and "11221" both become "11221".'''
+    return series.fillna('').astype(str).str.extract(r'(\d{5})', expand=False).fillna('')
+
+
+class AddressTable:
+    '''Local address -> coordinates lookup, keyed by normalized address and borough.'''
+
+    def __init__(self, keys, zip_keys, lat, lon):
+        self.coords = pd.DataFrame({'lat': lat, 'lon': lon}, index=keys)
+        self.coords = self.coords[~self.coords.index.duplicated()]
+        self.zip_coords = pd.DataFrame({'lat': lat, 'lon': lon}, index=zip_keys)
+        self.zip_coords = self.zip_coords[~self.zip_coords.index.duplicated() & (self.zip_coords.index != '')]
+
+    @classmethod
+    def from_frame(cls, df, address_col='address', borough_col='borough', zip_col='zip',
+                   lat_col='latitude', lon_col='longitude'):
+        df = df.dropna(subset=[address_col, lat_col, lon_col])
+        address = normalize_address(df[address_col])
+        keys = address + '|' + normalize_borough(df[borough_col])
+        zips = normalize_zip(df[zip_col]) if zip_col in df else pd.Series('', index=df.index)
+        # Rows without a zip get an empty zip key, which no lookup ever uses
+        zip_keys = (address + '|' + zips).where(zips != '', '')
+        return cls(keys.values, zip_keys.values, df[lat_col].astype(float).values,
+                   df[lon_col].astype(float).values)
+
+    @classmethod
+    def from_csv(cls, path, **columns):
+        return cls.from_frame(pd.read_csv(path, dtype=str), **columns)
+
+    def lookup(self, keys, zip_keys):
+        '''Coordinates for each key (NaN where unknown), trying the zip key second.'''
+        found = self.coords.reindex(keys)
+        missing = found['lat'].isnull().values
+        if missing.any():
+            by_zip = self.zip_coords.reindex(np.asarray(zip_keys)[missing])
+            found.iloc[np.flatnonzero(missing)] = by_zip.values
+        return found
+
+
+class GeocodeCache:
+    '''Every resolution ever made, by address key. Failures are stored as NULL
+    with the time they were made, and expire after retry_after seconds.'''
+
+    def __init__(self, path, retry_after=RETRY_AFTER):
+        self.path = path
+        self.retry_after = retry_after
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS geocodes ('
+                         'key TEXT PRIMARY KEY, lat REAL, lon REAL, source TEXT, resolved REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get_many(self, keys):
+        '''{key: (lat, lon) or (None, None)} for the keys that are cached.
+
+        Failures older than retry_after are left out, so they are tried again.'''
+        found = {}
+        keys = list(keys)
+        since = time.time() - self.retry_after
+        with self._connect() as conn:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = conn.execute('SELECT key, lat, lon FROM geocodes WHERE key IN ({}) '
+                                    'AND (lat IS NOT NULL OR resolved >= ?)'.format(
+                                        ','.join('?' * len(batch))), batch + [since])
+                for key, lat, lon in rows:
+                    found[key] = (lat, lon)
+        return found
+
+    def put_many(self, entries, source):
+        '''Store {key: (lat, lon) or None}.'''
+        now = time.time()
+        rows = [(key, None if coords is None else coords[0], None if coords is None else coords[1],
+                 source, now) for key, coords in entries.items()]
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?)', rows)
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM geocodes').fetchone()[0]
+
+
+class GoogleMapsBackend:
+    '''Remote backend using the googlemaps client (imported on first use).'''
+
+    def __init__(self, key):
+        import googlemaps
+        self.client = googlemaps.Client(key=key)
+
+    def geocode(self, text):
+        result = self.client.geocode(text)
+        if not result:
+            return None
+        location = result[0]['geometry']['location']
+        return location['lat'], location['lng']
+
+
+class StubBackend:
+    '''Backend answering from a dict, for tests and offline runs.'''
+
+    def __init__(self, answers=None):
+        self.answers = dict(answers or {})
+        self.calls = []
+
+    def geocode(self, text):
+        self.calls.append(text)
+        return self.answers.get(text)
+
+
+class Geocoder:
+    def __init__(self, address_table=None, cache_path='geocode_cache.sqlite', backend=None,
+                 retry_after=RETRY_AFTER):
+        self.address_table = address_table
+        self.cache = GeocodeCache(cache_path, retry_after)
+        self.backend = backend
+
+    def resolve(self, addresses):
+        '''Coordinates for a frame of distinct addresses.
+
+        addresses has columns key (address, borough and zip: the cache
+        key), address_key and zip_key (the address table keys) and query
+        (the text sent to the remote backend). Returns a frame with lat
+        and lon indexed by key.'''
+        keys = addresses['key'].values
+        result = pd.DataFrame({'lat': np.nan, 'lon': np.nan}, index=keys)
+
+        cached = self.cache.get_many(keys)
+        if cached:
+            hits = pd.DataFrame.from_dict(cached, orient='index', columns=['lat', 'lon'], dtype=float)
+            result.loc[hits.index, ['lat', 'lon']] = hits.values
+        todo = addresses[~addresses['key'].isin(cached)]
+
+        if self.address_table is not None and len(todo):
+            found = self.address_table.lookup(todo['address_key'].values, todo['zip_key'].values)
+            hit = found['lat'].notnull().values
+            keys = todo['key'].values[hit]
+            result.loc[keys, ['lat', 'lon']] = found.values[hit]
+            self.cache.put_many({key: tuple(coords) for key, coords in
+                                 zip(keys, found.values[hit].tolist())}, 'table')
+            todo = todo[~hit]
+
+        if self.backend is not None and len(todo):
+            resolved = {}
+            for key, query in zip(todo['key'], todo['query']):
+                try:
+                    resolved[key] = self.backend.geocode(query)
+                except Exception:
+                    continue  # transient failure, not cached so it is retried next run
+                if resolved[key] is not None:
+                    result.loc[key, ['lat', 'lon']] = resolved[key]
+            self.cache.put_many(resolved, type(self.backend).__name__)
+        return result
+
+    def fill(self, df, address_col='Incident_Address', borough_col='Incident_Address_Borough',
+             zip_col='Incident_Address_Zip', lat_col='Latitude', lon_col='Longitude'):
+        '''Copy of df with missing lat/lon filled in wherever an address resolves.'''
+        df = df.copy()
+        missing = df[lat_col].isnull() | df[lon_col].isnull()
+        if not missing.any():
+            return df
+
+        rows = df.loc[missing, [address_col, borough_col, zip_col]]
+        address = normalize_address(rows[address_col])
+        zips = normalize_zip(rows[zip_col])
+        address_key = address + '|' + normalize_borough(rows[borough_col])
+        # The zip is part of the cache key: with an empty borough, the same
+        # street name in different zips is a different place
+        rows = pd.DataFrame({'key': address_key + '|' + zips,
+                             'address_key': address_key,
+                             'zip_key': (address + '|' + zips).where(zips != '', ''),
+                             'query': address + ', ' + rows[borough_col].fillna('').astype(str)
+                                      + ', NYC, NY, USA ' + zips}, index=rows.index)
+        rows = rows[address != '']
+
+        distinct = rows.drop_duplicates('key')
+        coords = self.resolve(distinct)
+        filled = coords.reindex(rows['key'].values)
+        resolved = filled['lat'].notnull().values
+        df.loc[rows.index[resolved], lat_col] = filled['lat'].values[resolved]
+        df.loc[rows.index[resolved], lon_col] = filled['lon'].values[resolved]
+        return df
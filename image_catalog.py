@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+'''Live catalog of the images in a directory.
+
+The image pages used to glob the directory once at import, so a new
+chart needed a restart, and checked requests against that list with a
+linear search. ImageCatalog keeps a dict from file name to ImageInfo
+(size, mtime, pixel dimensions and SHA-1), which makes the allowed-file
+check a hash lookup, and a daemon thread re-scans the directory every
+poll_interval seconds. A scan only re-reads files whose size or mtime
+changed, builds a new dict and swaps it in with one assignment, so
+readers always see either the old or the new index, never a mix.
+
+version is a digest of the names and hashes in the index. It is the
+same in every worker process, so a page can cheaply ask "has the
+catalog changed since I last listed it":
+
+    catalog = ImageCatalog(image_directory)
+    'chart.png' in catalog
+    catalog.options()   # dcc.Dropdown options'''
+
+import fnmatch
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+
+from PIL import Image
+
+from dataset_cache import file_hash
+
+ImageInfo = namedtuple('ImageInfo', ['name', 'size', 'mtime_ns', 'width', 'height', 'sha1'])
+
+
+def read_image_info(path, stat=None):
+    stat = stat or os.stat(path)
+    with Image.open(path) as im:  # only reads the header
+        width, height = im.size
+    return ImageInfo(os.path.basename(path), stat.st_size, stat.st_mtime_ns, width, height, file_hash(path))
+
+
+class ImageCatalog:
+    def __init__(self, directory, pattern='*.png', poll_interval=2.0):
+        self.directory = directory
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self._index = {}
+        self._version = None
+        self._refresh_lock = threading.Lock()
+        self._watcher_pid = None
+        self.refresh()
+
+    def refresh(self):
+        '''Re-scan the directory; returns True if the index changed.'''
+        with self._refresh_lock:
+            old = self._index
+            index = {}
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or not fnmatch.fnmatch(entry.name, self.pattern):
+                    continue
+                stat = entry.stat()
+                info = old.get(entry.name)
+                if info is None or (info.size, info.mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                    try:
+                        info = read_image_info(entry.path, stat)
+                    except (OSError, SyntaxError):
+                        continue  # half written or not an image, try again next scan
+                index[entry.name] = info
+            if index == old and self._version is not None:
+                return False
+            digest = hashlib.sha1()
+            for name in sorted(index):
+                digest.update('{}:{}\n'.format(name, index[name].sha1).encode('utf-8'))
+            self._index, self._version = index, digest.hexdigest()[:16]
+            return True
+
+    def watch(self):
+        '''Start the polling thread of this process, if it is not running yet.
+
+        Threads do not survive a fork, so every worker starts its own on
+        first use of the catalog.'''
+        if self._watcher_pid != os.getpid():
+            self._watcher_pid = os.getpid()
+            threading.Thread(target=self._poll, name='image-catalog', daemon=True).start()
+
+    def _poll(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.refresh()
+            except OSError:
+                pass  # directory briefly unavailable, keep the last index
+
+    @property
+    def version(self):
+        self.watch()
+        return self._version
+
+    def __contains__(self, name):
+        self.watch()
+        return name in self._index
+
+    def get(self, name):
+        self.watch()
+        return self._index.get(name)
+
+    def names(self):
+        self.watch()
+        return sorted(self._index)
+
+    def options(self):
+        return [{'label': name, 'value': name} for name in self.names()]
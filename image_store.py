@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+'''Resized, recompressed and cacheable versions of the static images.
+
+The charts in the datasets directory are large PNGs (about 4 MB for the
+NYPD ones). ImageStore serves them as variants instead: a width from
+WIDTHS (never wider than the original) in WebP when the browser accepts
+it and optimized PNG otherwise. Each variant is made once with Pillow and
+kept on disk under a name containing the source file's SHA-1, so editing
+an image makes new variants and stale ones are simply never asked for.
+
+Responses carry a strong ETag (the source hash plus the variant), a
+Cache-Control max-age and "Vary: Accept", and an If-None-Match request
+for an unchanged image gets an empty 304.
+
+    images = ImageStore(image_directory)
+
+    @app.server.route('/static/<image_path>.png')
+    def serve_image(image_path):
+        return images.send(image_path + '.png', flask.request)
+
+/static/chart.png?w=640 asks for the 640 pixel wide variant.'''
+
+import os
+import threading
+
+import flask
+from PIL import Image
+
+from dataset_cache import file_hash
+
+WIDTHS = (320, 640, 960, 1280)
+DEFAULT_WIDTH = 960
+MIMETYPES = {'webp': 'image/webp', 'png': 'image/png'}
+
+
+class ImageStore:
+    def __init__(self, image_directory, cache_directory=None, widths=WIDTHS, max_age=86400,
+                 webp_quality=80, catalog=None):
+        self.image_directory = image_directory
+        self.catalog = catalog    # an ImageCatalog of the directory, to reuse its hashes
+        self.cache_directory = cache_directory or os.path.join(image_directory, '.image_cache')
+        self.widths = sorted(widths)
+        self.max_age = max_age
+        self.webp_quality = webp_quality
+        self._hashes = {}         # name -> (size, mtime_ns, sha1)
+        self._lock = threading.Lock()
+
+    def source_hash(self, name):
+        '''SHA-1 of an image, re-hashed only when its size or mtime changes.'''
+        stat = os.stat(os.path.join(self.image_directory, name))
+        info = self.catalog.get(name) if self.catalog is not None else None
+        if info is not None and (info.size, info.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            return info.sha1
+        known = self._hashes.get(name)
+        if known is None or known[:2] != (stat.st_size, stat.st_mtime_ns):
+            known = (stat.st_size, stat.st_mtime_ns, file_hash(os.path.join(self.image_directory, name)))
+            self._hashes[name] = known
+        return known[2]
+
+    def snap_width(self, width):
+        '''Smallest configured width that is at least width.'''
+        for candidate in self.widths:
+            if candidate >= width:
+                return candidate
+        return self.widths[-1]
+
+    def variant(self, name, width=DEFAULT_WIDTH, fmt='webp'):
+        '''(path, etag) of the variant, making it first if needed.'''
+        width = self.snap_width(width)
+        digest = self.source_hash(name)
+        etag = '{}-{}-{}'.format(digest[:20], width, fmt)
+        stem = os.path.splitext(name)[0]
+        path = os.path.join(self.cache_directory, '{}.{}.{}'.format(stem, etag, fmt))
+        if not os.path.exists(path):
+            with self._lock:
+                if not os.path.exists(path):
+                    self._render(os.path.join(self.image_directory, name), path, width, fmt)
+        return path, etag
+
+    def _render(self, source, path, width, fmt):
+        os.makedirs(self.cache_directory, exist_ok=True)
+        with Image.open(source) as im:
+            if im.width > width:
+                im = im.resize((width, round(im.height * width / im.width)), Image.LANCZOS)
+            if fmt == 'webp':
+                im = im.convert('RGBA' if 'A' in im.getbands() or 'transparency' in im.info else 'RGB')
+                options = {'quality': self.webp_quality, 'method': 6}
+            else:
+                options = {'optimize': True}
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            try:
+                im.save(tmp_path, format=fmt.upper(), **options)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def send(self, name, request):
+        '''Response for an image request, honouring ?w=, Accept and If-None-Match.'''
+        width = request.args.get('w', DEFAULT_WIDTH, type=int) or DEFAULT_WIDTH
+        fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'png'
+        path, etag = self.variant(name, width, fmt)
+        response = flask.send_file(path, mimetype=MIMETYPES[fmt], etag=etag, max_age=self.max_age,
+                                   conditional=True, last_modified=os.path.getmtime(path))
+        response.headers['Cache-Control'] = 'public, max-age={}'.format(self.max_age)
+        response.vary.add('Accept')
+        return response
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+'''Per-callback timing and payload metrics, served in Prometheus' text format.
+
+instrument_app(app) wraps every server-side callback registered on a
+Dash app and records, per callback:
+
+- requests, errors and a histogram of wall time;
+- time per section: 'pandas' and 'figure' for code marked with
+  section() / timed() (see final_discovery_app.py), 'load' for data
+  sets loaded on first use by the request, 'serialize' for
+  Dash's JSON encoding of the response and 'other' for the rest
+  (validation, cache look-ups, glue). Sections nest and only count
+  their own time, so the sections of a request add up to its wall time;
+- a histogram of response payload bytes;
+
+plus the figure cache's hit and miss counts per cached function. GET
+/metrics returns all of it. Metrics are per process: under serve.py a
+scrape sees the worker that answered it, which is enough to find hot
+paths but not an exact total across workers.
+
+The sampling profiler records the stack of every request thread every
+few milliseconds while it runs. It is off by default and only reachable
+when DISCOVERY_PROFILER_TOKEN is set:
+
+    curl -X POST 'localhost:8050/debug/profiler/start?token=...'
+    curl -X POST 'localhost:8050/debug/profiler/stop?token=...'
+    curl 'localhost:8050/debug/profiler?token=...'   # collapsed stacks
+
+The output is one "frame;frame;frame count" line per distinct stack,
+the input format of flamegraph.pl and speedscope.
+
+record_traces() appends every callback request to a file in the trace
+format loadtest.py replays.'''
+
+import functools
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import flask
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PAYLOAD_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7)
+
+_local = threading.local()
+
+
+# -- sections -----------------------------------------------------------
+
+@contextmanager
+def section(name):
+    '''Count the time of the block towards section name of the current request.
+
+    Outside an instrumented callback this does nothing.'''
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        yield
+        return
+    frame = [name, time.perf_counter(), 0.0]   # name, start, time spent in nested sections
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        elapsed = time.perf_counter() - frame[1]
+        _local.sections[name] += elapsed - frame[2]
+        if stack:
+            stack[-1][2] += elapsed
+
+
+def timed(name):
+    '''Decorator form of section().'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with section(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# -- metrics ------------------------------------------------------------
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.n += 1
+
+    def lines(self, metric, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            yield '{}_bucket{{{},le="{}"}} {}'.format(metric, labels, le, cumulative)
+        yield '{}_sum{{{}}} {}'.format(metric, labels, self.total)
+        yield '{}_count{{{}}} {}'.format(metric, labels, self.n)
+
+
+class CallbackMetrics:
+    def __init__(self, figure_cache=None):
+        self.figure_cache = figure_cache
+        self.requests = Counter()
+        self.errors = Counter()
+        self.sections = Counter()     # (callback, section) -> seconds
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.payload = defaultdict(lambda: Histogram(PAYLOAD_BUCKETS))
+        self._lock = threading.Lock()
+
+    def record(self, callback, seconds, sections, payload_bytes, failed):
+        with self._lock:
+            self.requests[callback] += 1
+            if failed:
+                self.errors[callback] += 1
+            self.latency[callback].observe(seconds)
+            if payload_bytes is not None:
+                self.payload[callback].observe(payload_bytes)
+            for name, spent in sections.items():
+                self.sections[(callback, name)] += spent
+            self.sections[(callback, 'other')] += max(0.0, seconds - sum(sections.values()))
+
+    def render(self):
+        '''Everything recorded so far in the Prometheus text exposition format.'''
+        out = []
+        with self._lock:
+            out.append('# TYPE dash_callback_requests_total counter')
+            out.extend('dash_callback_requests_total{{callback="{}"}} {}'.format(cb, n)
+                       for cb, n in sorted(self.requests.items()))
+            out.append('# TYPE dash_callback_errors_total counter')
+            out.extend('dash_callback_errors_total{{callback="{}"}} {}'.format(cb, self.errors[cb])
+                       for cb in sorted(self.requests))
+            out.append('# TYPE dash_callback_seconds histogram')
+            for cb, hist in sorted(self.latency.items()):
+                out.extend(hist.lines('dash_callback_seconds', 'callback="{}"'.format(cb)))
+            out.append('# TYPE dash_callback_section_seconds_total counter')
+            out.extend('dash_callback_section_seconds_total{{callback="{}",section="{}"}} {}'.format(
+                cb, name, spent) for (cb, name), spent in sorted(self.sections.items()))
+            out.append('# TYPE dash_callback_payload_bytes histogram')
+            for cb, hist in sorted(self.payload.items()):
+                out.extend(hist.lines('dash_callback_payload_bytes', 'callback="{}"'.format(cb)))
+        if self.figure_cache is not None:
+            out.append('# TYPE figure_cache_requests_total counter')
+            out.extend('figure_cache_requests_total{{function="{}",result="{}"}} {}'.format(func, result, n)
+                       for (func, result), n in sorted(self.figure_cache.counts.items()))
+            out.append('# TYPE figure_cache_entries gauge')
+            out.append('figure_cache_entries {}'.format(len(self.figure_cache)))
+        return '\n'.join(out) + '\n'
+
+
+def _instrument(callback_name, func, metrics):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _local.stack, _local.sections = [], Counter()
+        start = time.perf_counter()
+        result, failed = None, True
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        except Exception as exc:
+            # PreventUpdate and friends are how callbacks say "nothing to do"
+            failed = not type(exc).__module__.startswith('dash')
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            sections = _local.sections
+            _local.stack = _local.sections = None
+            payload = len(result) if isinstance(result, (str, bytes)) else None
+            metrics.record(callback_name, seconds, sections, payload, failed)
+    return wrapper
+
+
+def instrument_app(app, figure_cache=None, datasets=None, route='/metrics'):
+    '''Wrap every server-side callback of app and serve the metrics at route.
+
+    Call it after the callbacks are registered.'''
+    metrics = CallbackMetrics(figure_cache)
+    if datasets is not None:
+        for name in datasets.names():
+            handle = datasets.handle(name)
+            handle.loader = timed('load')(handle.loader)
+    for entry in app.callback_map.values():
+        func = entry.get('callback')
+        if func is None or getattr(func, 'instrumented', False):
+            continue
+        name = getattr(getattr(func, '__wrapped__', func), '__name__', 'callback')
+        entry['callback'] = _instrument(name, func, metrics)
+        entry['callback'].instrumented = True
+
+    # Dash serializes the response with its to_json helper; time it as its own section
+    import dash._callback as dash_callback
+    if hasattr(dash_callback, 'to_json') and not hasattr(dash_callback.to_json, 'instrumented'):
+        dash_callback.to_json = timed('serialize')(dash_callback.to_json)
+        dash_callback.to_json.instrumented = True
+
+    @app.server.route(route)
+    def metrics_endpoint():
+        return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    add_profiler_routes(app.server, SamplingProfiler())
+    return metrics
+
+
+# -- sampling profiler --------------------------------------------------
+
+class SamplingProfiler:
+    '''Samples the stacks of all other threads every interval seconds.'''
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self._thread = None
+        self._running = threading.Event()
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def start(self):
+        if not self.running:
+            self._running.set()
+            self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        own = threading.get_ident()
+        while self._running.is_set():
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                names = []
+                while frame is not None and len(names) < self.max_depth:
+                    code = frame.f_code
+                    names.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(names))] += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(stack, n) for stack, n in self.stacks.most_common())
+
+
+def add_profiler_routes(server, profiler, token=None):
+    '''Profiler control routes, only when a token is configured.'''
+    token = token or os.environ.get('DISCOVERY_PROFILER_TOKEN')
+    if not token:
+        return
+
+    def check():
+        if flask.request.args.get('token') != token:
+            flask.abort(403)
+
+    @server.route('/debug/profiler/start', methods=['POST'])
+    def profiler_start():
+        check()
+        profiler.stacks.clear()
+        profiler.start()
+        return 'started\n'
+
+    @server.route('/debug/profiler/stop', methods=['POST'])
+    def profiler_stop():
+        check()
+        profiler.stop()
+        return 'stopped, {} samples\n'.format(sum(profiler.stacks.values()))
+
+    @server.route('/debug/profiler')
+    def profiler_report():
+        check()
+        return flask.Response(profiler.collapsed(), mimetype='text/plain')
+
+
+# -- trace recording ----------------------------------------------------
+
+def record_traces(server, path):
+    '''Append every _dash-update-component request to path for loadtest.py.
+
+    Requests are grouped into sessions by client address and user agent,
+    which tells apart the browsers of a test session well enough.'''
+    lock = threading.Lock()
+
+    @server.before_request
+    def record_trace():
+        request = flask.request
+        if request.method != 'POST' or not request.path.endswith('/_dash-update-component'):
+            return
+        body = request.get_json(silent=True)
+        if body is None:
+            return
+        client = '{} {}'.format(request.remote_addr, request.user_agent.string)
+        line = json.dumps({'session': hashlib.sha1(client.encode('utf-8')).hexdigest()[:12],
+                           't': time.time(), 'body': body})
+        with lock, open(path, 'a') as f:
+            f.write(line + '\n')
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+'''Find columns in other data sets that are likely joinable with a column.
+
+Every column of every registered CSV is summarized by a MinHash signature
+of its distinct (normalized) values. The signatures go into a banded
+locality-sensitive hashing (LSH) index, so asking "which columns could
+this one join with" only looks at the columns that share a bucket with
+it instead of intersecting it with every other column.
+
+For each candidate the index reports the estimated Jaccard similarity of
+the two value sets and the estimated containment, the fraction of the
+query column's distinct values that also appear in the candidate. A
+containment close to 1 is what a good join key looks like.
+
+    index = LinkIndex()
+    index.add_directory('datasets')
+    index.query('monthly_tonnage', 'BOROUGH')'''
+
+import argparse
+import codecs
+import glob
+import os
+import pickle
+from collections import defaultdict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+JoinCandidate = namedtuple('JoinCandidate', ['dataset', 'column', 'jaccard', 'containment', 'distinct'])
+
+
+def normalize_values(series):
+    '''Distinct normalized values of a column as an array of str.
+
+    Text is stripped and lower-cased, and numbers with no fractional part
+    are written as integers so that '1062652.0' and '1062652' match.'''
+    values = series.dropna().astype(str).str.strip().str.lower()
+    values = pd.unique(values[values != ''].to_numpy())
+    if len(values) == 0:
+        return values.astype(object)
+    numbers = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    with np.errstate(invalid='ignore'):
+        integral = np.isfinite(numbers) & (numbers == np.floor(numbers)) & (np.abs(numbers) < 2 ** 53)
+    if integral.any():
+        values = values.astype(object)
+        values[integral] = numbers[integral].astype(np.int64).astype(str)
+        values = pd.unique(values)
+    return values
+
+
+def hash_values(values):
+    '''Stable 64-bit hashes of an array of str.'''
+    return pd.util.hash_array(np.asarray(values, dtype=object)).astype(np.uint64)
+
+
+class MinHasher:
+    '''Draws num_perm universal hash functions and applies them in bulk.'''
+
+    def __init__(self, num_perm=128, seed=1, chunk_size=8192):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.chunk_size = chunk_size
+        self.a = rng.randint(1, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64) % MERSENNE_PRIME
+        self.b = rng.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64) % MERSENNE_PRIME
+
+    def empty(self):
+        return np.full(self.num_perm, MAX_HASH, dtype=np.uint64)
+
+    def signature(self, hashes, signature=None):
+        '''MinHash signature of hashes, folded into signature if given.'''
+        if signature is None:
+            signature = self.empty()
+        hashes = hashes & MAX_HASH
+        with np.errstate(over='ignore'):
+            for start in range(0, len(hashes), self.chunk_size):
+                chunk = hashes[start:start + self.chunk_size, None]
+                permuted = ((chunk * self.a + self.b) % MERSENNE_PRIME) & MAX_HASH
+                np.minimum(signature, permuted.min(axis=0), out=signature)
+        return signature
+
+
+def jaccard(sig_a, sig_b):
+    return float(np.mean(sig_a == sig_b))
+
+
+def containment(jaccard_ab, size_a, size_b):
+    '''Estimated |A & B| / |A| from the Jaccard similarity and set sizes.'''
+    if size_a == 0:
+        return 0.0
+    overlap = jaccard_ab * (size_a + size_b) / (1.0 + jaccard_ab)
+    return min(1.0, overlap / size_a)
+
+
+class LinkIndex:
+    '''LSH index over the MinHash signatures of every column of every data set.
+
+    bands * rows must equal num_perm. Two columns land in the same bucket
+    of a band with probability jaccard ** rows, so fewer rows per band
+    finds weaker overlaps (e.g. a small key set contained in a large one)
+    at the price of more candidates to check.'''
+
+    def __init__(self, num_perm=128, bands=64, rows=2, seed=1):
+        if bands * rows != num_perm:
+            raise ValueError('bands * rows must equal num_perm ({} * {} != {})'.format(bands, rows, num_perm))
+        self.hasher = MinHasher(num_perm, seed)
+        self.bands = bands
+        self.rows = rows
+        self.directories = []
+        self.columns = {}       # (dataset, column) -> {'signature', 'distinct', 'rows', 'path'}
+        self.sources = {}       # dataset -> (path, mtime_ns)
+        self._buckets = [defaultdict(set) for _ in range(bands)]
+
+    # -- building -------------------------------------------------------
+
+    def _band_keys(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def add_column(self, dataset, column, signature, distinct, rows=None, path=None):
+        key = (dataset, column)
+        if key in self.columns:
+            self.remove_column(dataset, column)
+        self.columns[key] = {'signature': signature, 'distinct': int(distinct), 'rows': rows, 'path': path}
+        for bucket, band_key in zip(self._buckets, self._band_keys(signature)):
+            bucket[band_key].add(key)
+
+    def remove_column(self, dataset, column):
+        entry = self.columns.pop((dataset, column))
+        for bucket, band_key in zip(self._buckets, self._band_keys(entry['signature'])):
+            members = bucket.get(band_key)
+            if members is not None:
+                members.discard((dataset, column))
+                if not members:
+                    del bucket[band_key]
+
+    def remove_dataset(self, dataset):
+        for key in [key for key in self.columns if key[0] == dataset]:
+            self.remove_column(*key)
+        self.sources.pop(dataset, None)
+
+    def add_frame(self, dataset, df, path=None):
+        for column in df.columns:
+            values = normalize_values(df[column])
+            if len(values) < 2:
+                continue  # constant or empty columns cannot link anything
+            signature = self.hasher.signature(hash_values(values))
+            self.add_column(dataset, column, signature, len(values), len(df), path)
+
+    def add_csv(self, path, dataset=None, chunksize=250000):
+        '''Sketch every column of a CSV, streaming it in chunks.
+
+        Files that fit in one chunk get exact distinct counts, larger files
+        the HyperLogLog estimate built in the same pass. The HyperLogLog
+        sketches are saved next to the CSV (see column_sketches.py).'''
+        from column_sketches import ColumnSketches, save_sketches
+
+        dataset = dataset or os.path.splitext(os.path.basename(path))[0]
+        self.remove_dataset(dataset)
+        sketches = ColumnSketches()
+        signatures, distinct, n_rows, n_chunks = {}, {}, 0, 0
+        for chunk in _read_csv_chunks(path, chunksize):
+            n_chunks += 1
+            n_rows += len(chunk)
+            for column in chunk.columns:
+                values = normalize_values(chunk[column])
+                hashes = hash_values(values)
+                signatures[column] = self.hasher.signature(hashes, signatures.get(column))
+                sketches.add_hashes(str(column), hashes, int(chunk[column].notnull().sum()))
+                distinct[column] = len(values)
+            sketches.total_rows += len(chunk)
+        save_sketches(sketches, path)
+        for column, signature in signatures.items():
+            count = distinct[column] if n_chunks == 1 else int(round(sketches.distinct(str(column))))
+            if count >= 2:
+                self.add_column(dataset, column, signature, count, n_rows, path)
+        self.sources[dataset] = (path, os.stat(path).st_mtime_ns)
+        return dataset
+
+    def add_directory(self, directory, pattern='*.csv'):
+        '''Register a directory and index its CSVs that are new or changed.'''
+        if directory not in self.directories:
+            self.directories.append(directory)
+        added = []
+        for path in sorted(glob.glob(os.path.join(directory, pattern))):
+            dataset = os.path.splitext(os.path.relpath(path, directory))[0]
+            known = self.sources.get(dataset)
+            if known is not None and known == (path, os.stat(path).st_mtime_ns):
+                continue
+            added.append(self.add_csv(path, dataset))
+        return added
+
+    def refresh(self):
+        '''Re-scan every registered directory for new or changed files.'''
+        added = []
+        for directory in self.directories:
+            added.extend(self.add_directory(directory))
+        return added
+
+    # -- querying -------------------------------------------------------
+
+    def candidates(self, signature):
+        found = set()
+        for bucket, band_key in zip(self._buckets, self._band_keys(signature)):
+            found.update(bucket.get(band_key, ()))
+        return found
+
+    def query(self, dataset, column, min_containment=0.5, top=10, same_dataset=False):
+        '''Columns in other data sets likely to be joinable with dataset.column.
+
+        Returns JoinCandidates sorted by estimated containment of the query
+        column's values in the candidate column.'''
+        entry = self.columns[(dataset, column)]
+        return self.query_signature(entry['signature'], entry['distinct'], min_containment, top,
+                                    exclude=None if same_dataset else dataset,
+                                    skip=(dataset, column))
+
+    def query_values(self, values, min_containment=0.5, top=10):
+        '''Same as query() for a set of values that is not in the index.'''
+        values = normalize_values(pd.Series(list(values)))
+        signature = self.hasher.signature(hash_values(values))
+        return self.query_signature(signature, len(values), min_containment, top)
+
+    def query_signature(self, signature, distinct, min_containment=0.5, top=10, exclude=None, skip=None):
+        results = []
+        for key in self.candidates(signature):
+            if key == skip or key[0] == exclude:
+                continue
+            other = self.columns[key]
+            jac = jaccard(signature, other['signature'])
+            cont = containment(jac, distinct, other['distinct'])
+            if cont >= min_containment:
+                results.append(JoinCandidate(key[0], key[1], jac, cont, other['distinct']))
+        results.sort(key=lambda c: (-c.containment, -c.jaccard, c.dataset, c.column))
+        return results[:top] if top else results
+
+    # -- persistence ----------------------------------------------------
+
+    def save(self, path):
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def _csv_encoding(path, blocksize=1 << 20):
+    '''UTF-8 if the whole file decodes as such, otherwise ISO-8859-1.'''
+    # The portal exports are not consistently UTF-8 (the notebooks use
+    # ISO-8859-1). A bad byte can sit anywhere, so check the whole file
+    # before the first chunk goes out rather than fail halfway through.
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                decoder.decode(block)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return 'ISO-8859-1'
+    return 'utf-8'
+
+
+def _read_csv_chunks(path, chunksize):
+    # Values are sketched as text, so read everything as str
+    for chunk in pd.read_csv(path, dtype=str, chunksize=chunksize, encoding=_csv_encoding(path)):
+        yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find joinable columns across CSV data sets.')
+    parser.add_argument('directories', nargs='+', help='directories of CSV files to index')
+    parser.add_argument('--index', help='index file to load from and save to')
+    parser.add_argument('--query', help='dataset:column to find join candidates for')
+    parser.add_argument('--min-containment', type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.index and os.path.exists(args.index):
+        index = LinkIndex.load(args.index)
+    else:
+        index = LinkIndex()
+    for directory in args.directories:
+        index.add_directory(directory)
+    if args.index:
+        index.save(args.index)
+
+    if args.query:
+        dataset, column = args.query.split(':', 1)
+        for cand in index.query(dataset, column, args.min_containment, top=None):
+            print('{:.2f}  {:.2f}  {}:{} ({} distinct)'.format(
+                cand.containment, cand.jaccard, cand.dataset, cand.column, cand.distinct))
+    else:
+        print('{} columns indexed from {} data sets'.format(len(index.columns), len(index.sources)))
+
+
+if __name__ == '__main__':
+    main()
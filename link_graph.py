@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+
+'''Graph of the data sets and the keys they can be joined on.
+
+link_discovery.py answers "which columns look like this one"; this module
+answers the README's question, "what else can I reach from this data
+set": linking A and B and C, and through them G, M and Z.
+
+Nodes are data sets. Every column that holds one of the known join keys
+is turned into a canonical key:
+
+    year                 a 4 digit year, also taken from dates and months
+    borough              borough name, also from borough codes 1-5
+    bin                  building identification number
+    zip                  5 digit zip code
+    community_district   borough code * 100 + district, e.g. 101
+    address              normalized street address (geocoder.normalize_address)
+
+and the graph keeps, per key column, the hashes of its distinct values
+with their row counts. An edge joins two data sets that share enough
+values of a key of the same kind; its weight is the number of rows the
+join would produce, computed exactly from the counts. Joins over several
+hops are estimated assuming the keys are independent:
+
+    rows(A-B-C) = rows(A-B) * rows(B-C) / rows(B)
+
+reachable(dataset, hops) finds every data set within hops edges, each at
+its fewest hops, and ranks them by that estimate. Results are cached, and
+so is the node layout used to draw the graph. Adding or changing a CSV
+recomputes only the edges of that data set, moves only it and its
+strongest neighbours in the layout (a bounded number of steps, each
+linear in the number of data sets) and drops only the cached results
+whose search went through one of them. stale() tells a long-running
+process when the directory has changed and the graph should be loaded
+again.
+
+    graph = cached_link_graph('datasets')
+    graph.reachable('yearly_numeric_data', hops=2)'''
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import _write_atomic
+from geocoder import normalize_address
+from link_discovery import _read_csv_chunks, hash_values
+
+GRAPH_FORMAT = 3
+
+# Checked in this order: 'Incident_Address_Zip' is a zip, not an address
+KEY_PATTERNS = [
+    ('zip', r'zip|postcode|postal'),
+    ('community_district', r'community_?district|community_?board|^cd$'),
+    ('borough', r'boro'),
+    ('bin', r'^bin$|building_?id'),
+    ('year', r'year|date|month|period'),
+    ('address', r'address|street'),
+]
+KEY_KINDS = [kind for kind, _ in KEY_PATTERNS]
+
+BOROUGH_NAMES = {'manhattan': '1', 'bronx': '2', 'the bronx': '2', 'brooklyn': '3', 'queens': '4',
+                 'staten island': '5', 'mn': '1', 'bx': '2', 'bk': '3', 'qn': '4', 'si': '5'}
+BOROUGHS = {'1': 'manhattan', '2': 'bronx', '3': 'brooklyn', '4': 'queens', '5': 'staten island'}
+
+# A column is a key when at least this share of its values are valid keys
+MIN_VALID = 0.5
+
+# Neighbours moved along with a new or changed data set, strongest joins first
+MAX_MOVED = 16
+
+KeyColumn = namedtuple('KeyColumn', ['kind', 'hashes', 'counts'])
+Edge = namedtuple('Edge', ['source', 'target', 'kind', 'source_column', 'target_column',
+                           'shared', 'containment', 'join_rows'])
+Reach = namedtuple('Reach', ['dataset', 'hops', 'join_rows', 'path'])
+
+
+# -- key extraction -----------------------------------------------------
+
+def _text(series):
+    text = series.astype(str).str.strip()
+    # '11221.0' -> '11221': numbers come back from pandas as floats
+    return text.str.replace(r'^(\d+)\.0+$', r'\1', regex=True)
+
+
+def _borough_codes(series):
+    text = _text(series).str.lower()
+    return text.where(text.isin(list(BOROUGHS)), text.map(BOROUGH_NAMES))
+
+
+def key_values(series, kind, boroughs=None):
+    '''The canonical keys of a column as str, NaN where a value is not one.'''
+    series = series.dropna()
+    if kind == 'year':
+        return series.astype(str).str.extract(r'\b(1[89]\d\d|20\d\d)\b', expand=False)
+    if kind == 'borough':
+        return _borough_codes(series).map(BOROUGHS)
+    if kind == 'bin':
+        text = _text(series)
+        # x000000 BINs are placeholders for buildings without their own
+        return text.where(text.str.fullmatch(r'[1-5]\d{6}') & ~text.str.endswith('000000'))
+    if kind == 'zip':
+        return _text(series).str.extract(r'^(\d{5})', expand=False)
+    if kind == 'community_district':
+        number = pd.to_numeric(_text(series), errors='coerce')
+        if boroughs is not None:
+            # Districts numbered within the borough, as in the DSNY data
+            code = pd.to_numeric(_borough_codes(boroughs.reindex(series.index)), errors='coerce')
+            number = number.where(number >= 100, code * 100 + number)
+        valid = (number >= 101) & (number <= 595) & (number % 100 >= 1) & (number % 100 <= 18)
+        return number.where(valid).dropna().astype(int).astype(str).reindex(series.index)
+    if kind == 'address':
+        text = normalize_address(series)
+        return text.where(text.str.contains(r'\d') & text.str.contains(r'[A-Z]{2}'))
+    raise ValueError('unknown key kind {!r}'.format(kind))
+
+
+def key_columns(df):
+    '''{column: kind} for the columns of df that hold join keys.'''
+    named = {}
+    for column in df.columns:
+        name = re.sub(r'[^a-z0-9]+', '_', str(column).lower()).strip('_')
+        kind = next((kind for kind, pattern in KEY_PATTERNS if re.search(pattern, name)), None)
+        if kind is None and df[column].dtype == object:
+            # Unlabelled borough columns, e.g. air quality's geo_entity_name
+            distinct = df[column].dropna().drop_duplicates()
+            if len(distinct) and _borough_codes(distinct).notnull().mean() >= 0.8:
+                kind = 'borough'
+        if kind is not None:
+            named[column] = kind
+    boroughs = df[_borough_column(named)] if _borough_column(named) else None
+    found = {}
+    for column, kind in named.items():
+        values = df[column].dropna()
+        if len(values) and key_values(values, kind, boroughs).notnull().mean() >= MIN_VALID:
+            found[column] = kind
+    return found
+
+
+def _borough_column(columns):
+    return next((column for column, kind in columns.items() if kind == 'borough'), None)
+
+
+def _merge_counts(hashes, counts, new_hashes, new_counts):
+    if hashes is None:
+        return new_hashes, new_counts
+    merged, inverse = np.unique(np.concatenate([hashes, new_hashes]), return_inverse=True)
+    totals = np.zeros(len(merged), dtype=np.int64)
+    np.add.at(totals, inverse, np.concatenate([counts, new_counts]))
+    return merged, totals
+
+
+def read_keys(path, chunksize=250000):
+    '''({column: KeyColumn}, rows) for a CSV, streaming it in chunks.
+
+    The key columns are chosen on the first chunk.'''
+    columns, keys, rows = None, {}, 0
+    for chunk in _read_csv_chunks(path, chunksize):
+        rows += len(chunk)
+        if columns is None:
+            columns = key_columns(chunk)
+        boroughs = chunk[_borough_column(columns)] if _borough_column(columns) else None
+        for column, kind in columns.items():
+            values = key_values(chunk[column], kind, boroughs).dropna()
+            hashes, counts = np.unique(hash_values(values.to_numpy(dtype=object)), return_counts=True)
+            previous = keys.get(column)
+            merged = _merge_counts(previous.hashes if previous else None,
+                                   previous.counts if previous else None, hashes, counts)
+            keys[column] = KeyColumn(kind, *merged)
+    return {column: key for column, key in keys.items() if len(key.hashes) >= 2}, rows
+
+
+def join_rows(a, b):
+    '''(shared distinct keys, rows of the equi-join) of two KeyColumns.'''
+    _, ia, ib = np.intersect1d(a.hashes, b.hashes, assume_unique=True, return_indices=True)
+    return len(ia), int((a.counts[ia] * b.counts[ib]).sum())
+
+
+# -- the graph ----------------------------------------------------------
+
+class LinkGraph:
+    '''Incremental join graph over the CSVs of one or more directories.
+
+    An edge needs at least min_shared common key values covering at least
+    min_containment of the smaller column's distinct values.'''
+
+    def __init__(self, min_containment=0.3, min_shared=2, cache_size=512, seed=1):
+        self.min_containment = min_containment
+        self.min_shared = min_shared
+        self.cache_size = cache_size
+        self.seed = seed
+        self.directories = []
+        self.sources = {}         # dataset -> (path, size, mtime_ns)
+        self.rows = {}            # dataset -> rows
+        self.keys = {}            # dataset -> {column: KeyColumn}
+        self.adjacency = defaultdict(dict)  # dataset -> {neighbour: [Edge from dataset]}
+        self.positions = {}       # dataset -> np.array([x, y])
+        self.version = None       # digest of the sources, the same in every process
+        self.scanned = {}         # directory -> file signature at the last add_directory
+        self._checked = 0.0       # time of the last stale() scan
+        self._reach = OrderedDict()   # (dataset, hops) -> (results, data sets the search expanded)
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+
+    # -- building -------------------------------------------------------
+
+    def add_csv(self, path, dataset=None, chunksize=250000):
+        dataset = dataset or os.path.splitext(os.path.basename(path))[0]
+        keys, rows = read_keys(path, chunksize)
+        stat = os.stat(path)
+        self.set_dataset(dataset, keys, rows, (path, stat.st_size, stat.st_mtime_ns))
+        return dataset
+
+    def set_dataset(self, dataset, keys, rows, source=None):
+        '''Add or replace a data set, updating only the edges it takes part in.'''
+        touched = {dataset} | set(self.adjacency.get(dataset, ()))
+        self._drop_edges(dataset)
+        self.keys[dataset] = keys
+        self.rows[dataset] = rows
+        self.sources[dataset] = source
+        for other, other_keys in self.keys.items():
+            if other == dataset:
+                continue
+            edges = self._edges(dataset, keys, other, other_keys)
+            if edges:
+                self.adjacency[dataset][other] = edges
+                self.adjacency[other][dataset] = [self._reverse(e) for e in edges]
+                touched.add(other)
+        self._place(dataset)
+        self._changed(touched)
+
+    def remove_dataset(self, dataset):
+        touched = {dataset} | set(self.adjacency.get(dataset, ()))
+        self._drop_edges(dataset)
+        for table in (self.keys, self.rows, self.sources, self.positions, self.adjacency):
+            table.pop(dataset, None)
+        self._changed(touched)
+
+    def _drop_edges(self, dataset):
+        for other in self.adjacency.pop(dataset, {}):
+            self.adjacency[other].pop(dataset, None)
+
+    def _edges(self, dataset, keys, other, other_keys):
+        # One edge per kind of key: the column pair with the best overlap
+        best = {}
+        for column, key in keys.items():
+            for other_column, other_key in other_keys.items():
+                if key.kind != other_key.kind:
+                    continue
+                shared, rows = join_rows(key, other_key)
+                cont = shared / float(min(len(key.hashes), len(other_key.hashes)))
+                if shared < self.min_shared or cont < self.min_containment:
+                    continue
+                edge = Edge(dataset, other, key.kind, column, other_column, shared, cont, rows)
+                known = best.get(key.kind)
+                if known is None or (shared, cont, -rows) > (known.shared, known.containment, -known.join_rows):
+                    best[key.kind] = edge
+        return sorted(best.values(), key=lambda e: -e.join_rows)
+
+    @staticmethod
+    def _reverse(edge):
+        return edge._replace(source=edge.target, target=edge.source,
+                             source_column=edge.target_column, target_column=edge.source_column)
+
+    def _changed(self, touched):
+        digest = hashlib.sha1(repr(sorted(self.sources.items())).encode('utf-8'))
+        self.version = digest.hexdigest()[:16]
+        with self._lock:
+            for query, (_, expanded) in list(self._reach.items()):
+                if expanded & touched:
+                    del self._reach[query]
+
+    def add_directory(self, directory, pattern='*.csv'):
+        '''Register a directory and add its new or changed CSVs; returns their names.
+
+        Data sets whose file is gone are removed.'''
+        if directory not in self.directories:
+            self.directories.append(directory)
+        self.scanned[directory] = directory_signature(directory, pattern)
+        self._checked = time.time()
+        changed, present = [], set()
+        for path in sorted(glob.glob(os.path.join(directory, pattern))):
+            dataset = os.path.splitext(os.path.relpath(path, directory))[0]
+            present.add(dataset)
+            stat = os.stat(path)
+            if self.sources.get(dataset) == (path, stat.st_size, stat.st_mtime_ns):
+                continue
+            try:
+                self.add_csv(path, dataset)
+            except (ValueError, pd.errors.ParserError):
+                continue  # not a table we can read
+            changed.append(dataset)
+        for dataset, source in list(self.sources.items()):
+            if (source and os.path.abspath(os.path.dirname(source[0])) == os.path.abspath(directory)
+                    and dataset not in present):
+                self.remove_dataset(dataset)
+                changed.append(dataset)
+        return changed
+
+    def refresh(self):
+        changed = []
+        for directory in self.directories:
+            changed.extend(self.add_directory(directory))
+        return changed
+
+    def stale(self, min_interval=0):
+        '''True if a CSV was added, changed or removed since the graph was built.
+
+        Scans at most every min_interval seconds and in one thread at a
+        time; the others get False meanwhile. The graph itself is left
+        alone, so threads still reading it are not disturbed: load a new
+        one (cached_link_graph reads only the changed files).'''
+        if time.time() - self._checked < min_interval or not self._check_lock.acquire(False):
+            return False
+        try:
+            self._checked = time.time()
+            return any(directory_signature(directory) != signature
+                       for directory, signature in self.scanned.items())
+        finally:
+            self._check_lock.release()
+
+    # -- querying -------------------------------------------------------
+
+    def datasets(self):
+        return sorted(self.rows)
+
+    def neighbours(self, dataset):
+        '''Edges from dataset, best join first.'''
+        edges = [e for group in self.adjacency.get(dataset, {}).values() for e in group]
+        return sorted(edges, key=lambda e: (-e.join_rows, e.target))
+
+    def reachable(self, dataset, hops=2, top=None):
+        '''Data sets within hops edges of dataset, by estimated join rows.
+
+        Every Reach carries its path, a list of Edges.'''
+        query = (dataset, hops)
+        with self._lock:
+            cached = self._reach.get(query)
+            if cached is not None:
+                self._reach.move_to_end(query)
+        if cached is None:
+            cached = self._search(dataset, hops)
+            with self._lock:
+                self._reach[query] = cached
+                if len(self._reach) > self.cache_size:
+                    self._reach.popitem(last=False)
+        results = cached[0]
+        return results[:top] if top else results
+
+    def _search(self, source, hops):
+        # Breadth first: every data set is reported at its fewest hops, with
+        # the best estimate among the paths of that length. Only the edges of
+        # expanded data sets matter to the result, so a change elsewhere
+        # cannot affect it.
+        best = {}
+        frontier = {source: (float(self.rows.get(source, 0)), [])}
+        expanded = set()
+        for _ in range(hops):
+            following = {}
+            for node, (rows, path) in frontier.items():
+                expanded.add(node)
+                if not self.rows.get(node):
+                    continue
+                for neighbour, edges in self.adjacency.get(node, {}).items():
+                    if neighbour == source or neighbour in best:
+                        continue
+                    estimate = rows * edges[0].join_rows / self.rows[node]
+                    if neighbour not in following or estimate > following[neighbour][0]:
+                        following[neighbour] = (estimate, path + [edges[0]])
+            best.update(following)
+            frontier = following
+        results = [Reach(node, len(path), rows, path) for node, (rows, path) in best.items()]
+        results.sort(key=lambda r: (-r.join_rows, r.hops, r.dataset))
+        return results, expanded
+
+    # -- layout ---------------------------------------------------------
+
+    def _place(self, dataset, iterations=60):
+        '''Put a new or changed data set next to its neighbours and let
+        just it and its strongest neighbours settle; everything else keeps
+        its place.'''
+        edges = self.adjacency.get(dataset, {})
+        neighbours = sorted((n for n in edges if n in self.positions),
+                            key=lambda n: (-edges[n][0].join_rows, n))[:MAX_MOVED]
+        rng = np.random.RandomState(zlib.crc32(dataset.encode('utf-8')) ^ self.seed)
+        if neighbours:
+            start = np.mean([self.positions[n] for n in neighbours], axis=0) + rng.normal(0, 0.05, 2)
+        else:
+            angle = rng.uniform(0, 2 * np.pi)
+            start = np.array([np.cos(angle), np.sin(angle)]) * (1 + 0.1 * len(self.positions) ** 0.5)
+        self.positions[dataset] = start
+        self.relax([dataset] + neighbours, iterations)
+
+    def relax(self, movable=None, iterations=200, tolerance=1e-4):
+        '''Force-directed layout steps (Fruchterman-Reingold) moving only movable.
+
+        Only the forces on movable are computed, so a step costs
+        len(movable) * len(positions). Stops early once no node moves
+        more than tolerance.'''
+        names = sorted(self.positions)
+        if len(names) < 2:
+            return
+        index = {name: i for i, name in enumerate(names)}
+        pos = np.array([self.positions[name] for name in names], dtype=np.float64)
+        moving = np.array(sorted({index[n] for n in (movable if movable is not None else names)
+                                  if n in index}), dtype=int)
+        if not len(moving):
+            return
+        # Edges seen from their moving end(s): row in moving, other end, weight
+        pairs = [(row, index[b], np.log1p(edges[0].join_rows)) for row, i in enumerate(moving)
+                 for b, edges in self.adjacency.get(names[i], {}).items() if b in index]
+        rows, others, weight = (np.array(column) for column in zip(*pairs)) if pairs else \
+            (np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0))
+        k = 1.0 / np.sqrt(len(names))
+        step = 0.1
+        for _ in range(iterations):
+            # Every pair repels with k^2 / d, edges attract with d^2 / k, more for bigger joins
+            delta = pos[moving][:, None, :] - pos[None, :, :]
+            distance = np.maximum(np.linalg.norm(delta, axis=2), 1e-3)
+            force = (delta * (k * k / distance ** 2)[..., None]).sum(axis=1)
+            span = pos[moving[rows]] - pos[others]
+            pull = span * (np.linalg.norm(span, axis=1) / k * (1 + weight / 10))[:, None]
+            np.subtract.at(force, rows, pull)
+            length = np.maximum(np.linalg.norm(force, axis=1), 1e-9)
+            moved = np.minimum(length, step)
+            pos[moving] += force * (moved / length)[:, None]
+            step *= 0.97
+            if moved.max() < tolerance:
+                break
+        for i in moving:
+            self.positions[names[i]] = pos[i]
+
+    def network(self):
+        '''(nodes, edges) to draw: nodes as (dataset, x, y, rows, key kinds),
+        edges as the best Edge of every connected pair.'''
+        nodes = [(name, float(self.positions[name][0]), float(self.positions[name][1]), self.rows[name],
+                  sorted({key.kind for key in self.keys[name].values()})) for name in self.datasets()]
+        edges = [group[0] for a in self.datasets() for b, group in sorted(self.adjacency.get(a, {}).items())
+                 if a < b]
+        return nodes, edges
+
+    # -- persistence ----------------------------------------------------
+
+    def save(self, path):
+        '''Write the key hashes and counts as arrays and the rest as JSON.
+
+        Nothing is pickled, so loading a file cannot run code.'''
+        keys, hashes, counts, offset = [], [], [], 0
+        for dataset in sorted(self.keys):
+            for column, key in self.keys[dataset].items():
+                keys.append([dataset, column, key.kind, offset, len(key.hashes)])
+                hashes.append(key.hashes)
+                counts.append(key.counts)
+                offset += len(key.hashes)
+        edges = [list(edge) for dataset in sorted(self.adjacency)
+                 for group in self.adjacency[dataset].values() for edge in group]
+        meta = {'format': GRAPH_FORMAT, 'min_containment': self.min_containment,
+                'min_shared': self.min_shared, 'cache_size': self.cache_size, 'seed': self.seed,
+                'directories': self.directories, 'sources': self.sources, 'rows': self.rows,
+                'positions': {name: [float(x), float(y)] for name, (x, y) in self.positions.items()},
+                'scanned': self.scanned, 'version': self.version, 'keys': keys, 'edges': edges}
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, hashes=np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64),
+                         counts=np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64),
+                         meta=np.array(json.dumps(meta)))
+        _write_atomic(path, write)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('format') != GRAPH_FORMAT:
+                raise ValueError('graph format {} is not {}'.format(meta.get('format'), GRAPH_FORMAT))
+            hashes, counts = data['hashes'], data['counts']
+        graph = cls(meta['min_containment'], meta['min_shared'], meta['cache_size'], meta['seed'])
+        graph.directories = meta['directories']
+        graph.sources = {name: tuple(source) if source else source for name, source in meta['sources'].items()}
+        graph.rows = meta['rows']
+        graph.keys = {name: {} for name in graph.rows}
+        for dataset, column, kind, start, length in meta['keys']:
+            graph.keys[dataset][column] = KeyColumn(kind, hashes[start:start + length],
+                                                    counts[start:start + length])
+        for edge in meta['edges']:
+            edge = Edge(*edge)
+            graph.adjacency[edge.source].setdefault(edge.target, []).append(edge)
+        graph.positions = {name: np.array(xy) for name, xy in meta['positions'].items()}
+        graph.scanned = {directory: [tuple(entry) for entry in signature]
+                         for directory, signature in meta['scanned'].items()}
+        graph.version = meta['version']
+        return graph
+
+
+def directory_signature(directory, pattern='*.csv'):
+    '''(name, size, mtime_ns) of every matching file, sorted.'''
+    signature = []
+    for path in sorted(glob.glob(os.path.join(directory, pattern))):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # removed while scanning
+        signature.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    return signature
+
+
+def cached_link_graph(directory, path=None):
+    '''The LinkGraph of directory, kept in path between runs.
+
+    Only CSVs added or changed since the last save are read.'''
+    path = path or os.path.join(directory, 'link_graph.npz')
+    graph = None
+    if os.path.exists(path):
+        try:
+            graph = LinkGraph.load(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            graph = None  # unreadable or an older format: rebuild it
+    graph = graph or LinkGraph()
+    scanned = graph.scanned.get(directory)
+    # A new file that is not a table changes nothing but the scan: save that
+    # too, or stale() would report it on every check
+    if graph.add_directory(directory) or graph.scanned[directory] != scanned or not os.path.exists(path):
+        try:
+            graph.save(path)
+        except OSError:
+            pass  # read-only data directory: keep it in memory
+    return graph
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the data sets reachable from one through join keys.')
+    parser.add_argument('directory', help='directory of CSV files')
+    parser.add_argument('--graph', help='graph file, default <directory>/link_graph.npz')
+    parser.add_argument('--from', dest='source', help='data set to start from')
+    parser.add_argument('--hops', type=int, default=2)
+    args = parser.parse_args()
+
+    graph = cached_link_graph(args.directory, args.graph)
+    if not args.source:
+        for name in graph.datasets():
+            print('{:<45} {:>9} rows  {}'.format(name, graph.rows[name], ', '.join(
+                '{}:{}'.format(e.kind, e.target) for e in graph.neighbours(name))))
+        return
+    for reach in graph.reachable(args.source, args.hops):
+        route = ' -> '.join('{} ({} {}={})'.format(e.target, e.kind, e.source_column, e.target_column)
+                            for e in reach.path)
+        print('{:>14,.0f}  {}  via {}'.format(reach.join_rows, reach.dataset, route))
+
+
+if __name__ == '__main__':
+    main()
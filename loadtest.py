@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+
+'''Load test: replay interaction traces against a local copy of the app.
+
+A trace is what a browser sends while someone uses the page: the burst
+of _dash-update-component POSTs on page load, then one or more per
+interaction (a dropdown change, a few slider releases, a year selector
+flip) separated by think time. The tool starts the app on localhost,
+replays traces with N simulated readers at once and reports, per
+callback, throughput and a latency histogram:
+
+    python loadtest.py --server serve --workers 4 --concurrency 1,8,32,64
+    python loadtest.py --server dev --duration 20
+    python loadtest.py --url http://127.0.0.1:8050 --trace recorded.jsonl
+
+Synthetic traces are generated from the running app's own layout and
+callback graph (/_dash-layout and /_dash-dependencies), so they pick
+values from the real dropdown options and slider ranges; --write-trace
+saves them. Real sessions can be recorded by starting the app with
+DISCOVERY_TRACE_FILE=recorded.jsonl and clicking around; every line is
+
+    {"session": "...", "t": <seconds>, "body": <the POST body>}
+
+Every reader replays one session at a time, keeping the recorded gaps
+between requests (scaled by --think-scale, 0 for back to back) and
+waiting for each response before the next request, like a browser
+tab. Requests only ever go to localhost.
+
+Each --concurrency level runs for --duration seconds after a --warmup
+that is not counted. Readers are threads of this process; at a few
+hundred readers the client itself can become the bottleneck, so watch
+its CPU.'''
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+UPDATE_PATH = '/_dash-update-component'
+LOCAL_HOSTS = ('127.0.0.1', 'localhost', '::1')
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+HEADERS = {'Content-Type': 'application/json', 'Accept': 'application/json',
+           'Accept-Encoding': 'gzip, deflate'}
+
+
+# -- the app's callbacks -----------------------------------------------
+
+def output_specs(output):
+    '''["id.property", ...] from a callback's output string.'''
+    if output.startswith('..') and output.endswith('..'):
+        return output[2:-2].split('...')
+    return [output]
+
+
+def callback_name(output):
+    '''Short name of a callback: its first output and how many others it has,
+    e.g. "heatmap-1.figure+1".'''
+    specs = output_specs(output)
+    return specs[0] if len(specs) == 1 else '{}+{}'.format(specs[0], len(specs) - 1)
+
+
+class Callback:
+    '''A server-side callback as listed by /_dash-dependencies.'''
+
+    def __init__(self, dependency):
+        self.output = dependency['output']
+        self.name = callback_name(self.output)
+        self.outputs = [dict(zip(('id', 'property'), spec.rsplit('.', 1))) for spec in output_specs(self.output)]
+        self.inputs = [(d['id'], d['property']) for d in dependency['inputs']]
+        self.state = [(d['id'], d['property']) for d in dependency.get('state', [])]
+        self.prevent_initial_call = dependency.get('prevent_initial_call', False)
+
+    def body(self, values, changed):
+        '''The POST body the browser sends for this callback.'''
+        return {
+            'output': self.output,
+            'outputs': self.outputs if len(self.outputs) > 1 else self.outputs[0],
+            'inputs': [{'id': i, 'property': p, 'value': values.get((i, p))} for i, p in self.inputs],
+            'state': [{'id': i, 'property': p, 'value': values.get((i, p))} for i, p in self.state],
+            'changedPropIds': ['{}.{}'.format(i, p) for i, p in changed],
+        }
+
+
+def layout_components(layout):
+    '''id -> (type, props) for every component with an id in a serialized layout.'''
+    found = {}
+    stack = [layout]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, dict) and 'props' in node:
+            props = node['props']
+            if isinstance(props.get('id'), str):
+                found[props['id']] = (node.get('type'), props)
+            stack.append(props.get('children'))
+    return found
+
+
+# -- synthetic traces ---------------------------------------------------
+
+def option_values(options):
+    if isinstance(options, dict):
+        return list(options)
+    return [o['value'] if isinstance(o, dict) else o for o in options or []]
+
+
+class TraceGenerator:
+    '''Synthetic sessions from the layout and the callback graph.
+
+    Controls are the inputs of server callbacks that a reader can change:
+    dropdowns, radio items, checklists and sliders.'''
+
+    def __init__(self, layout, dependencies, think_time=3.0, seed=0):
+        components = layout_components(layout)
+        self.callbacks = [Callback(d) for d in dependencies if not d.get('clientside_function')]
+        self.think_time = think_time
+        self.rng = random.Random(seed)
+        self.initial = {}
+        self.triggers = defaultdict(list)     # (id, property) -> callbacks it fires
+        self.controls = {}                    # (id, property) -> (type, props)
+        for cb in self.callbacks:
+            for key in cb.inputs + cb.state:
+                self.initial[key] = components.get(key[0], (None, {}))[1].get(key[1])
+            for key in cb.inputs:
+                self.triggers[key].append(cb)
+                ctype, props = components.get(key[0], (None, {}))
+                if key[1] == 'value' and hasattr(self, '_move_' + str(ctype)):
+                    self.controls[key] = (ctype, props)
+        self.control_keys = sorted(self.controls)
+
+    def session(self, actions):
+        '''[(t, body), ...] for a page load followed by actions interactions.'''
+        values = dict(self.initial)
+        events = [(0.0, cb.body(values, [])) for cb in self.callbacks if not cb.prevent_initial_call]
+        t = 0.0
+        for _ in range(actions if self.control_keys else 0):
+            t += self.rng.expovariate(1.0 / self.think_time)
+            key = self.rng.choice(self.control_keys)
+            ctype, props = self.controls[key]
+            dt = 0.0
+            for dt, value in getattr(self, '_move_' + ctype)(props, values[key]):
+                values[key] = value
+                events.extend((t + dt, cb.body(values, [key])) for cb in self.triggers[key])
+            t += dt
+        return events
+
+    def _other(self, choices, current):
+        choices = [c for c in choices if c != current] or choices
+        return self.rng.choice(choices)
+
+    def _move_Dropdown(self, props, current):
+        choices = option_values(props.get('options'))
+        if not choices:
+            return []
+        if not props.get('multi'):
+            return [(0.0, self._other(choices, current))]
+        # Multi-select: add or remove one entry
+        current = list(current or [])
+        unused = [c for c in choices if c not in current]
+        if current and (not unused or self.rng.random() < 0.4):
+            current.remove(self.rng.choice(current))
+        else:
+            current.append(self.rng.choice(unused))
+        return [(0.0, current)]
+
+    def _move_RadioItems(self, props, current):
+        choices = option_values(props.get('options'))
+        return [(0.0, self._other(choices, current))] if choices else []
+
+    def _move_Checklist(self, props, current):
+        return self._move_Dropdown(dict(props, multi=True), current)
+
+    def _slider_steps(self, props):
+        low, high = props.get('min', 0), props.get('max', 10)
+        step = props.get('step') or 1
+        return [low + i * step for i in range(int((high - low) / step) + 1)]
+
+    def _move_Slider(self, props, current):
+        return [(0.0, self._other(self._slider_steps(props), current))]
+
+    def _move_RangeSlider(self, props, current):
+        '''A scrub: one handle dragged to a new position.
+
+        With updatemode='drag' every step on the way is a request, 50 ms
+        apart; with the default 'mouseup' only the one to four releases
+        are.'''
+        steps = self._slider_steps(props)
+        lo, hi = current if current and len(current) == 2 else (steps[0], steps[-1])
+        handle = self.rng.randrange(2)
+        start = (lo, hi)[handle]
+        target = self.rng.choice([s for s in steps if s <= hi] if handle == 0 else [s for s in steps if s >= lo])
+        path = [s for s in steps if s != start and min(start, target) <= s <= max(start, target)]
+        if target < start:
+            path.reverse()
+        if not path:
+            return []
+        if props.get('updatemode') == 'drag':
+            stops, gap = path, 0.05
+        else:
+            releases = self.rng.randint(1, min(4, len(path)))
+            stops = [path[i] for i in sorted(self.rng.sample(range(len(path) - 1), releases - 1))] + [path[-1]]
+            gap = 0.6
+        return [(i * gap, [p, hi] if handle == 0 else [lo, p]) for i, p in enumerate(stops)]
+
+
+def write_trace(sessions, path):
+    with open(path, 'w') as f:
+        for k, events in enumerate(sessions):
+            for t, body in events:
+                f.write(json.dumps({'session': str(k), 't': round(t, 3), 'body': body}) + '\n')
+
+
+def read_trace(path, max_think=30.0):
+    '''Sessions from a trace file, with gaps longer than max_think cut to it.'''
+    grouped = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                grouped[event['session']].append((float(event['t']), event['body']))
+    sessions = []
+    for events in grouped.values():
+        events.sort(key=lambda e: e[0])
+        t, last, shifted = 0.0, events[0][0], []
+        for when, body in events:
+            t += min(when - last, max_think)
+            last = when
+            shifted.append((t, body))
+        sessions.append(shifted)
+    return sessions
+
+
+# -- replay -------------------------------------------------------------
+
+class Stats:
+    def __init__(self):
+        self.latency = defaultdict(list)    # callback -> seconds
+        self.errors = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.sessions = 0
+        self.elapsed = None
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, status, size):
+        with self._lock:
+            self.latency[name].append(seconds)
+            self.bytes[name] += size
+            # 204 is Dash's answer when a callback raises PreventUpdate
+            if status not in (200, 204):
+                self.errors[name] += 1
+
+    def summary(self):
+        elapsed = self.elapsed
+        callbacks = {}
+        for name, samples in sorted(self.latency.items()):
+            samples = sorted(samples)
+            histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+            for seconds in samples:
+                histogram[next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if seconds * 1000 <= bound),
+                               len(LATENCY_BUCKETS_MS))] += 1
+            callbacks[name] = {
+                'requests': len(samples),
+                'errors': self.errors[name],
+                'throughput': len(samples) / elapsed,
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p90_ms': percentile(samples, 90) * 1000,
+                'p99_ms': percentile(samples, 99) * 1000,
+                'max_ms': samples[-1] * 1000,
+                'mean_bytes': self.bytes[name] / len(samples),
+                'histogram': dict(zip([str(b) for b in LATENCY_BUCKETS_MS] + ['inf'], histogram)),
+            }
+        requests = sum(len(s) for s in self.latency.values())
+        return {'elapsed': elapsed, 'requests': requests, 'throughput': requests / elapsed,
+                'errors': sum(self.errors.values()), 'sessions': self.sessions, 'callbacks': callbacks}
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return float('nan')
+    return ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+
+
+def post(conn, path, body):
+    '''(seconds, status, response bytes); status is None when the connection failed.'''
+    start = time.perf_counter()
+    try:
+        conn.request('POST', path, body, HEADERS)
+        response = conn.getresponse()
+        status, size = response.status, len(response.read())
+    except (OSError, http.client.HTTPException):
+        conn.close()
+        status, size = None, 0
+    return time.perf_counter() - start, status, size
+
+
+def replay(url, sessions, concurrency, duration, think_scale=1.0, timeout=60):
+    '''Replay sessions with concurrency readers for duration seconds; returns Stats.'''
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path.rstrip('/') + UPDATE_PATH
+    # Encode once so the readers spend their time waiting on the server, not on json
+    encoded = [[(t * think_scale, callback_name(body['output']), json.dumps(body).encode('utf-8'))
+                for t, body in events] for events in sessions]
+    stats = Stats()
+    order = itertools.count()
+    deadline = time.monotonic() + duration
+
+    def reader(offset):
+        conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+        while time.monotonic() < deadline:
+            events = encoded[(next(order) + offset) % len(encoded)]
+            start = time.monotonic()
+            for t, name, body in events:
+                wait = start + t - time.monotonic()
+                if wait > 0:
+                    time.sleep(min(wait, max(0.0, deadline - time.monotonic())))
+                if time.monotonic() >= deadline:
+                    break
+                stats.record(name, *post(conn, path, body))
+            else:
+                with stats._lock:
+                    stats.sessions += 1
+        conn.close()
+
+    threads = [threading.Thread(target=reader, args=(k,), daemon=True) for k in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.elapsed = time.monotonic() - started
+    return stats
+
+
+# -- the server ---------------------------------------------------------
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(kind, port, data_dir=None, workers=1, threads=1):
+    '''Start the app on 127.0.0.1:port; returns (process, readiness path).
+
+    kind is 'serve' for serve.py's prefork server or 'dev' for Dash's
+    threaded development server (without the debugger and reloader).'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    if data_dir:
+        env['DISCOVERY_DATA_PATH'] = os.path.join(os.path.abspath(data_dir), '')
+    if kind == 'serve':
+        cmd = [sys.executable, os.path.join(here, 'serve.py'), '--bind', '127.0.0.1:{}'.format(port),
+               '--workers', str(workers), '--threads', str(threads)]
+        ready = '/readyz'
+    else:
+        cmd = [sys.executable, '-c', 'import final_discovery_app as m; '
+               'm.app.run_server(host="127.0.0.1", port={}, debug=False, threaded=True)'.format(port)]
+        ready = '/'
+    return subprocess.Popen(cmd, cwd=here, env=env), ready
+
+
+def wait_ready(url, process=None, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError('the server exited with status {}'.format(process.returncode))
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError('{} was not ready after {} s'.format(url, timeout))
+
+
+def fetch_json(url):
+    with urllib.request.urlopen(url, timeout=60) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def check_local(url):
+    host = urllib.parse.urlsplit(url).hostname
+    if host not in LOCAL_HOSTS:
+        raise SystemExit('refusing to load test {}: only localhost is allowed'.format(host))
+
+
+# -- report -------------------------------------------------------------
+
+def print_level(concurrency, summary, histograms=True):
+    print('\nconcurrency {}: {} requests in {:.1f} s, {:.1f} req/s, {} errors, {} sessions'.format(
+        concurrency, summary['requests'], summary['elapsed'], summary['throughput'],
+        summary['errors'], summary['sessions']))
+    print('  {:<40} {:>7} {:>7} {:>8} {:>8} {:>8} {:>8} {:>6} {:>9}'.format(
+        'callback', 'n', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'errors', 'kB/resp'))
+    for name, cb in sorted(summary['callbacks'].items()):
+        print('  {:<40} {:>7} {:>7.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>6} {:>9.1f}'.format(
+            name[:40], cb['requests'], cb['throughput'], cb['p50_ms'], cb['p90_ms'], cb['p99_ms'],
+            cb['max_ms'], cb['errors'], cb['mean_bytes'] / 1000.0))
+    if not histograms:
+        return
+    for name, cb in sorted(summary['callbacks'].items()):
+        print('  {}'.format(name))
+        peak = max(cb['histogram'].values()) or 1
+        for bound, count in cb['histogram'].items():
+            if count:
+                label = '> {} ms'.format(LATENCY_BUCKETS_MS[-1]) if bound == 'inf' else '<= {} ms'.format(bound)
+                print('    {:>11} {:>7} {}'.format(label, count, '#' * int(round(40.0 * count / peak))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the Data Discovery App on localhost.')
+    parser.add_argument('--server', choices=['serve', 'dev'], default='serve',
+                        help='start serve.py (prefork) or the development server')
+    parser.add_argument('--url', help='test an app already running on localhost instead of starting one')
+    parser.add_argument('--data-dir', default='datasets', help='datasets directory for the started app')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='serve.py workers')
+    parser.add_argument('--threads', type=int, default=1, help='serve.py threads per worker')
+    parser.add_argument('--concurrency', default='1,8,32',
+                        help='comma separated numbers of simultaneous readers, one run each')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per concurrency level')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of uncounted load first')
+    parser.add_argument('--trace', help='replay this trace file instead of synthetic sessions')
+    parser.add_argument('--write-trace', help='save the synthetic sessions to this file')
+    parser.add_argument('--sessions', type=int, default=200, help='synthetic sessions to generate')
+    parser.add_argument('--actions', type=int, default=20, help='interactions per synthetic session')
+    parser.add_argument('--think-time', type=float, default=3.0,
+                        help='mean seconds between synthetic interactions')
+    parser.add_argument('--think-scale', type=float, default=1.0,
+                        help='multiply the gaps between requests, 0 replays back to back')
+    parser.add_argument('--max-think', type=float, default=30.0,
+                        help='cut longer gaps in recorded traces to this many seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=60, help='seconds per request')
+    parser.add_argument('--no-histograms', action='store_true', help='only print the summary tables')
+    parser.add_argument('--out', help='write results to this JSON file')
+    args = parser.parse_args()
+
+    process = None
+    if args.url:
+        url = args.url.rstrip('/')
+        check_local(url)
+        wait_ready(url + '/', timeout=30)
+    else:
+        port = free_port()
+        url = 'http://127.0.0.1:{}'.format(port)
+        print('starting {} server on {}'.format(args.server, url), file=sys.stderr)
+        process, ready = start_server(args.server, port, args.data_dir, args.workers, args.threads)
+    try:
+        if process is not None:
+            wait_ready(url + ready, process)
+        if args.trace:
+            sessions = read_trace(args.trace, args.max_think)
+        else:
+            generator = TraceGenerator(fetch_json(url + '/_dash-layout'), fetch_json(url + '/_dash-dependencies'),
+                                       args.think_time, args.seed)
+            sessions = [generator.session(args.actions) for _ in range(args.sessions)]
+        if args.write_trace:
+            write_trace(sessions, args.write_trace)
+        if not sessions:
+            raise SystemExit('no sessions to replay')
+
+        levels = [int(c) for c in args.concurrency.split(',')]
+        if args.warmup > 0:
+            print('warming up for {} s'.format(args.warmup), file=sys.stderr)
+            replay(url, sessions, max(levels), args.warmup, args.think_scale, args.timeout)
+        results = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                   'server': 'external' if args.url else args.server,
+                   'workers': None if args.url else args.workers,
+                   'threads': None if args.url else args.threads,
+                   'trace': args.trace or 'synthetic', 'sessions': len(sessions),
+                   'think_scale': args.think_scale, 'levels': {}}
+        for concurrency in levels:
+            print('running {} readers for {} s'.format(concurrency, args.duration), file=sys.stderr)
+            stats = replay(url, sessions, concurrency, args.duration, args.think_scale, args.timeout)
+            summary = stats.summary()
+            results['levels'][str(concurrency)] = summary
+            print_level(concurrency, summary, not args.no_histograms)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+'''Column profiles for every CSV in a directory.
+
+profile_frame computes, for all columns of a DataFrame at once: the null
+fraction, a distinct-count estimate (read off the column's HyperLogLog
+sketch), min and max, the inferred type and the most common values.
+profile_directory runs it over many files in a process pool (one file
+per task, so the work spreads over every core) and writes the results
+to a JSON profile catalog. Files whose size and mtime match the
+existing catalog entry are not profiled again. While a file is in memory
+its HyperLogLog column sketches are saved next to it too (see
+column_sketches.py), so join estimates never need to read it again.
+
+    python profiler.py datasets --catalog datasets/profile_catalog.json
+
+completeness(df) gives the per-column non-null percentages the HW4
+notebooks used to build one exec() call per column for.'''
+
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from column_sketches import ColumnSketches, save_sketches
+
+TOP_VALUES = 5
+
+
+def completeness(df):
+    '''Percentage of non-null values in each column.'''
+    if len(df) == 0:
+        return pd.Series(0.0, index=df.columns)
+    return df.notnull().mean() * 100
+
+
+def _scalar(value):
+    # JSON friendly version of a pandas / numpy scalar
+    if value is None or (isinstance(value, float) and np.isnan(value)) or value is pd.NaT:
+        return None
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return pd.Timestamp(value).isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def infer_type(series):
+    '''pandas' inferred type, with number-like text reported as "numeric text".
+
+    The portal exports often keep numbers as padded strings mixed with
+    markers like "Not Available"; those columns are worth cleaning.'''
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+    if inferred in ('string', 'mixed'):
+        values = series.dropna()
+        numbers = pd.to_numeric(values.astype(str).str.strip(), errors='coerce')
+        if len(values) and numbers.notnull().mean() >= 0.5:
+            return 'numeric text'
+    return inferred
+
+
+def profile_frame(df, top=TOP_VALUES, sketches=None):
+    '''One profile dict per column of df.
+
+    sketches are df's ColumnSketches, if already built.'''
+    n_rows = len(df)
+    nulls = df.isnull().sum()
+    if sketches is None:
+        sketches = ColumnSketches().add_frame(df)
+    ordered = df.select_dtypes(include=['number', 'datetime', 'datetimetz'])
+    mins = ordered.min()
+    maxs = ordered.max()
+
+    profiles = []
+    for col in df.columns:
+        counts = df[col].value_counts(dropna=True).head(top)
+        profiles.append({
+            'column': str(col),
+            'dtype': str(df[col].dtype),
+            'inferred_type': infer_type(df[col]),
+            'null_fraction': float(nulls[col]) / n_rows if n_rows else 1.0,
+            'distinct': int(round(sketches.distinct(str(col)))),
+            'min': _scalar(mins[col]) if col in mins.index else None,
+            'max': _scalar(maxs[col]) if col in maxs.index else None,
+            'top_values': [[_scalar(value), int(count)] for value, count in counts.items()],
+        })
+    return profiles
+
+
+def read_any_csv(path):
+    # The portal exports are not consistently UTF-8 (the notebooks use ISO-8859-1).
+    try:
+        return pd.read_csv(path, low_memory=False)
+    except UnicodeDecodeError:
+        return pd.read_csv(path, low_memory=False, encoding='ISO-8859-1')
+
+
+def profile_file(path):
+    '''Catalog entry for one CSV file.'''
+    stat = os.stat(path)
+    df = read_any_csv(path)
+    sketches = ColumnSketches().add_frame(df)
+    save_sketches(sketches, path)
+    return {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'rows': len(df), 'columns': profile_frame(df, sketches=sketches)}
+
+
+def load_catalog(catalog_path):
+    try:
+        with open(catalog_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'files': {}}
+
+
+def save_catalog(catalog, catalog_path):
+    tmp_path = '{}.{}.tmp'.format(catalog_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(catalog, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, catalog_path)
+
+
+def profile_paths(paths, catalog_path=None, workers=None):
+    '''Profile paths in parallel, reusing unchanged entries of the catalog.'''
+    catalog = load_catalog(catalog_path) if catalog_path else {'files': {}}
+    stale = []
+    for path in paths:
+        stat = os.stat(path)
+        entry = catalog['files'].get(path)
+        if entry is None or (entry['size'], entry['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            stale.append(path)
+
+    if len(stale) <= 1 or workers == 1:
+        results = [profile_file(path) for path in stale]
+    else:
+        # Largest files first, so one big file does not start last and
+        # leave the other cores idle at the end.
+        stale.sort(key=lambda p: -os.stat(p).st_size)
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            results = list(pool.map(profile_file, stale))
+
+    for entry in results:
+        catalog['files'][entry['path']] = entry
+
+    if catalog_path:
+        save_catalog(catalog, catalog_path)
+    return catalog
+
+
+def profile_directory(directory, catalog_path=None, pattern='*.csv', workers=None):
+    paths = sorted(glob.glob(os.path.join(directory, pattern)))
+    return profile_paths(paths, catalog_path, workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile the columns of every CSV in a directory.')
+    parser.add_argument('directory')
+    parser.add_argument('--catalog', help='profile catalog (JSON) to update, default <directory>/profile_catalog.json')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default one per core')
+    args = parser.parse_args()
+
+    catalog_path = args.catalog or os.path.join(args.directory, 'profile_catalog.json')
+    catalog = profile_directory(args.directory, catalog_path, workers=args.workers)
+    for path, entry in sorted(catalog['files'].items()):
+        print('{}: {} rows, {} columns'.format(path, entry['rows'], len(entry['columns'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+'''Production server for the Data Discovery App.
+
+final_discovery_app.py's own entry point runs Dash's single-process
+development server. This one serves app.server from gunicorn's prefork
+server instead:
+
+    python serve.py --bind 0.0.0.0:8050 --workers 4 --threads 2
+
+The app is imported and its data sets are loaded once, in the master
+process, before the workers are forked; the workers then share those
+pages copy-on-write instead of each holding its own copy. gc.freeze()
+keeps the garbage collector from touching (and so copying) them.
+
+By default the master loads the data sets the app's callbacks read (its
+callback_datasets). One that fails to load is logged and skipped rather
+than stopping the server; its callbacks try to load it again on first
+use, as in the development server, and until one succeeds the worker
+reports itself not ready.
+
+Sending the master SIGHUP reloads gracefully: the data sets that were
+loaded are read again in the master, new workers are forked with the new
+data, and the old workers finish their requests before exiting.
+
+Every worker answers:
+
+    /healthz   200 as long as the process is serving requests
+    /readyz    200 when every data set the master was asked to load is
+               loaded in this worker, 503 with the missing ones (and the
+               error the master got loading them) otherwise
+
+Settings can also come from the environment (DISCOVERY_BIND,
+DISCOVERY_WORKERS, DISCOVERY_THREADS, DISCOVERY_TIMEOUT), which is handy
+in containers.'''
+
+import argparse
+import gc
+import json
+import logging
+import os
+
+from gunicorn.app.base import BaseApplication
+
+
+def add_health_routes(server, registry, ready_names=None, errors=None):
+    '''/healthz and /readyz on the Flask server behind the Dash app.
+
+    errors maps data set names to why they failed to load, if known.'''
+
+    @server.route('/healthz')
+    def healthz():
+        return server.response_class('ok\n', mimetype='text/plain')
+
+    @server.route('/readyz')
+    def readyz():
+        names = registry.names() if ready_names is None else ready_names
+        loaded = set(registry.loaded())
+        missing = [name for name in names if name not in loaded]
+        failed = {name: errors[name] for name in missing if errors and name in errors}
+        body = json.dumps({'ready': not missing, 'missing': missing, 'failed': failed, 'pid': os.getpid()})
+        return server.response_class(body, status=503 if missing else 200, mimetype='application/json')
+
+
+class DiscoveryServer(BaseApplication):
+    '''gunicorn application that loads the app and its data before forking.'''
+
+    def __init__(self, options, warm=None, module='final_discovery_app'):
+        self.options = options
+        self.warm = warm
+        self.module = module
+        self.dash_app = None
+        self.datasets = None
+        self.ready = []     # what /readyz waits for: every data set asked to be warmed
+        self.errors = {}    # data set -> why the master could not load it
+        self.log = logging.getLogger('gunicorn.error')
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+        # Always preload: that is what lets the workers share the data
+        self.cfg.set('preload_app', True)
+        self.cfg.set('on_reload', self.on_reload)
+
+    def load(self):
+        if self.dash_app is None:
+            module = __import__(self.module)
+            self.dash_app = module.app
+            self.datasets = module.datasets
+            if self.warm is None:
+                self.warm = getattr(module, 'callback_datasets', self.datasets.names())
+            self.ready[:] = self.warm
+            add_health_routes(self.dash_app.server, self.datasets, self.ready, self.errors)
+            self.prepare_fork(self.warm)
+        return self.dash_app.server
+
+    def prepare_fork(self, names):
+        loaded = []
+        self.errors.clear()
+        for name in names:
+            try:
+                self.datasets.get(name)
+            except Exception as exc:
+                # e.g. a data file missing from this checkout; its callbacks fail alone
+                self.log.exception('Could not load data set %s, skipping it', name)
+                self.errors[name] = '{}: {}'.format(type(exc).__name__, exc)
+                continue
+            loaded.append(name)
+        gc.collect()
+        gc.freeze()
+        return loaded
+
+    def on_reload(self, arbiter):
+        # Runs in the master on SIGHUP, before the new workers are forked
+        gc.unfreeze()
+        # The warmed data sets, including any that failed last time, and
+        # whatever else the master had loaded
+        names = list(dict.fromkeys(list(self.ready) + self.datasets.loaded()))
+        for name in names:
+            self.datasets.handle(name).unload()
+        arbiter.log.info('Reloaded data sets: %s', ', '.join(self.prepare_fork(names)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the Data Discovery App with prefork workers.')
+    parser.add_argument('--bind', default=os.environ.get('DISCOVERY_BIND', '127.0.0.1:8050'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('DISCOVERY_WORKERS', os.cpu_count() or 1)),
+                        help='worker processes, default one per core')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('DISCOVERY_THREADS', 1)),
+                        help='threads per worker')
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('DISCOVERY_TIMEOUT', 60)),
+                        help='seconds before a silent worker is restarted')
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help='seconds old workers get to finish their requests on reload or shutdown')
+    parser.add_argument('--warm', help='comma separated data sets to load before forking, '
+                                         "default the app's callback_datasets")
+    parser.add_argument('--access-log', default=None, help="access log file, '-' for stdout")
+    args = parser.parse_args()
+
+    options = {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'accesslog': args.access_log,
+    }
+    warm = args.warm.split(',') if args.warm else None
+    DiscoveryServer(options, warm).run()
+
+
+if __name__ == '__main__':
+    main()
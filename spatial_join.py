@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+
+'''Assign complaint coordinates to boroughs, zips, community districts and tracts.
+
+The complaints carry Latitude/Longitude, but Figure 6 groups them by the
+free-text Incident_Address_Borough, and the cleaning notebook dropped
+Community Board and Census Tract. This stage puts every point in the
+areas of local boundary files (GeoJSON, as published on NYC Open Data):
+
+    boundaries/boroughs.geojson              boro_name   -> Area_Borough
+    boundaries/zip_codes.geojson             ZIPCODE     -> Area_Zip
+    boundaries/community_districts.geojson   boro_cd     -> Area_Community_District
+    boundaries/census_tracts.geojson         boro_ct2010 -> Area_Census_Tract
+
+Each layer is indexed by a uniform grid. A cell records the area holding
+its centre and the polygon edges that cross it. A point in a cell no edge
+crosses gets the cell's area without any test. A point in a boundary cell
+starts from the centre's area and flips membership of every polygon with
+an odd number of edges crossing the segment centre -> point, which can
+only be the cell's own few edges. All of it runs as numpy array
+operations over all points at once, so millions of points take seconds.
+The index is saved next to the GeoJSON (<geojson>.grid.npz) and reused
+while the file keeps its size and mtime.
+
+Community districts use the boro_cd code (borough code * 100 + district,
+e.g. 101 for Manhattan 01), which district_columns turns into the
+BOROUGH/COMMUNITYDISTRICT keys of monthly_tonnage.csv:
+
+    python spatial_join.py complaints.csv --boundaries boundaries \\
+        --out complaints_located.csv --tonnage datasets/monthly_tonnage.csv \\
+        --district-out complaints_tonnage_by_district.csv'''
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# layer -> (file name in the boundaries directory, key properties to try in order)
+LAYERS = {
+    'borough': ('boroughs.geojson', ['boro_name', 'BoroName', 'borough']),
+    'zip': ('zip_codes.geojson', ['ZIPCODE', 'zipcode', 'postalCode', 'MODZCTA', 'ZCTA5CE10']),
+    'community_district': ('community_districts.geojson', ['boro_cd', 'BoroCD']),
+    'census_tract': ('census_tracts.geojson', ['boro_ct2010', 'BoroCT2010', 'boro_ct2020', 'BoroCT2020',
+                                               'GEOID']),
+}
+AREA_COLUMNS = {'borough': 'Area_Borough', 'zip': 'Area_Zip',
+                'community_district': 'Area_Community_District', 'census_tract': 'Area_Census_Tract'}
+# Borough codes of boro_cd / boro_ct, named as in monthly_tonnage.csv
+BOROUGH_CODES = {1: 'Manhattan', 2: 'Bronx', 3: 'Brooklyn', 4: 'Queens', 5: 'Staten Island'}
+GRID_FORMAT = 1
+MAX_CELLS = 1024
+PAIRS_PER_BATCH = 4000000
+
+
+def _rings(geometry):
+    if geometry is None:
+        return []
+    if geometry['type'] == 'Polygon':
+        return list(geometry['coordinates'])
+    if geometry['type'] == 'MultiPolygon':
+        return [ring for polygon in geometry['coordinates'] for ring in polygon]
+    if geometry['type'] == 'GeometryCollection':
+        return [ring for part in geometry['geometries'] for ring in _rings(part)]
+    return []
+
+
+def read_geojson(path, key_properties):
+    '''(keys, edges, owners) from a GeoJSON FeatureCollection.
+
+    edges is an (n, 4) array of x0, y0, x1, y1 (longitude, latitude) over
+    every ring of every feature, holes included; owners gives the feature
+    each edge belongs to. Even-odd crossing counts make holes and
+    multi-part features work without treating them specially.'''
+    with open(path) as f:
+        features = json.load(f)['features']
+    if not features:
+        raise ValueError('{} has no features'.format(path))
+    properties = features[0].get('properties') or {}
+    key = next((name for name in key_properties if name in properties), None)
+    if key is None:
+        raise ValueError('{} has none of the key properties {}'.format(path, key_properties))
+
+    keys, edges, owners = [], [], []
+    for feature in features:
+        rings = _rings(feature.get('geometry'))
+        if not rings:
+            continue
+        owner = len(keys)
+        keys.append(str((feature.get('properties') or {}).get(key)))
+        for ring in rings:
+            ring = np.asarray(ring, dtype=np.float64)[:, :2]
+            if len(ring) < 3:
+                continue
+            if not np.array_equal(ring[0], ring[-1]):
+                ring = np.vstack([ring, ring[:1]])
+            edges.append(np.hstack([ring[:-1], ring[1:]]))
+            owners.append(np.full(len(ring) - 1, owner, dtype=np.int32))
+    return np.array(keys, dtype=object), np.vstack(edges), np.concatenate(owners)
+
+
+class BoundaryLayer:
+    '''Grid index over the polygons of one boundary file.
+
+    Boundary files partition the map; where polygons do overlap, a point
+    gets one of the polygons holding it.'''
+
+    def __init__(self, keys, edges, owners, grid=None):
+        self.keys = np.asarray(keys, dtype=object)
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.owners = np.asarray(owners, dtype=np.int32)
+        if grid is None:
+            grid = self._build_grid()
+        (self.origin, self.cell_size, self.shape, self.cell_start, self.cell_edges,
+         self.center_owner) = grid
+
+    @classmethod
+    def from_geojson(cls, path, key_properties):
+        return cls(*read_geojson(path, key_properties))
+
+    def __len__(self):
+        return len(self.keys)
+
+    # -- index ----------------------------------------------------------
+
+    def _build_grid(self):
+        x0, y0, x1, y1 = self.edges.T
+        xmin, xmax = min(x0.min(), x1.min()), max(x0.max(), x1.max())
+        ymin, ymax = min(y0.min(), y1.min()), max(y0.max(), y1.max())
+        # About two cells per edge along each axis keeps boundary cells down to a few edges
+        side = int(np.clip(2 * np.sqrt(len(self.edges)), 16, MAX_CELLS))
+        width, height = max(xmax - xmin, 1e-12), max(ymax - ymin, 1e-12)
+        size = max(width, height) / side
+        nx, ny = int(np.ceil(width / size)) + 1, int(np.ceil(height / size)) + 1
+        origin, cell_size, shape = np.array([xmin, ymin]), np.array([size, size]), (ny, nx)
+
+        # Every cell the bounding box of each edge touches
+        ix0, iy0 = self._cell_coords(np.minimum(x0, x1), np.minimum(y0, y1), origin, cell_size, shape)
+        ix1, iy1 = self._cell_coords(np.maximum(x0, x1), np.maximum(y0, y1), origin, cell_size, shape)
+        widths = ix1 - ix0 + 1
+        counts = widths * (iy1 - iy0 + 1)
+        edge_ids = np.repeat(np.arange(len(self.edges)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = ((np.repeat(iy0, counts) + offsets // np.repeat(widths, counts)) * nx
+                 + np.repeat(ix0, counts) + offsets % np.repeat(widths, counts))
+        order = np.argsort(cells, kind='stable')
+        cell_edges = edge_ids[order].astype(np.int32)
+        cell_start = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=nx * ny))])
+
+        center_owner = np.full(ny * nx, -1, dtype=np.int32)
+        centers_x = xmin + (np.arange(nx) + 0.5) * size
+        for iy in range(ny):
+            row = cell_edges[cell_start[iy * nx]:cell_start[(iy + 1) * nx]]
+            center_owner[iy * nx:(iy + 1) * nx] = self._row_owners(np.unique(row), ymin + (iy + 0.5) * size,
+                                                                   centers_x)
+        return origin, cell_size, shape, cell_start, cell_edges, center_owner
+
+    def _row_owners(self, edge_ids, y, xs):
+        '''Owner of each point (x, y) on one row, by sweeping the edge crossings.'''
+        x0, y0, x1, y1 = self.edges[edge_ids].T
+        crosses = (y0 > y) != (y1 > y)
+        if not crosses.any():
+            return -1
+        x0, y0, x1, y1 = x0[crosses], y0[crosses], x1[crosses], y1[crosses]
+        at = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        order = np.argsort(at, kind='stable')
+        inside, after = set(), []
+        for owner in self.owners[edge_ids[crosses][order]].tolist():
+            inside ^= {owner}
+            after.append(min(inside) if inside else -1)
+        position = np.searchsorted(at[order], xs, side='right')
+        return np.where(position > 0, np.array([-1] + after)[position], -1)
+
+    @staticmethod
+    def _cell_coords(x, y, origin, cell_size, shape):
+        ix = np.clip(((x - origin[0]) // cell_size[0]).astype(np.int64), 0, shape[1] - 1)
+        iy = np.clip(((y - origin[1]) // cell_size[1]).astype(np.int64), 0, shape[0] - 1)
+        return ix, iy
+
+    # -- lookups --------------------------------------------------------
+
+    def locate(self, x, y):
+        '''Index of the polygon holding each point (x = longitude, y = latitude), -1 if none.'''
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        ny, nx = self.shape
+        fx = (x - self.origin[0]) // self.cell_size[0]
+        fy = (y - self.origin[1]) // self.cell_size[1]
+        valid = (fx >= 0) & (fx < nx) & (fy >= 0) & (fy < ny)   # False for NaN too
+        result = np.full(len(x), -1, dtype=np.int32)
+        points = np.flatnonzero(valid)
+        cells = fy[points].astype(np.int64) * nx + fx[points].astype(np.int64)
+        result[points] = self.center_owner[cells]
+
+        counts = self.cell_start[cells + 1] - self.cell_start[cells]
+        boundary = counts > 0
+        points, cells, counts = points[boundary], cells[boundary], counts[boundary]
+        # Batches bounded by (point, edge) pairs rather than points, so memory stays flat
+        done = np.cumsum(counts) - counts
+        start = 0
+        while start < len(points):
+            end = max(start + 1, np.searchsorted(done, done[start] + PAIRS_PER_BATCH))
+            batch = points[start:end]
+            result[batch] = self._refine(x[batch], y[batch], cells[start:end], counts[start:end], result[batch])
+            start = end
+        return result
+
+    def _refine(self, px, py, cells, counts, owner):
+        '''Owners of points in boundary cells, from the crossings centre -> point.'''
+        nx = self.shape[1]
+        cx = self.origin[0] + (cells % nx + 0.5) * self.cell_size[0]
+        cy = self.origin[1] + (cells // nx + 0.5) * self.cell_size[1]
+        pair_point = np.repeat(np.arange(len(cells)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        edge_ids = self.cell_edges[np.repeat(self.cell_start[cells], counts) + offsets]
+        ax, ay, bx, by = self.edges[edge_ids].T
+        sx, sy = cx[pair_point], cy[pair_point]
+        tx, ty = px[pair_point], py[pair_point]
+        dx, dy = tx - sx, ty - sy
+        # The edge's ends on either side of the segment's line (a half-open test,
+        # so a vertex on the line counts once) and the segment's ends on either
+        # side of the edge's line
+        side_a = dx * (ay - sy) - dy * (ax - sx) > 0
+        side_b = dx * (by - sy) - dy * (bx - sx) > 0
+        ex, ey = bx - ax, by - ay
+        side_s = ex * (sy - ay) - ey * (sx - ax) > 0
+        side_t = ex * (ty - ay) - ey * (tx - ax) > 0
+        crossing = (side_a != side_b) & (side_s != side_t)
+
+        # Polygons crossed an odd number of times flip membership
+        n = len(self.keys)
+        flips, times = np.unique(pair_point[crossing] * n + self.owners[edge_ids[crossing]], return_counts=True)
+        flips = flips[times % 2 == 1]
+        flip_point, flip_owner = flips // n, (flips % n).astype(np.int32)
+        # Where polygons overlap, the lowest index holding the point wins, as in _row_owners
+        left = flip_owner == owner[flip_point]
+        result = np.where(owner >= 0, owner, n).astype(np.int32)
+        result[flip_point[left]] = n
+        np.minimum.at(result, flip_point[~left], flip_owner[~left])
+        result[result == n] = -1
+        return result
+
+    def assign(self, x, y):
+        '''Key of the polygon holding each point, None outside every polygon.'''
+        return np.append(self.keys, None)[self.locate(x, y)]
+
+    # -- persistence ----------------------------------------------------
+
+    def save(self, path, **meta):
+        np.savez(path, keys=self.keys.astype(str), edges=self.edges, owners=self.owners, origin=self.origin,
+                 cell_size=self.cell_size, shape=np.array(self.shape), cell_start=self.cell_start,
+                 cell_edges=self.cell_edges, center_owner=self.center_owner,
+                 meta=np.array(repr(sorted(dict(meta, format=GRID_FORMAT).items()))))
+
+    @classmethod
+    def load(cls, path, **meta):
+        '''Load a saved index, or return None if it was saved with other meta.'''
+        try:
+            with np.load(path) as data:
+                if str(data['meta']) != repr(sorted(dict(meta, format=GRID_FORMAT).items())):
+                    return None
+                grid = (data['origin'], data['cell_size'], tuple(data['shape'].tolist()), data['cell_start'],
+                        data['cell_edges'], data['center_owner'])
+                return cls(data['keys'].astype(object), data['edges'], data['owners'], grid)
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+def cached_layer(path, key_properties):
+    '''BoundaryLayer of a GeoJSON file, with the index cached next to it.'''
+    stat = os.stat(path)
+    cache_path = path + '.grid.npz'
+    layer = BoundaryLayer.load(cache_path, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    if layer is None:
+        layer = BoundaryLayer.from_geojson(path, key_properties)
+        tmp_path = '{}.{}.tmp.npz'.format(path, os.getpid())
+        try:
+            layer.save(tmp_path, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    return layer
+
+
+def load_layers(directory, layers=LAYERS):
+    '''{layer name: BoundaryLayer} for the boundary files found in directory.'''
+    found = {}
+    for name, (filename, key_properties) in layers.items():
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            found[name] = cached_layer(path, key_properties)
+    if not found:
+        raise ValueError('no boundary files ({}) in {}'.format(
+            ', '.join(filename for filename, _ in layers.values()), directory))
+    return found
+
+
+# -- joins --------------------------------------------------------------
+
+def assign_areas(df, layers, lat_col='Latitude', lon_col='Longitude'):
+    '''Copy of df with an Area_* column per layer; rows without coordinates get None.'''
+    df = df.copy()
+    lon = pd.to_numeric(df[lon_col], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    lat = pd.to_numeric(df[lat_col], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    for name, layer in layers.items():
+        df[AREA_COLUMNS.get(name, 'Area_' + name)] = layer.assign(lon, lat)
+    return df
+
+
+def district_columns(boro_cd):
+    '''BOROUGH and COMMUNITYDISTRICT, as in monthly_tonnage.csv, from boro_cd codes.'''
+    code = pd.to_numeric(pd.Series(boro_cd), errors='coerce')
+    borough = (code // 100).map(BOROUGH_CODES)
+    district = (code % 100).map(lambda d: '' if pd.isnull(d) else '{:02d}'.format(int(d)))
+    return pd.DataFrame({'BOROUGH': borough.values, 'COMMUNITYDISTRICT': district.values})
+
+
+def district_counts(df, date_col='Date_Received', district_col=AREA_COLUMNS['community_district']):
+    '''Complaints per year, borough and community district.
+
+    Indexed by (year, borough, district) like TonnageRollup's year x
+    district table. The year is the first four digit group of the date
+    text, as in complaints.stream_complaint_cube.'''
+    keys = district_columns(df[district_col].values)
+    year = pd.to_numeric(df[date_col].astype(str).str.extract(r'(\d{4})', expand=False), errors='coerce')
+    keys['year'] = year.values
+    keys = keys.dropna()
+    keys = keys[keys['COMMUNITYDISTRICT'] != '']
+    counts = keys.groupby(['year', 'BOROUGH', 'COMMUNITYDISTRICT']).size()
+    counts.index = counts.index.set_levels(counts.index.levels[0].astype(np.int64), level=0)
+    counts.index.names = ['year', 'borough', 'district']
+    return counts.rename('complaints')
+
+
+def join_tonnage(counts, rollup):
+    '''Yearly district tonnage next to the complaint counts of the same district.'''
+    tonnage = rollup.table('year', 'district')
+    joined = tonnage.join(counts, how='outer')
+    joined['complaints'] = joined['complaints'].fillna(0).astype(np.int64)
+    return joined
+
+
+def locate_csv(path, layers, out_path, chunksize=500000, lat_col='Latitude', lon_col='Longitude',
+               date_col='Date_Received'):
+    '''Stream a complaints CSV through assign_areas into out_path.
+
+    Returns the district counts when a community district layer is
+    loaded, otherwise None.'''
+    counts = []
+    tmp_path = '{}.{}.tmp'.format(out_path, os.getpid())
+    try:
+        header = True
+        for chunk in pd.read_csv(path, dtype=str, chunksize=chunksize):
+            located = assign_areas(chunk, layers, lat_col, lon_col)
+            located.to_csv(tmp_path, mode='w' if header else 'a', header=header, index=False)
+            header = False
+            if 'community_district' in layers and date_col in located:
+                counts.append(district_counts(located, date_col))
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if not counts:
+        return None
+    return pd.concat(counts).groupby(level=[0, 1, 2]).sum()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Assign complaint coordinates to boundary areas.')
+    parser.add_argument('complaints', help='complaints CSV with Latitude and Longitude')
+    parser.add_argument('--boundaries', default='boundaries', help='directory of boundary GeoJSON files')
+    parser.add_argument('--out', help='located CSV to write, default <complaints>_located.csv')
+    parser.add_argument('--tonnage', help='monthly_tonnage.csv, to join the district counts with')
+    parser.add_argument('--district-out', help='CSV for the yearly district counts (and tonnage)')
+    parser.add_argument('--chunksize', type=int, default=500000)
+    args = parser.parse_args()
+
+    layers = load_layers(args.boundaries)
+    out_path = args.out or os.path.splitext(args.complaints)[0] + '_located.csv'
+    counts = locate_csv(args.complaints, layers, out_path, args.chunksize)
+    print('{} -> {} ({})'.format(args.complaints, out_path, ', '.join(sorted(layers))))
+    if args.district_out:
+        if counts is None:
+            parser.error('--district-out needs {}'.format(LAYERS['community_district'][0]))
+        if args.tonnage:
+            from tonnage_rollup import TonnageRollup
+            counts = join_tonnage(counts, TonnageRollup.from_csv(args.tonnage))
+        (counts.to_frame() if isinstance(counts, pd.Series) else counts).to_csv(args.district_out)
+        print('district counts -> {}'.format(args.district_out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+'''Month / quarter / year rollups of the DSNY monthly tonnage data.
+
+monthly_tonnage.csv has one row per month ("1993 / 11"), borough and
+community district. TonnageRollup parses the month keys in one vectorized
+step, sums the raw rows once into a month x district table, and derives
+every coarser level from that table:
+
+    time:  month (Period 'M'), quarter (Period 'Q'), year (int)
+    place: city, borough, district (borough + community district)
+
+Each of the nine tables is indexed by (time[, borough[, district]]) and
+sorted, so query() is an index slice rather than a regroup of the raw
+rows.
+
+The yearly city totals are what the REFUSETONSCOLLECTED..XMASTREETONS
+columns of yearly_numeric_data.csv hold; update_yearly_files writes them
+back into the yearly CSVs so that step is reproducible:
+
+    python tonnage_rollup.py datasets'''
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+TONNAGE_COLUMNS = ['REFUSETONSCOLLECTED', 'PAPERTONSCOLLECTED', 'MGPTONSCOLLECTED', 'RESORGANICSTONS',
+                   'SCHOOLORGANICTONS', 'LEAVESORGANICTONS', 'XMASTREETONS']
+TIME_GRAINS = ['month', 'quarter', 'year']
+GEO_GRAINS = ['city', 'borough', 'district']
+GEO_KEYS = {'city': [], 'borough': ['borough'], 'district': ['borough', 'district']}
+
+
+def parse_months(series):
+    '''Monthly Periods from month keys like "1993 / 11" (or "1993-11").'''
+    parts = series.astype(str).str.extract(r'(\d{4})\D+(\d{1,2})')
+    dates = pd.to_datetime({'year': pd.to_numeric(parts[0]), 'month': pd.to_numeric(parts[1]), 'day': 1},
+                           errors='coerce')
+    return dates.dt.to_period('M')
+
+
+class TonnageRollup:
+    def __init__(self, df, columns=TONNAGE_COLUMNS):
+        self.columns = list(columns)
+        base = pd.DataFrame({
+            'month': parse_months(df['MONTH']),
+            'borough': df['BOROUGH'].astype(str).str.strip(),
+            'district': df['COMMUNITYDISTRICT'].astype(str).str.strip().str.zfill(2),
+        })
+        base[self.columns] = df[self.columns].astype(np.float64)
+        base = base[base['month'].notnull()]
+
+        month_district = base.groupby(['month', 'borough', 'district'])[self.columns].sum()
+        self.tables = {('month', 'district'): month_district}
+        flat = month_district.reset_index()
+        flat['quarter'] = flat['month'].dt.asfreq('Q')
+        flat['year'] = flat['month'].dt.year
+        for time in TIME_GRAINS:
+            for geo in GEO_GRAINS:
+                if (time, geo) not in self.tables:
+                    keys = [time] + GEO_KEYS[geo]
+                    self.tables[(time, geo)] = flat.groupby(keys)[self.columns].sum().sort_index()
+
+    @classmethod
+    def from_csv(cls, path, columns=TONNAGE_COLUMNS):
+        return cls(pd.read_csv(path, dtype={'COMMUNITYDISTRICT': str}), columns)
+
+    @property
+    def nbytes(self):
+        return int(sum(table.memory_usage(deep=True).sum() for table in self.tables.values()))
+
+    def table(self, time='year', geo='city'):
+        if time not in TIME_GRAINS or geo not in GEO_GRAINS:
+            raise ValueError('time must be one of {} and geo one of {}'.format(TIME_GRAINS, GEO_GRAINS))
+        return self.tables[(time, geo)]
+
+    def query(self, time='year', geo='city', start=None, end=None, borough=None, district=None,
+              columns=None):
+        '''Slice of one rollup table.
+
+        start and end bound the time key (inclusive; a year, or anything
+        pandas accepts for a Period such as '2015-03' or '2015Q2').
+        borough and district pick one place at the borough or district
+        level.'''
+        table = self.table(time, geo)
+        if time != 'year':
+            freq = 'M' if time == 'month' else 'Q'
+            start = None if start is None else pd.Period(start, freq=freq)
+            end = None if end is None else pd.Period(end, freq=freq)
+        if geo == 'city':
+            result = table.loc[start:end]
+        else:
+            levels = [slice(start, end)]
+            levels.append(slice(None) if borough is None else borough)
+            if geo == 'district':
+                levels.append(slice(None) if district is None else str(district).zfill(2))
+            result = table.loc[tuple(levels), :]
+        return result if columns is None else result[columns]
+
+    def yearly_city_totals(self, years=None):
+        '''Year x tonnage column totals, as stored in yearly_numeric_data.csv.'''
+        totals = self.table('year', 'city')
+        return totals if years is None else totals.reindex(years)
+
+
+def update_yearly_files(rollup, num_file, stan_file):
+    '''Rewrite the tonnage columns of the yearly numeric and standardized CSVs.
+
+    Only years already in the yearly files are filled; years without
+    tonnage data stay empty. The standardized copy is min-max scaled to
+    [0,1] like the rest of yearly_stan_data.csv.'''
+    # round_trip parsing so the columns we do not touch are written back unchanged
+    num_df = pd.read_csv(num_file, index_col=0, float_precision='round_trip')
+    stan_df = pd.read_csv(stan_file, index_col=0, float_precision='round_trip')
+    totals = rollup.yearly_city_totals(num_df['year'].astype(int).values)
+    for col in rollup.columns:
+        # Round away float summation noise so reruns write identical files
+        values = np.round(totals[col].values, 6)
+        num_df[col] = values
+        low, high = np.nanmin(values), np.nanmax(values)
+        stan_df[col] = (values - low) / (high - low) if high > low else 0.0
+    num_df.to_csv(num_file)
+    stan_df.to_csv(stan_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Regenerate the yearly tonnage columns from monthly_tonnage.csv.')
+    parser.add_argument('data_dir', help='directory holding monthly_tonnage.csv and the yearly CSVs')
+    args = parser.parse_args()
+
+    rollup = TonnageRollup.from_csv(os.path.join(args.data_dir, 'monthly_tonnage.csv'))
+    update_yearly_files(rollup, os.path.join(args.data_dir, 'yearly_numeric_data.csv'),
+                        os.path.join(args.data_dir, 'yearly_stan_data.csv'))
+
+
+if __name__ == '__main__':
+    main()
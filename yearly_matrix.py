@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+'''Memory-mapped store of the yearly numeric data.
+
+yearly_numeric_data.csv is one row per year and one float column per
+series; yearly_stan_data.csv is the same data min-max scaled and the
+app's "full" frame is the subset of columns without gaps. Instead of a
+pandas copy of each in every worker, YearlyMatrix keeps the data once:
+
+    <csv>.matrix.npy   float64 values, rows x series (NaN where missing)
+    <csv>.valid.npy    validity bitmask, one packed row of bits per series
+    <csv>.matrix.json  index, years, column names, per-column min/max and
+                       the source file's size, mtime and SHA-1
+
+The .npy files are opened with mmap_mode='r', so every worker process
+maps the same page cache pages and adding workers or series does not add
+private memory. frame() wraps the mapped values in a DataFrame without
+copying them; standardized() and complete_columns() derive the
+standardized and gap-free views on the fly.
+
+    yearly = cached_yearly_matrix(num_file)
+    num_df = yearly.frame()
+    stan_df = yearly.standardized(['year', 'new_york_city_population'])'''
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from dataset_cache import _dump_json, _write_atomic, file_hash
+
+MATRIX_FORMAT = 1
+YEAR_COLUMN = 'year'
+
+
+def matrix_paths(csv_path):
+    return csv_path + '.matrix.npy', csv_path + '.valid.npy', csv_path + '.matrix.json'
+
+
+def _save_npy(array, path):
+    # np.save(path) would append .npy to the temporary name
+    with open(path, 'wb') as f:
+        np.save(f, array)
+
+
+class YearlyMatrix:
+    def __init__(self, index, years, columns, values, valid, minimum, maximum):
+        self.index = pd.Index(index)
+        self.years = np.asarray(years, dtype=np.int64)
+        self.columns = list(columns)
+        self.values = values          # (rows, columns) float64, usually a read-only memmap
+        self.valid = valid            # (columns, ceil(rows / 8)) uint8, packed bits
+        self.minimum = np.asarray(minimum, dtype=np.float64)
+        self.maximum = np.asarray(maximum, dtype=np.float64)
+        self._positions = {col: i for i, col in enumerate(self.columns)}
+
+    @classmethod
+    def from_frame(cls, df, year_col=YEAR_COLUMN):
+        data = df.drop(columns=[year_col])
+        values = np.ascontiguousarray(data.to_numpy(dtype=np.float64, na_value=np.nan))
+        valid = np.packbits(~np.isnan(values).T, axis=1)
+        # +-inf for columns without any value; standardized() leaves those NaN
+        minimum = np.where(np.isnan(values), np.inf, values).min(axis=0)
+        maximum = np.where(np.isnan(values), -np.inf, values).max(axis=0)
+        return cls(df.index, df[year_col].astype(np.int64).values, data.columns, values, valid,
+                   minimum, maximum)
+
+    # -- persistence ----------------------------------------------------
+
+    def save(self, csv_path, **meta):
+        values_path, valid_path, meta_path = matrix_paths(csv_path)
+        meta = dict(meta, format=MATRIX_FORMAT, index=self.index.tolist(), years=self.years.tolist(),
+                    columns=self.columns, minimum=self.minimum.tolist(), maximum=self.maximum.tolist())
+        _write_atomic(values_path, lambda p: _save_npy(self.values, p))
+        _write_atomic(valid_path, lambda p: _save_npy(self.valid, p))
+        # Written last: a reader only trusts the arrays once their meta matches
+        _write_atomic(meta_path, lambda p: _dump_json(meta, p))
+
+    @classmethod
+    def open(cls, csv_path):
+        '''Map a saved matrix, returning (matrix, meta).'''
+        values_path, valid_path, meta_path = matrix_paths(csv_path)
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('format') != MATRIX_FORMAT:
+            raise ValueError('matrix format {} is not {}'.format(meta.get('format'), MATRIX_FORMAT))
+        values = np.load(values_path, mmap_mode='r')
+        valid = np.load(valid_path, mmap_mode='r')
+        matrix = cls(meta['index'], meta['years'], meta['columns'], values, valid,
+                     meta['minimum'], meta['maximum'])
+        return matrix, meta
+
+    # -- views ----------------------------------------------------------
+
+    @property
+    def nbytes(self):
+        return int(self.values.nbytes + self.valid.nbytes)
+
+    def positions(self, columns):
+        return [self._positions[col] for col in columns]
+
+    def valid_mask(self, columns):
+        '''(rows, len(columns)) bool array unpacked from the bitmask.'''
+        bits = np.unpackbits(self.valid[self.positions(columns)], axis=1, count=len(self.index))
+        return bits.T.astype(bool)
+
+    def valid_rows(self, columns):
+        '''Rows where every one of columns has a value.'''
+        return self.valid_mask(columns).all(axis=1)
+
+    def complete_columns(self):
+        '''Columns with a value in every row.'''
+        bits = np.unpackbits(self.valid, axis=1, count=len(self.index))
+        return [col for col, full in zip(self.columns, bits.all(axis=1)) if full]
+
+    def _frame(self, values, columns, year):
+        df = pd.DataFrame(values, index=self.index, columns=columns, copy=False)
+        if year:
+            df.insert(0, YEAR_COLUMN, self.years)
+        return df
+
+    def frame(self, columns=None, year=True):
+        '''The yearly numeric data as a DataFrame with a leading year column.
+
+        Without columns the frame is a view of the mapped values; a column
+        subset copies just those columns.'''
+        if columns is None:
+            return self._frame(self.values, self.columns, year)
+        columns = [col for col in columns if col != YEAR_COLUMN]
+        return self._frame(self.values[:, self.positions(columns)], columns, year)
+
+    def standardized(self, columns=None, year=True):
+        '''Columns min-max scaled to [0,1], as in yearly_stan_data.csv.'''
+        if columns is None:
+            columns = self.columns
+        columns = [col for col in columns if col != YEAR_COLUMN]
+        pos = self.positions(columns)
+        low, high = self.minimum[pos], self.maximum[pos]
+        span = np.where(high > low, high - low, np.nan)
+        return self._frame((self.values[:, pos] - low) / span, columns, year)
+
+
+def cached_yearly_matrix(csv_path):
+    '''YearlyMatrix for csv_path, mapped from the files next to it.
+
+    The files are rebuilt when the CSV's content changes; a new mtime
+    with the same SHA-1 keeps them.'''
+    stat = os.stat(csv_path)
+    try:
+        matrix, meta = YearlyMatrix.open(csv_path)
+    except (OSError, ValueError, KeyError):
+        matrix, meta = None, None
+    if meta is not None and meta.get('size') == stat.st_size:
+        if meta.get('mtime_ns') == stat.st_mtime_ns or meta.get('sha1') == file_hash(csv_path):
+            return matrix
+
+    sha1 = file_hash(csv_path)
+    matrix = YearlyMatrix.from_frame(pd.read_csv(csv_path, index_col=0))
+    try:
+        matrix.save(csv_path, source=os.path.basename(csv_path), size=stat.st_size,
+                    mtime_ns=stat.st_mtime_ns, sha1=sha1)
+        return YearlyMatrix.open(csv_path)[0]
+    except OSError:
+        return matrix  # read-only data directory: serve from memory